@@ -0,0 +1,229 @@
+import collections
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+import protocol
+
+class ConnectionSlots:
+    """Counts open connections against an optional cap, tracking the peak"""
+
+    def __init__(self, limit=0):
+        self.limit = limit  # 0 means unlimited
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a slot for a new connection. Returns False if the server is full."""
+        with self._lock:
+            if self.limit and self.current >= self.limit:
+                return False
+            self.current += 1
+            if self.current > self.peak:
+                self.peak = self.current
+            return True
+
+    def release(self):
+        with self._lock:
+            self.current -= 1
+
+class _PendingHandshake:
+    __slots__ = ("connection", "address", "decoder", "deadline", "hello_done", "tls_done", "reply", "username")
+
+    def __init__(self, connection, address, deadline, decoder):
+        self.connection = connection
+        self.address = address
+        self.decoder = decoder
+        self.deadline = deadline
+        self.hello_done = False
+        self.tls_done = False
+        self.reply = None     # what is left to send of the HELLO reply
+        self.username = None  # held back until the reply is out
+
+class HandshakeReactor:
+    """Reads the handshakes of many new connections on one thread.
+
+    With a thread per connection, a client that connects and never sends
+    its username holds a thread for the whole handshake timeout. Here
+    pending handshakes are just entries in a selector. Only once a client's
+    username has arrived is it handed to on_ready, which starts the
+    client's own thread.
+
+    on_ready(connection, address, decoder, username) receives the decoder
+    with any bytes the client already pipelined after its username.
+    on_failed(connection, address, reason) is called for timeouts, early
+    disconnects and protocol errors. negotiate(connection, decoder, hello)
+    answers a protocol HELLO and returns the reply frame. new_decoder(address)
+    makes the FrameDecoder for a connection.
+
+    With a tls_context, the TLS handshake is driven here as well, without
+    blocking, and connection.socket is replaced by the SSLSocket.
+    """
+
+    def __init__(self, timeout, negotiate, on_ready, on_failed, name="handshakes", tls_context=None,
+                 new_decoder=None):
+        self.timeout = timeout
+        self.new_decoder = new_decoder or (lambda address: protocol.FrameDecoder())
+        self.tls_context = tls_context
+        self.negotiate = negotiate
+        self.on_ready = on_ready
+        self.on_failed = on_failed
+        self.selector = selectors.DefaultSelector()
+        self.incoming = collections.deque()   # handshakes added by the accept loop
+        self.deadlines = collections.deque()  # pending handshakes in deadline order
+        self.running = True
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self.selector.register(self._wakeup_receiver, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def add(self, connection, address):
+        """Hand a newly accepted connection over; callable from any thread"""
+        self.incoming.append(_PendingHandshake(
+            connection, address, time.monotonic() + self.timeout, self.new_decoder(address)))
+        try:
+            self._wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            pass  # a wakeup is already pending
+
+    def stop(self):
+        self.running = False
+        try:
+            self._wakeup_sender.send(b"\0")
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self.selector.get_map()) - 1
+
+    def _run(self):
+        while self.running:
+            timeout = None
+            if self.deadlines:
+                timeout = max(0.0, self.deadlines[0].deadline - time.monotonic())
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self._wakeup_receiver:
+                    self._accept_incoming()
+                    continue
+                pending = key.data
+                if pending.reply:
+                    self._send_reply(pending)
+                if events & selectors.EVENT_READ and pending.username is None and pending.deadline is not None:
+                    self._read(pending)
+            self._expire()
+
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self._finish(key.data, "server is shutting down")
+        self.selector.close()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+
+    def _accept_incoming(self):
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.incoming:
+            pending = self.incoming.popleft()
+            pending.connection.socket.setblocking(False)
+            if self.tls_context is not None:
+                pending.connection.socket = self.tls_context.wrap_socket(
+                    pending.connection.socket, server_side=True, do_handshake_on_connect=False)
+            self.selector.register(pending.connection.socket, selectors.EVENT_READ, pending)
+            self.deadlines.append(pending)
+
+    def _read(self, pending):
+        sock = pending.connection.socket
+        try:
+            if self.tls_context is not None and not pending.tls_done:
+                sock.do_handshake()
+                pending.tls_done = True
+            if not pending.decoder.recv_into(sock):
+                self._finish(pending, "closed during handshake")
+                return
+            # Decrypted bytes left inside the SSLSocket do not wake the selector
+            while self.tls_context is not None and sock.pending():
+                pending.decoder.recv_into(sock)
+            while True:
+                message = pending.decoder.next_message()
+                if message is None:
+                    return
+                hello = protocol.parse_hello(message) if not pending.hello_done else None
+                pending.hello_done = True
+                if hello is None:
+                    break
+                reply = self.negotiate(pending.connection, pending.decoder, hello)
+                pending.reply = memoryview(bytes(reply))
+                self._send_reply(pending)
+                if pending.deadline is None:
+                    return
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except (OSError, protocol.ProtocolError) as e:
+            self._finish(pending, f"handshake failed: {e}")
+            return
+
+        if pending.reply:
+            # Stop reading; what follows is the client's, and goes along with the decoder
+            pending.username = message
+            return
+        self._hand_off(pending, message)
+
+    def _send_reply(self, pending):
+        """Send what the socket takes of the HELLO reply, waiting to write the rest"""
+        sock = pending.connection.socket
+        try:
+            while pending.reply:
+                pending.reply = pending.reply[sock.send(pending.reply):]
+        except ssl.SSLWantReadError:
+            self.selector.modify(sock, selectors.EVENT_READ, pending)
+            return
+        except (BlockingIOError, ssl.SSLWantWriteError):
+            events = selectors.EVENT_WRITE
+            if pending.username is None:
+                events |= selectors.EVENT_READ
+            self.selector.modify(sock, events, pending)
+            return
+        except OSError as e:
+            self._finish(pending, f"handshake failed: {e}")
+            return
+        if pending.username is not None:
+            self._hand_off(pending, pending.username)
+        elif self.selector.get_key(sock).events != selectors.EVENT_READ:
+            self.selector.modify(sock, selectors.EVENT_READ, pending)
+
+    def _hand_off(self, pending, username):
+        self.selector.unregister(pending.connection.socket)
+        pending.connection.socket.setblocking(True)
+        pending.deadline = None
+        self.on_ready(pending.connection, pending.address, pending.decoder, username)
+
+    def _expire(self):
+        # All handshakes share one timeout, so deadlines arrive in order and
+        # each check is O(1); finished entries are skipped as they surface
+        now = time.monotonic()
+        while self.deadlines:
+            pending = self.deadlines[0]
+            if pending.deadline is not None and pending.deadline > now:
+                break
+            self.deadlines.popleft()
+            if pending.deadline is not None:
+                self._finish(pending, "timed out during initial handshake")
+
+    def _finish(self, pending, reason):
+        pending.deadline = None
+        try:
+            self.selector.unregister(pending.connection.socket)
+        except (KeyError, ValueError):
+            pass
+        if pending.decoder.capture is not None:
+            pending.decoder.capture.close()
+        self.on_failed(pending.connection, pending.address, reason)
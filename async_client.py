@@ -0,0 +1,327 @@
+import asyncio
+import codecs
+import os
+import shutil
+import signal
+import sys
+import time
+
+import client
+import protocol
+
+FRAME_RATE = 30          # most terminal repaints per second
+MAX_LINES_PER_FRAME = 500  # older lines of a larger burst are summarised
+READ_SIZE = 64 * 1024
+
+class LineEditor:
+    """Line being typed, edited one key at a time without blocking.
+
+    Understands printable text, Backspace, Ctrl+U (clear), Ctrl+W (delete
+    word), Ctrl+A/Ctrl+E and Home/End, and the left and right arrows.
+    feed() returns the lines completed with Enter.
+    """
+
+    def __init__(self):
+        self.text = []
+        self.cursor = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.escape = ""  # partial escape sequence
+
+    @property
+    def line(self):
+        return "".join(self.text)
+
+    def feed(self, data):
+        lines = []
+        for char in self.decoder.decode(data):
+            if self.escape:
+                self.escape += char
+                if ((len(self.escape) == 2 and char not in "[O")
+                        or (len(self.escape) > 2 and (char.isalpha() or char == "~"))
+                        or len(self.escape) > 8):
+                    self._escape_sequence(self.escape)
+                    self.escape = ""
+            elif char == "\x1b":
+                self.escape = char
+            elif char in "\r\n":
+                lines.append(self.line)
+                self.text.clear()
+                self.cursor = 0
+            elif char in "\x7f\x08":
+                if self.cursor:
+                    self.cursor -= 1
+                    del self.text[self.cursor]
+            elif char == "\x15":  # Ctrl+U
+                del self.text[:self.cursor]
+                self.cursor = 0
+            elif char == "\x17":  # Ctrl+W
+                start = self.cursor
+                while start and self.text[start - 1] == " ":
+                    start -= 1
+                while start and self.text[start - 1] != " ":
+                    start -= 1
+                del self.text[start:self.cursor]
+                self.cursor = start
+            elif char == "\x01":  # Ctrl+A
+                self.cursor = 0
+            elif char == "\x05":  # Ctrl+E
+                self.cursor = len(self.text)
+            elif char.isprintable():
+                self.text.insert(self.cursor, char)
+                self.cursor += 1
+        return lines
+
+    def _escape_sequence(self, sequence):
+        if sequence in ("\x1b[D", "\x1bOD"):
+            self.cursor = max(0, self.cursor - 1)
+        elif sequence in ("\x1b[C", "\x1bOC"):
+            self.cursor = min(len(self.text), self.cursor + 1)
+        elif sequence in ("\x1b[H", "\x1bOH", "\x1b[1~"):
+            self.cursor = 0
+        elif sequence in ("\x1b[F", "\x1bOF", "\x1b[4~"):
+            self.cursor = len(self.text)
+        elif sequence == "\x1b[3~" and self.cursor < len(self.text):
+            del self.text[self.cursor]
+
+class Screen:
+    """Coalesces output and repaints the terminal at most FRAME_RATE times a second.
+
+    Received messages are only appended to a list; a repaint clears the
+    input line, writes every pending line and redraws the prompt with the
+    partially typed input in a single write. A burst of hundreds of
+    messages therefore costs one write per frame instead of several per
+    message, and typing is never interrupted.
+    """
+
+    def __init__(self, editor, output=sys.stdout, interactive=True):
+        self.editor = editor
+        self.output = output
+        self.interactive = interactive  # False when stdout is not a terminal
+        self.prompt = ""
+        self.lines = []
+        self.skipped = 0
+        self.loop = asyncio.get_running_loop()
+        self.last_paint = 0.0
+        self.scheduled = False
+
+    def add(self, text):
+        self.lines.extend(text.split("\n"))
+        if len(self.lines) > MAX_LINES_PER_FRAME:
+            excess = len(self.lines) - MAX_LINES_PER_FRAME
+            self.skipped += excess
+            del self.lines[:excess]
+        self.refresh()
+
+    def set_prompt(self, prompt):
+        self.prompt = prompt
+        self.refresh()
+
+    def refresh(self):
+        """Schedule a repaint, respecting the frame rate"""
+        if self.scheduled:
+            return
+        self.scheduled = True
+        delay = self.last_paint + 1.0 / FRAME_RATE - time.monotonic()
+        if delay > 0:
+            self.loop.call_later(delay, self.paint)
+        else:
+            self.loop.call_soon(self.paint)
+
+    def paint(self):
+        self.scheduled = False
+        self.last_paint = time.monotonic()
+        parts = []
+        if self.interactive:
+            parts.append("\r\x1b[K")  # wipe the prompt line
+        if self.skipped:
+            parts.append(f"... {self.skipped} earlier messages not shown ...\n")
+            self.skipped = 0
+        for line in self.lines:
+            parts.append(line)
+            parts.append("\n")
+        self.lines.clear()
+        if self.interactive:
+            parts.append(self._input_line())
+        self.output.write("".join(parts))
+        self.output.flush()
+
+    def _input_line(self):
+        # Scroll long input sideways so the cursor stays on screen
+        text, cursor = self.editor.text, self.editor.cursor
+        width = max(10, shutil.get_terminal_size().columns - len(self.prompt) - 1)
+        start = max(0, cursor - width)
+        visible = "".join(text[start:start + width])
+        back = len(visible) - (cursor - start)
+        return self.prompt + visible + (f"\x1b[{back}D" if back else "")
+
+class AsyncChatClient:
+    """Chat client running its network, keyboard and screen on one event loop"""
+
+    def __init__(self, host, port, tls_context=None):
+        self.host = host
+        self.port = port
+        self.tls_context = tls_context
+        self.editor = LineEditor()
+        self.decoder = protocol.FrameDecoder()
+        self.version = 1
+        self.username = None
+        self.reader = self.writer = None
+        self.screen = None
+        self.done = None
+
+    async def run(self):
+        self.done = asyncio.get_running_loop().create_future()
+        self.screen = Screen(self.editor, interactive=sys.stdin.isatty() and sys.stdout.isatty())
+        print(f"Connecting to server at {self.host}:{self.port}...")
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.host, self.port, ssl=self.tls_context,
+                server_hostname=self.host if self.tls_context else None), 10.0)
+        await self.negotiate()
+        print(f"Connected to server at {self.host}:{self.port}")
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(sys.stdin.fileno(), self.on_keyboard)
+        loop.add_signal_handler(signal.SIGINT, self.stop, "exit")
+        receiver = loop.create_task(self.receive())
+        self.screen.set_prompt("Enter your username: ")
+        try:
+            await self.done
+        finally:
+            loop.remove_reader(sys.stdin.fileno())
+            loop.remove_signal_handler(signal.SIGINT)
+            receiver.cancel()
+            self.screen.paint()
+            if self.screen.interactive:
+                print()
+            self.writer.close()
+
+    async def negotiate(self):
+        """Ask for protocol v2 with compression and heartbeats, like client.py"""
+        self.writer.write(bytes(protocol.hello_frame(
+            proto=protocol.PROTOCOL_VERSION, batch=protocol.MAX_BATCH_SIZE,
+            compress=protocol.COMPRESSION, heartbeat=1)))
+        reply = await asyncio.wait_for(self.receive_one(), 10.0)
+        options = protocol.parse_hello(reply.text if reply else "")
+        if options is None:
+            if reply:
+                print(reply.text)
+            return
+        self.version = self.decoder.version = int(options.get("proto", 1))
+        self.decoder.max_frame_size = max(self.decoder.max_frame_size, int(options.get("batch", 0)))
+        if options.get("compress") == protocol.COMPRESSION:
+            self.decoder.decompressor = protocol.new_decompressor()
+
+    async def receive_one(self):
+        while True:
+            message = self.decoder.next_decoded()
+            if message is not None:
+                return message
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return None
+            self.decoder.feed(data)
+
+    async def receive(self):
+        """Decode everything each read delivers, then let the screen catch up"""
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    self.stop("Server has closed the connection.")
+                    return
+                self.decoder.feed(data)
+                while True:
+                    message = self.decoder.next_decoded()
+                    if message is None:
+                        break
+                    self.on_message(message)
+        except (OSError, protocol.ProtocolError) as e:
+            self.stop(f"An error occurred while receiving: {e}")
+
+    def on_message(self, message):
+        if message.kind == protocol.PING:
+            self.send(protocol.Message(protocol.PONG, message.body))
+            return
+        elif message.kind == protocol.PONG:
+            return
+        self.screen.add(client.format_message(message))
+        if (client.message_kind(message) == protocol.SYSTEM
+                and "shutting down" in message.text.lower()):
+            self.stop()
+
+    def on_keyboard(self):
+        try:
+            data = os.read(sys.stdin.fileno(), 4096)
+        except BlockingIOError:
+            return
+        if not data or (data == b"\x04" and not self.editor.text):
+            self.stop("exit")  # EOF or Ctrl+D on an empty line
+            return
+        for line in self.editor.feed(data):
+            self.submit(line)
+        self.screen.refresh()
+
+    def submit(self, line):
+        if self.username is None:
+            valid, result = client.validate_username(line)
+            if not valid:
+                self.screen.add(f"Invalid username: {result}")
+                return
+            self.username = result
+            self.send(protocol.Message(protocol.CHAT, result))
+            self.screen.add(f"Joined chat as: {result}\n{client.COMMAND_HINTS}")
+            self.screen.set_prompt("You: ")
+            return
+        if not line.strip():
+            return
+        if line.strip() == "/":
+            self.screen.add("💡 Tip: Type /help to see available commands")
+            return
+        if len(line) > 1000:
+            self.screen.add("Message too long. Maximum 1000 characters allowed.")
+            return
+        if self.screen.interactive:
+            # Keep what was sent in the scrollback; the input line is reused
+            self.screen.add(f"{self.screen.prompt}{line}")
+        self.send(protocol.Message(protocol.CHAT, line))
+        if line.lower() == "exit":
+            self.stop("Exit command sent. Closing client.")
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(bytes(message.frame(self.version)))
+
+    def stop(self, reason=None):
+        if reason == "exit":
+            # Ctrl+C or Ctrl+D: say goodbye to the server first
+            if self.username is not None:
+                self.send(protocol.Message(protocol.CHAT, "exit"))
+            reason = None
+        if reason:
+            self.screen.add(reason)
+        if not self.done.done():
+            self.done.set_result(None)
+
+def run_async_client(host=client.SERVER_IP, port=client.SERVER_PORT, tls_context=None):
+    """Run the chat client on an asyncio event loop with a raw-mode line editor"""
+    saved_mode = None
+    if sys.stdin.isatty():
+        import termios
+        import tty
+        saved_mode = termios.tcgetattr(sys.stdin.fileno())
+        # cbreak keeps Ctrl+C and output processing but hands us every key
+        tty.setcbreak(sys.stdin.fileno())
+    try:
+        asyncio.run(AsyncChatClient(host, port, tls_context).run())
+    except (asyncio.TimeoutError, ConnectionRefusedError):
+        print(f"Could not connect to {host}:{port}. Is the server running?")
+    except OSError as e:
+        print(f"Network error: {e}")
+    finally:
+        if saved_mode is not None:
+            termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, saved_mode)
+        print("Connection closed.")
+
+if __name__ == "__main__":
+    run_async_client()
@@ -0,0 +1,297 @@
+import asyncio
+import functools
+import signal
+import threading
+import time
+
+import heartbeat
+import outbound
+import protocol
+import server
+
+# Per-connection read buffer limit; keeps idle connections cheap
+STREAM_BUFFER_LIMIT = 16 * 1024
+
+class StreamConnection:
+    """Adapt an asyncio StreamWriter to the connection calls used by server.py.
+
+    broadcast(), handle_command() and friends only ever call send_frame(),
+    close() and abort() on a client, so the async server can share them
+    unchanged. send_frame() only enqueues; a per-connection writer task drains
+    the OutboundQueue and waits on drain(), so a slow reader fills its own
+    bounded queue instead of the transport buffer.
+    """
+
+    def __init__(self, writer, chat_server):
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        self.queue = chat_server.new_outbound_queue(on_ready=self._wake_writer)
+        self.version = 1      # protocol version negotiated with the peer
+        self.batch_limit = 0  # largest BATCH frame the peer accepts; 0 disables batching
+        self.compressor = None  # protocol.FrameCompressor when compression was negotiated
+        self.heartbeat = False  # peer answers pings, see heartbeat.py
+        self.last_seen = time.monotonic()  # when the peer last sent anything
+        self.session = None     # sessions.Session when the peer can resume after a drop
+        self.resume_seq = 0     # last session seq the peer saw before reconnecting
+        self.coalesce_window = chat_server.coalesce_window
+        self.cork = chat_server.tcp_cork
+        self.writer_task = self.loop.create_task(self._run_writer())
+
+    def send_frame(self, frame):
+        if not self.queue.put(frame):
+            raise ConnectionResetError("client dropped by slow-consumer policy")
+
+    def close(self):
+        """Flush whatever is queued, then close the stream"""
+        self.queue.close()
+
+    def abort(self):
+        """Discard queued frames and drop the connection immediately"""
+        self.queue.close(discard=True)
+        if threading.get_ident() == self.loop_thread:
+            self.writer.transport.abort()
+        else:
+            # A cluster bus thread delivering relayed chat; transports are not thread-safe
+            try:
+                self.loop.call_soon_threadsafe(self.writer.transport.abort)
+            except RuntimeError:
+                pass  # the loop has closed, and the transport with it
+
+    def join(self, timeout=None):
+        # The writer is a task on this loop; callers await writer_task instead
+        pass
+
+    def _wake_writer(self):
+        if threading.get_ident() == self.loop_thread:
+            self.ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def _run_writer(self):
+        try:
+            while True:
+                frames = self.queue.take(timeout=0)
+                if frames is None:
+                    break
+                if not frames:
+                    # Only wait once the queue is empty: a close() or put()
+                    # that arrived during the last drain has already set ready
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                if self.coalesce_window:
+                    # Let frames that arrive within the window share this write
+                    await asyncio.sleep(self.coalesce_window)
+                    frames.extend(self.queue.take(timeout=0) or ())
+                count = len(frames)
+                if self.batch_limit:
+                    frames = protocol.pack_batches(frames, self.batch_limit)
+                if self.compressor:
+                    frames = self.compressor.compress(frames)
+                sock = self.writer.get_extra_info("socket") if self.cork else None
+                if sock is not None:
+                    outbound.set_cork(sock, True)
+                self.writer.write(protocol.frames_to_bytes(frames))
+                if sock is not None:
+                    outbound.set_cork(sock, False)
+                server.count_write(count)
+                await self.writer.drain()
+        except ConnectionError:
+            self.queue.close(discard=True)
+        finally:
+            self.writer.close()
+
+async def receive_message(reader, decoder, decoded=False):
+    """Receive the next length-prefixed message from an asyncio stream.
+
+    Each read hands everything the stream has buffered to the shared
+    FrameDecoder, so pipelined messages are decoded without further awaits.
+    Returns the text, or a protocol.Message when decoded is set.
+    """
+    next_message = decoder.next_decoded if decoded else decoder.next_message
+    try:
+        while True:
+            message = next_message()
+            if message is not None:
+                return message
+            data = await reader.read(STREAM_BUFFER_LIMIT)
+            if not data:
+                return None
+            decoder.feed(data)
+    except (protocol.ProtocolError, ConnectionError):
+        return None
+
+async def client_handler(chat_server, reader, writer):
+    """Handle one client connection on the event loop"""
+    client_address = writer.get_extra_info("peername")
+    client_socket = StreamConnection(writer, chat_server)
+    username = None
+    server.connections_accepted.inc()
+    if not chat_server.connection_slots.acquire():
+        server.connections_rejected.inc()
+        print(f"Rejected connection from {client_address[0]}:{client_address[1]}: server full")
+        client_socket.send_frame(server.server_full_notice())
+        client_socket.close()
+        return
+    decoder = chat_server.new_decoder(client_address)
+    heartbeat.enable_keepalive(writer.get_extra_info("socket"))
+    # asyncio turns Nagle off for every TCP stream; --no-nodelay turns it back on
+    outbound.set_nodelay(writer.get_extra_info("socket"), chat_server.tcp_nodelay)
+    tls_object = writer.get_extra_info("ssl_object")
+    if tls_object is not None:
+        server.count_tls(tls_object)
+    limits = chat_server.rate_limiter.for_client(client_address)
+    dropped = False  # the connection went away rather than the client leaving
+    try:
+        # The loop accepts on its own, so --accept-rate delays the handshake instead
+        delay = chat_server.rate_limiter.accept_delay()
+        if delay:
+            server.accepts_throttled.inc()
+            await asyncio.sleep(delay)
+
+        try:
+            username = await asyncio.wait_for(receive_message(reader, decoder), server.HANDSHAKE_TIMEOUT)
+            hello = protocol.parse_hello(username or "")
+            if hello is not None:
+                # Newer clients negotiate the protocol before sending their username
+                server.queue_frame(client_socket, chat_server.negotiate_protocol(client_socket, decoder, hello))
+                username = await asyncio.wait_for(receive_message(reader, decoder), server.HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Client {client_address} timed out during initial handshake.")
+            return
+        if not username:
+            print(f"Failed to receive username from {client_address}")
+            return
+
+        username = server.clean_username(username)
+        if not username:
+            server.send_error(client_socket, "Invalid username")
+            return
+
+        username = chat_server.join_client(client_socket, username)
+        print(f"User {username} joined from {client_address}")
+
+        while chat_server.running:
+            message = await receive_message(reader, decoder, decoded=True)
+            if message is None:
+                dropped = True
+                break
+            client_socket.last_seen = time.monotonic()
+            server.bytes_in.inc(decoder.last_frame_size)
+            if limits:
+                delay = chat_server.admit_request(client_socket, username, limits, decoder.last_frame_size)
+                if delay is False:
+                    break
+                if delay is None:
+                    continue
+                if delay:
+                    await asyncio.sleep(delay)
+            if chat_server.handle_control(client_socket, message):
+                continue
+            request = message.text
+            if not request:
+                break
+            if not chat_server.handle_request(client_socket, username, request):
+                break
+
+    except (ConnectionResetError, ConnectionAbortedError):
+        print(f"Connection reset by {client_address}.")
+        dropped = True
+    except Exception as e:
+        print(f"Error handling client {client_address}: {e}")
+    finally:
+        chat_server.end_connection(client_socket, username, dropped)
+        chat_server.end_capture(decoder)
+        chat_server.rate_limiter.release(client_address)
+        chat_server.connection_slots.release()
+        client_socket.close()
+        print(f"Connection to {client_address} closed.")
+
+def raise_file_limit():
+    """Raise the open-file soft limit so the loop can hold many sockets"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+async def run_heartbeat(chat_server):
+    """Drive the heartbeat wheel from the loop, where evicting is safe"""
+    while True:
+        await asyncio.sleep(chat_server.heartbeats.wheel.tick)
+        chat_server.heartbeats.poll()
+
+async def expire_sessions(chat_server):
+    while True:
+        await asyncio.sleep(1.0)
+        chat_server.expire_sessions()
+
+async def serve(chat_server):
+    """Accept connections for a server.ChatServer until cancelled"""
+    if chat_server.listener is None:
+        chat_server.bind()
+    listener = await asyncio.start_server(
+        functools.partial(client_handler, chat_server),
+        sock=chat_server.listener,
+        limit=STREAM_BUFFER_LIMIT,
+        # The loop runs each TLS handshake alongside other work, never blocking accepts
+        ssl=chat_server.tls_context,
+        ssl_handshake_timeout=server.HANDSHAKE_TIMEOUT if chat_server.tls_context else None,
+    )
+    loop = asyncio.get_running_loop()
+    chat_server.loop, chat_server.task = loop, asyncio.current_task()
+    if chat_server.bus is not None:
+        # A cluster worker is stopped with SIGTERM; raising KeyboardInterrupt
+        # inside select() would skip the goodbyes below
+        loop.add_signal_handler(signal.SIGTERM, chat_server.task.cancel)
+    housekeeping = [loop.create_task(expire_sessions(chat_server))]
+    if chat_server.start_heartbeat(thread=False) is not None:
+        housekeeping.append(loop.create_task(run_heartbeat(chat_server)))
+    chat_server.running = True
+    transport = "asyncio event loop, TLS" if chat_server.tls_context else "asyncio event loop"
+    print(f"Listening on {chat_server.host}:{chat_server.port} ({transport})")
+    print("Server is ready to accept connections. Press Ctrl+C to stop.")
+    chat_server.ready.set()
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        for task in housekeeping:
+            task.cancel()
+        # Notify clients while the loop can still flush their transports
+        connections = chat_server.clients.snapshot
+        chat_server.shutdown_server()
+        writer_tasks = [client_socket.writer_task for client_socket, _ in connections
+                        if client_socket.writer_task]
+        if writer_tasks:
+            await asyncio.wait(writer_tasks, timeout=1.0)
+
+def run_async_server(chat_server):
+    """Run a server.ChatServer on a single-threaded asyncio event loop"""
+    raise_file_limit()
+    chat_server.start_metrics_endpoint()
+    chat_server.start_history()
+    chat_server.start_capture()
+    chat_server.start_search()
+    try:
+        asyncio.run(serve(chat_server))
+    except KeyboardInterrupt:
+        print("\nReceived shutdown signal.")
+    except asyncio.CancelledError:
+        pass  # stopped with ChatServer.stop()
+    except OSError as e:
+        print(f"Server error: {e}")
+    finally:
+        chat_server.loop = chat_server.task = None
+        print("Server closed.")
+
+if __name__ == "__main__":
+    server.ChatServer(mode="async").run()
@@ -0,0 +1,65 @@
+"""Micro-benchmark: per-recipient cost of broadcast encoding.
+
+Compares the old path, which encoded, length-prefixed and concatenated the
+message once per recipient, with sharing one pre-built protocol.Frame
+across every recipient's outbound queue. No sockets are involved; this
+measures only the work done on the sender's thread.
+
+    python3 benchmarks/bench_broadcast.py [--size 1024] [--repeat 5]
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbound
+import protocol
+
+RECIPIENT_COUNTS = (100, 1000, 10000)
+
+def legacy_encode(message):
+    """The per-recipient framing send_message() used to do"""
+    message_bytes = message.encode("utf-8")
+    length_prefix = struct.pack('!I', len(message_bytes))
+    return length_prefix + message_bytes
+
+def broadcast_legacy(queues, message):
+    for queue in queues:
+        queue.put(legacy_encode(message))
+
+def broadcast_framed(queues, message):
+    frame = protocol.Frame.from_text(message)
+    for queue in queues:
+        queue.put(frame)
+
+def time_broadcast(broadcast_fn, recipients, message, repeat):
+    """Best per-recipient time in nanoseconds over several runs"""
+    best = None
+    for _ in range(repeat):
+        queues = [outbound.OutboundQueue(max_bytes=1 << 30) for _ in range(recipients)]
+        start = time.perf_counter_ns()
+        broadcast_fn(queues, message)
+        elapsed = time.perf_counter_ns() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / recipients
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1000, help="message size in bytes")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement")
+    args = parser.parse_args()
+
+    message = "x" * args.size
+    print(f"message size: {args.size} bytes, best of {args.repeat}")
+    print(f"{'recipients':>10} {'legacy ns/rcpt':>15} {'framed ns/rcpt':>15} {'speedup':>8}")
+    for recipients in RECIPIENT_COUNTS:
+        legacy = time_broadcast(broadcast_legacy, recipients, message, args.repeat)
+        framed = time_broadcast(broadcast_framed, recipients, message, args.repeat)
+        print(f"{recipients:>10} {legacy:>15.0f} {framed:>15.0f} {legacy / framed:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
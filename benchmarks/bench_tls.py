@@ -0,0 +1,144 @@
+"""Benchmark: connect rate and message latency with and without TLS.
+
+Creates a self-signed certificate for 127.0.0.1 with the openssl command,
+starts a plaintext and a TLS server in this process on free ports, and
+measures for each transport:
+
+*   connect rate: sequential logins (TCP connect, TLS handshake, username,
+    first reply), and for TLS once more with every client offering the
+    session of the previous one, as client.py does when it reconnects;
+*   message latency: one user's chat message until another user has read
+    it, one message at a time.
+
+    python3 benchmarks/bench_tls.py [--connects 300] [--messages 2000] [--mode async] [--key ec]
+"""
+import argparse
+import contextlib
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+import server
+import tls
+
+HOST = "127.0.0.1"
+
+KEY_TYPES = {
+    "rsa": ["-newkey", "rsa:2048"],
+    "ec": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"],
+}
+
+def make_certificate(directory, key_type):
+    """Write a self-signed certificate and key for HOST; returns the file path"""
+    path = os.path.join(directory, "bench.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", *KEY_TYPES[key_type], "-nodes", "-days", "1", "-subj", "/CN=chat-bench",
+         "-addext", f"subjectAltName=IP:{HOST}", "-keyout", path, "-out", path],
+        check=True, capture_output=True)
+    return path
+
+class Login:
+    """Opens logged-in connections, over TLS when given a context"""
+
+    def __init__(self, port, tls_context=None, resume=False):
+        self.port = port
+        self.tls_context = tls_context
+        self.resume = resume
+        self.session = None
+        self.count = 0
+
+    def connect(self):
+        sock = socket.create_connection((HOST, self.port), timeout=10.0)
+        if self.tls_context is not None:
+            sock = self.tls_context.wrap_socket(sock, server_hostname=HOST, session=self.session)
+        reader = protocol.MessageReader(sock)
+        self.count += 1
+        protocol.send_frames(sock, [protocol.Frame.from_text(f"bench{self.count}")])
+        if reader.receive() is None:
+            raise ConnectionError("server closed the connection during login")
+        if self.resume:
+            self.session = sock.session
+        return sock, reader
+
+def measure_connects(login, count):
+    """Logins per second and mean milliseconds per login"""
+    start = time.perf_counter()
+    for _ in range(count):
+        sock, _ = login.connect()
+        sock.close()
+    elapsed = time.perf_counter() - start
+    return count / elapsed, elapsed / count * 1000
+
+def measure_latency(login, count):
+    """Median and 99th percentile milliseconds from send to receipt"""
+    sender, _ = login.connect()
+    receiver, reader = login.connect()
+    receiver.settimeout(10.0)
+    time.sleep(0.2)
+    # Drop the join notices and welcome text still in flight
+    receiver.settimeout(0.2)
+    with contextlib.suppress(socket.timeout):
+        while reader.receive() is not None:
+            pass
+    receiver.settimeout(10.0)
+
+    samples = []
+    for index in range(count):
+        frame = protocol.Frame.from_text(f"latency probe {index}")
+        start = time.perf_counter()
+        protocol.send_frames(sender, [frame])
+        while not (reader.receive() or "").endswith(f"latency probe {index}"):
+            pass
+        samples.append((time.perf_counter() - start) * 1000)
+    sender.close()
+    receiver.close()
+    samples.sort()
+    return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connects", type=int, default=300, help="logins per transport")
+    parser.add_argument("--messages", type=int, default=2000, help="latency samples per transport")
+    parser.add_argument("--mode", choices=("threads", "async"), default="threads", help="server mode")
+    parser.add_argument("--key", choices=sorted(KEY_TYPES), default="rsa",
+                        help="certificate key type (default: %(default)s)")
+    args = parser.parse_args()
+
+    report = sys.stdout
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w") as devnull:
+        certificate = make_certificate(directory, args.key)
+        client_context = tls.client_context(certificate)
+        # The servers' connection log would drown the report
+        with contextlib.redirect_stdout(devnull):
+            plain = server.ChatServer(host=HOST, port=0, mode=args.mode).start()
+            secure = server.ChatServer(host=HOST, port=0, mode=args.mode,
+                                       tls_context=tls.server_context(certificate)).start()
+            try:
+                runs = [
+                    ("plaintext", Login(plain.port)),
+                    ("tls", Login(secure.port, client_context)),
+                    ("tls resumed", Login(secure.port, client_context, resume=True)),
+                ]
+                print(f"{args.mode} server, {args.key} key, {args.connects} logins and "
+                      f"{args.messages} messages each, {ssl.OPENSSL_VERSION}", file=report)
+                print(f"{'transport':>12} {'logins/s':>9} {'ms/login':>9} {'p50 ms':>8} {'p99 ms':>8}",
+                      file=report)
+                for name, login in runs:
+                    rate, per_login = measure_connects(login, args.connects)
+                    p50, p99 = measure_latency(login, args.messages)
+                    print(f"{name:>12} {rate:>9.1f} {per_login:>9.3f} {p50:>8.3f} {p99:>8.3f}", file=report)
+                print(f"TLS handshakes: {server.tls_handshakes.value}, "
+                      f"resumed: {server.tls_resumed.value}", file=report)
+            finally:
+                plain.stop()
+                secure.stop()
+
+if __name__ == "__main__":
+    main()
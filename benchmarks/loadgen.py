@@ -0,0 +1,344 @@
+"""Headless load generator and latency benchmark for the chat server.
+
+Spins up many simulated users on one asyncio event loop, speaking the same
+length-prefixed protocol as client.py, and drives a configurable mix of
+room broadcasts, /whisper and /who against a running server. Chat messages
+carry the send timestamp, so every delivery yields an end-to-end latency
+sample. Results are printed as a table and optionally written as JSON for
+regression comparison.
+
+    python3 server.py --mode async &
+    python3 benchmarks/loadgen.py --users 500 --rate 2000 --duration 10 --output results.json
+
+With --in-process MODE the server runs inside the benchmark on a free port
+instead, so no server has to be started and runs do not collide on 8000.
+Its write options (--coalesce-ms, --cork) can then be set here too, and the
+report adds how many frames each socket write carried.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+from async_server import raise_file_limit
+
+BENCH_TAG = "bench"
+KINDS = ("broadcast", "whisper", "who")
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram with ~1% precision and bounded memory"""
+
+    GROWTH = 1.01
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = max(seconds * 1e6, 1.0)
+        index = int(math.log(micros, self.GROWTH))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Latency in seconds below which the given fraction of samples fall"""
+        if not self.count:
+            return 0.0
+        threshold = fraction * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= threshold:
+                return min(self.GROWTH ** (index + 1) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        """Summary in milliseconds"""
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count * 1e3, 3) if self.count else 0.0,
+            "p50": round(self.percentile(0.50) * 1e3, 3),
+            "p99": round(self.percentile(0.99) * 1e3, 3),
+            "p999": round(self.percentile(0.999) * 1e3, 3),
+            "max": round(self.max * 1e3, 3),
+        }
+
+class Stats:
+    def __init__(self):
+        self.sent = dict.fromkeys(KINDS, 0)
+        self.received = dict.fromkeys(KINDS, 0)
+        self.latency = {kind: LatencyHistogram() for kind in KINDS}
+        self.errors = 0
+        self.disconnects = 0
+
+class SimulatedUser:
+    """One benchmark connection: a reader task plus a paced sender"""
+
+    def __init__(self, index, args, stats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.username = f"{args.prefix}{index}"
+        self.reader = None
+        self.writer = None
+        # /who replies grow with the user count, so allow large frames
+        self.decoder = protocol.FrameDecoder(max_frame_size=1024 * 1024)
+        self.pending_who = []
+        self.welcomed = asyncio.Event()
+        self.measuring = False
+        self.closing = False
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        if self.args.protocol > 1:
+            # The server reads the HELLO before the username, so both can be pipelined
+            options = {"proto": self.args.protocol, "batch": protocol.MAX_BATCH_SIZE}
+            if self.args.compress:
+                options["compress"] = protocol.COMPRESSION
+            self.writer.write(bytes(protocol.hello_frame(**options)))
+        self.send(self.username)
+
+    def send(self, text):
+        if self.args.protocol > 1:
+            self.writer.write(bytes(protocol.Message(protocol.CHAT, text).frame(self.args.protocol)))
+        else:
+            self.writer.write(bytes(protocol.Frame.from_text(text)))
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(64 * 1024)
+                if not data:
+                    break
+                self.decoder.feed(data)
+                while True:
+                    message = self.decoder.next_message()
+                    if message is None:
+                        break
+                    self.handle(message, time.perf_counter_ns())
+        except (ConnectionError, protocol.ProtocolError):
+            pass
+        if not self.closing:
+            self.stats.disconnects += 1
+
+    def handle(self, message, now):
+        hello = protocol.parse_hello(message)
+        if hello is not None:
+            self.decoder.version = int(hello.get("proto", 1))
+            if hello.get("compress") == protocol.COMPRESSION:
+                self.decoder.decompressor = protocol.new_decompressor()
+            return
+        if message.startswith("Welcome to the chat, "):
+            self.username = message[len("Welcome to the chat, "):].split("!", 1)[0]
+            self.welcomed.set()
+            return
+        if message.startswith("ERROR:"):
+            if self.measuring:
+                self.stats.errors += 1
+            return
+        if message.startswith("Connected users") and self.pending_who:
+            sent_at = self.pending_who.pop(0)
+            if self.measuring:
+                self.stats.received["who"] += 1
+                self.stats.latency["who"].record((now - sent_at) / 1e9)
+            return
+
+        # "[user]: bench <ns>" or "[PRIVATE from user]: bench <ns>"
+        marker = message.find("]: " + BENCH_TAG + " ")
+        if marker < 0 or not self.measuring or message.startswith("[PRIVATE to"):
+            return
+        kind = "whisper" if message.startswith("[PRIVATE from") else "broadcast"
+        sent_at = int(message[marker + len(BENCH_TAG) + 4:].split(" ", 1)[0])
+        self.stats.received[kind] += 1
+        self.stats.latency[kind].record((now - sent_at) / 1e9)
+
+    async def send_loop(self, users, mix, interval, deadline):
+        padding = "x" * max(0, self.args.message_size - 30)
+        kinds, weights = zip(*mix.items())
+        while time.monotonic() < deadline:
+            # Exponential inter-arrival times give a Poisson arrival process
+            await asyncio.sleep(random.expovariate(1.0 / interval))
+            if self.writer.is_closing():
+                return
+            kind = random.choices(kinds, weights)[0]
+            stamp = time.perf_counter_ns()
+            if kind == "broadcast":
+                self.send(f"{BENCH_TAG} {stamp} {padding}")
+            elif kind == "whisper":
+                target = random.choice(users)
+                if target is self and len(users) > 1:
+                    continue
+                self.send(f"/whisper {target.username} {BENCH_TAG} {stamp} {padding}")
+            else:
+                self.pending_who.append(stamp)
+                self.send("/who")
+            self.stats.sent[kind] += 1
+            await self.writer.drain()
+
+def parse_mix(text):
+    """Parse "broadcast:90,whisper:8,who:2" into a weight per kind"""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition(":")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown message kind '{kind}'")
+        mix[kind] = float(weight or 1)
+    return mix
+
+async def run(args):
+    stats = Stats()
+    users = [SimulatedUser(index, args, stats) for index in range(args.users)]
+    readers = []
+
+    # Connect everyone, at most connect_concurrency handshakes in flight
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    async def connect(user):
+        async with semaphore:
+            await user.connect()
+            readers.append(asyncio.create_task(user.read_loop()))
+            await asyncio.wait_for(user.welcomed.wait(), 30)
+
+    connect_start = time.perf_counter()
+    results = await asyncio.gather(*(connect(user) for user in users), return_exceptions=True)
+    connect_seconds = time.perf_counter() - connect_start
+    failed = sum(1 for result in results if isinstance(result, BaseException))
+    users = [user for user, result in zip(users, results) if not isinstance(result, BaseException)]
+    if not users:
+        raise SystemExit("No users could connect; is the server running?")
+
+    if args.rooms > 1:
+        for user in users:
+            user.send(f"/join {args.prefix}room{user.index % args.rooms}")
+
+    # Let join notices drain before measuring
+    await asyncio.sleep(args.settle)
+    for user in users:
+        user.measuring = True
+
+    interval = len(users) / args.rate
+    start = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(user.send_loop(users, args.mix, interval, deadline) for user in users))
+    send_seconds = time.perf_counter() - start
+    # Wait for in-flight deliveries
+    await asyncio.sleep(args.settle)
+
+    for user in users:
+        user.closing = True
+        user.writer.close()
+    for task in readers:
+        task.cancel()
+
+    total_sent = sum(stats.sent.values())
+    total_received = sum(stats.received.values())
+    return {
+        "config": {
+            "host": args.host, "port": args.port, "users": args.users, "rate": args.rate,
+            "duration": args.duration, "mix": args.mix, "message_size": args.message_size,
+            "rooms": args.rooms, "protocol": args.protocol, "compress": args.compress,
+        },
+        "connect": {
+            "connected": len(users),
+            "failed": failed,
+            "seconds": round(connect_seconds, 3),
+            "per_second": round(len(users) / connect_seconds, 1),
+        },
+        "sent": stats.sent,
+        "received": stats.received,
+        "throughput": {
+            "sent_per_second": round(total_sent / send_seconds, 1),
+            "received_per_second": round(total_received / (send_seconds + args.settle), 1),
+        },
+        "latency_ms": {kind: stats.latency[kind].summary() for kind in KINDS},
+        "errors": stats.errors,
+        "disconnects": stats.disconnects,
+    }
+
+def print_report(result):
+    connect = result["connect"]
+    print(f"connected {connect['connected']} users in {connect['seconds']}s "
+          f"({connect['per_second']}/s, {connect['failed']} failed)")
+    throughput = result["throughput"]
+    print(f"sent {throughput['sent_per_second']} msg/s, delivered {throughput['received_per_second']} msg/s")
+    print(f"{'kind':>10} {'sent':>8} {'recv':>9} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'max ms':>8}")
+    for kind in KINDS:
+        latency = result["latency_ms"][kind]
+        print(f"{kind:>10} {result['sent'][kind]:>8} {result['received'][kind]:>9} "
+              f"{latency['p50']:>8} {latency['p99']:>8} {latency['p999']:>8} {latency['max']:>8}")
+    if "server" in result:
+        in_process = result["server"]
+        print(f"server wrote {in_process['socket_writes']} times, "
+              f"{in_process['frames_per_write']} frames per write")
+    if result["errors"] or result["disconnects"]:
+        print(f"errors: {result['errors']}, unexpected disconnects: {result['disconnects']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--users", type=int, default=100, help="simulated users (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=500.0, help="total messages per second (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load (default: %(default)s)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("broadcast:90,whisper:8,who:2"),
+                        help="weights per kind (default: broadcast:90,whisper:8,who:2)")
+    parser.add_argument("--message-size", type=int, default=100, help="approximate chat message bytes")
+    parser.add_argument("--rooms", type=int, default=1, help="spread users over this many rooms")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="handshakes in flight at once")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait before and after load")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=1,
+                        help="wire protocol version; 2 negotiates typed, batched frames")
+    parser.add_argument("--compress", action="store_true", help="ask for compression (needs --protocol 2)")
+    parser.add_argument("--prefix", default=BENCH_TAG, help="username prefix")
+    parser.add_argument("--output", help="write JSON results to this file ('-' for stdout)")
+    parser.add_argument("--in-process", choices=("threads", "async"), metavar="MODE",
+                        help="run a server in this process on a free port (threads or async)")
+    parser.add_argument("--coalesce-ms", type=float, default=0, metavar="MS",
+                        help="write coalescing window of the --in-process server")
+    parser.add_argument("--cork", action="store_true", help="cork the --in-process server's client sockets")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    if args.in_process:
+        import server
+        # The embedded server's connection log would drown the report
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            chat_server = server.ChatServer(host=args.host, port=0, mode=args.in_process,
+                                            coalesce_window=args.coalesce_ms / 1000,
+                                            tcp_cork=args.cork).start()
+            args.port = chat_server.port
+            try:
+                result = asyncio.run(run(args))
+            finally:
+                chat_server.stop()
+        writes = server.socket_writes.value
+        result["server"] = {
+            "mode": args.in_process, "coalesce_ms": args.coalesce_ms, "cork": args.cork,
+            "socket_writes": writes,
+            "frames_per_write": round(server.frames_written.value / writes, 2) if writes else 0,
+        }
+    else:
+        result = asyncio.run(run(args))
+    print_report(result)
+    if args.output == "-":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""Replay captured traffic against a chat server and report how it kept up.
+
+A server started with --capture FILE records every frame its clients
+send. This tool re-creates each captured connection and sends its frames
+byte for byte, with the captured timing scaled by --speed (2 replays twice
+as fast, 0 as fast as the server takes it), then compares the run with the
+capture:
+
+*   throughput: frames sent and messages delivered per second, against
+    the rate the capture implies at that speed;
+*   schedule lag: how much later than planned each frame went out, which
+    grows once the server stops keeping up with its readers;
+*   delivery latency: from sending a chat message or whisper until each
+    recipient has read it. Texts sent more than once are timed from their
+    latest send.
+
+At --speed 0 every connection closes as soon as its frames are out, so
+clients miss messages they received in the capture; use it for raw
+throughput, and a finite speed to compare latencies.
+
+    python3 server.py --capture traffic.cap     # serve real users, then Ctrl+C
+    python3 benchmarks/replay.py traffic.cap --speed 4 --in-process async
+
+Pass every file of a --workers capture (traffic.cap.worker-0, ...) to
+replay them together.
+"""
+import argparse
+import asyncio
+import contextlib
+import heapq
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import capture
+import protocol
+from async_server import raise_file_limit
+from loadgen import LatencyHistogram
+
+WHISPER_COMMANDS = ("/whisper ", "/w ")
+# Titles of the history the server replays on joins and for /history
+HISTORY_TITLES = ("--- Recent messages in #", "--- Last messages in #")
+HISTORY_END = "--- End of history ---"
+
+class Event:
+    __slots__ = ("time", "connection", "kind", "data", "texts")
+
+    def __init__(self, time, connection, kind, data=b"", texts=()):
+        self.time = time
+        self.connection = connection
+        self.kind = kind
+        self.data = data    # the frame with its length prefix, ready to write
+        self.texts = texts  # chat texts in the frame, to match against deliveries
+
+class UpstreamDecoder:
+    """Follows what one captured client sent, to find the chat texts in its frames"""
+
+    def __init__(self):
+        self.decoder = protocol.FrameDecoder(max_frame_size=protocol.MAX_BATCH_SIZE)
+        self.logged_in = False
+
+    def texts(self, data):
+        self.decoder.feed(data)
+        texts = []
+        try:
+            while True:
+                message = self.decoder.next_decoded()
+                if message is None:
+                    break
+                if message.kind in (protocol.PING, protocol.PONG):
+                    continue
+                text = message.text
+                hello = protocol.parse_hello(text)
+                if hello is not None:
+                    self.decoder.version = min(int(hello.get("proto", 1)), protocol.PROTOCOL_VERSION)
+                    if hello.get("compress") == protocol.COMPRESSION:
+                        self.decoder.decompressor = protocol.new_decompressor()
+                elif not self.logged_in:
+                    self.logged_in = True  # the username
+                elif text.startswith(WHISPER_COMMANDS):
+                    parts = text.split(" ", 2)
+                    if len(parts) == 3:
+                        texts.append(parts[2])
+                elif text and not text.startswith("/"):
+                    texts.append(text)
+        except (protocol.ProtocolError, UnicodeDecodeError):
+            pass  # the server drops such a client too; its frames still replay as captured
+        return texts
+
+def tagged_records(path, index):
+    for record in capture.read_capture(path):
+        yield record, index
+
+def load_events(paths):
+    """Merge capture files into one list of Events in time order"""
+    captures = [tagged_records(path, index) for index, path in enumerate(paths)]
+    upstream = {}
+    events = []
+    for record, index in heapq.merge(*captures, key=lambda item: item[0].time):
+        connection = (index, record.connection)
+        if record.kind == capture.OPEN:
+            upstream[connection] = UpstreamDecoder()
+            events.append(Event(record.time, connection, record.kind))
+        elif connection in upstream:
+            if record.kind == capture.FRAME:
+                data = protocol.LENGTH_PREFIX.pack(len(record.payload)) + record.payload
+                texts = upstream[connection].texts(data)
+                events.append(Event(record.time, connection, record.kind, data, texts))
+            else:
+                events.append(Event(record.time, connection, record.kind))
+    return events
+
+class Stats:
+    def __init__(self):
+        self.sent_at = {}  # chat text -> perf_counter of its latest send
+        self.frames = 0
+        self.bytes = 0
+        self.received = 0
+        self.failed = 0
+        self.last_send = 0.0
+        self.lag = LatencyHistogram()
+        self.latency = LatencyHistogram()
+
+class ReplayConnection:
+    """One captured client: sends its frames in order and reads what comes back"""
+
+    def __init__(self, args, stats):
+        self.args = args
+        self.stats = stats
+        self.outgoing = asyncio.Queue()  # (due, Event), then the linger once it closes
+        self.closed = False
+        self.in_history = False  # old messages are not timed
+        self.decoder = protocol.FrameDecoder(max_frame_size=1024 * 1024)
+        self.task = asyncio.create_task(self.run())
+
+    def send(self, due, event):
+        if not self.closed:
+            self.outgoing.put_nowait((due, event))
+
+    def close(self, linger=0.0):
+        """Close after the queued frames, keeping on reading for linger seconds"""
+        if not self.closed:
+            self.closed = True
+            self.outgoing.put_nowait(linger)
+
+    async def run(self):
+        try:
+            reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        except OSError:
+            self.stats.failed += 1
+            return
+        reading = asyncio.create_task(self.read_loop(reader))
+        try:
+            while True:
+                item = await self.outgoing.get()
+                if not isinstance(item, tuple):
+                    await asyncio.sleep(item)
+                    break
+                due, event = item
+                now = time.perf_counter()
+                if due is not None:
+                    self.stats.lag.record(max(0.0, now - due))
+                for text in event.texts:
+                    self.stats.sent_at[text] = now
+                writer.write(event.data)
+                self.stats.frames += 1
+                self.stats.bytes += len(event.data)
+                await writer.drain()
+                self.stats.last_send = time.perf_counter()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            reading.cancel()
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    return
+                now = time.perf_counter()
+                self.decoder.feed(data)
+                while True:
+                    message = self.decoder.next_message()
+                    if message is None:
+                        break
+                    self.handle(message, now)
+        except (ConnectionError, protocol.ProtocolError):
+            pass
+
+    def handle(self, message, now):
+        hello = protocol.parse_hello(message)
+        if hello is not None:
+            self.decoder.version = int(hello.get("proto", 1))
+            if hello.get("compress") == protocol.COMPRESSION:
+                self.decoder.decompressor = protocol.new_decompressor()
+            return
+        self.stats.received += 1
+        if message.startswith(HISTORY_TITLES):
+            self.in_history = True
+        elif message == HISTORY_END:
+            self.in_history = False
+        if self.in_history:
+            return
+        # "[user]: text" or "[PRIVATE from user]: text"
+        marker = message.find("]: ")
+        if marker >= 0 and not message.startswith("[PRIVATE to"):
+            sent_at = self.stats.sent_at.get(message[marker + 3:])
+            if sent_at is not None:
+                self.stats.latency.record(now - sent_at)
+
+async def replay(args, events):
+    stats = Stats()
+    connections = {}
+    first = events[0].time
+    start = time.perf_counter()
+    for event in events:
+        due = None
+        if args.speed:
+            due = start + (event.time - first) / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)  # let connections open and write as we go
+        if event.kind == capture.OPEN:
+            connections[event.connection] = ReplayConnection(args, stats)
+        elif event.kind == capture.FRAME:
+            connections[event.connection].send(due, event)
+        else:
+            connections[event.connection].close()
+    # Connections still open at the end of the capture wait for the last deliveries
+    for connection in connections.values():
+        connection.close(linger=args.settle)
+    await asyncio.gather(*(connection.task for connection in connections.values()))
+    send_seconds = max(stats.last_send - start, 1e-6)
+
+    capture_seconds = events[-1].time - first
+    frames = sum(1 for event in events if event.kind == capture.FRAME)
+    planned_seconds = capture_seconds / args.speed if args.speed else 0.0
+    return {
+        "config": {"captures": args.captures, "speed": args.speed, "host": args.host, "port": args.port},
+        "capture": {
+            "connections": len(connections),
+            "frames": frames,
+            "seconds": round(capture_seconds, 3),
+            "frames_per_second": round(frames / capture_seconds, 1) if capture_seconds else 0.0,
+        },
+        "replay": {
+            "failed_connections": stats.failed,
+            "frames": stats.frames,
+            "bytes": stats.bytes,
+            "seconds": round(send_seconds, 3),
+            "planned_seconds": round(planned_seconds, 3),
+            "frames_per_second": round(stats.frames / send_seconds, 1) if send_seconds else 0.0,
+            "delivered": stats.received,
+            "delivered_per_second": round(stats.received / (send_seconds + args.settle), 1),
+        },
+        "schedule_lag_ms": stats.lag.summary(),
+        "latency_ms": stats.latency.summary(),
+    }
+
+def print_report(result):
+    recorded, replayed = result["capture"], result["replay"]
+    print(f"capture: {recorded['connections']} connections, {recorded['frames']} frames in "
+          f"{recorded['seconds']}s ({recorded['frames_per_second']}/s)")
+    speed = result["config"]["speed"]
+    planned = f"planned {replayed['planned_seconds']}s at {speed}x" if speed else "at max speed"
+    print(f"replay:  {replayed['frames']} frames in {replayed['seconds']}s ({planned}), "
+          f"{replayed['frames_per_second']} frames/s, {replayed['delivered_per_second']} deliveries/s")
+    if replayed["failed_connections"]:
+        print(f"         {replayed['failed_connections']} connections failed")
+    print(f"{'':>14} {'count':>8} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'max ms':>8}")
+    for name, key in (("schedule lag", "schedule_lag_ms"), ("delivery", "latency_ms")):
+        summary = result[key]
+        if summary["count"]:
+            print(f"{name:>14} {summary['count']:>8} {summary['p50']:>8} {summary['p99']:>8} "
+                  f"{summary['p999']:>8} {summary['max']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("captures", nargs="+", metavar="CAPTURE", help="files written by server.py --capture")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="multiple of the captured pace; 0 sends as fast as possible (default: %(default)s)")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait for deliveries at the end")
+    parser.add_argument("--output", help="write JSON results to this file ('-' for stdout)")
+    parser.add_argument("--in-process", choices=("threads", "async"), metavar="MODE",
+                        help="run a server in this process on a free port (threads or async)")
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed cannot be negative")
+
+    try:
+        events = load_events(args.captures)
+    except (OSError, capture.CaptureError) as e:
+        raise SystemExit(f"Cannot read capture: {e}")
+    if not events:
+        raise SystemExit("The capture holds no traffic")
+
+    raise_file_limit()
+    if args.in_process:
+        import server
+        # The embedded server's connection log would drown the report
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            chat_server = server.ChatServer(host=args.host, port=0, mode=args.in_process).start()
+            args.port = chat_server.port
+            try:
+                result = asyncio.run(replay(args, events))
+            finally:
+                chat_server.stop()
+    else:
+        result = asyncio.run(replay(args, events))
+    print_report(result)
+    if args.output == "-":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+if __name__ == "__main__":
+    main()
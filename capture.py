@@ -0,0 +1,148 @@
+import collections
+import itertools
+import queue
+import struct
+import threading
+import time
+
+# A capture file starts with MAGIC and the wall-clock time capturing began,
+# then holds one record per event: microseconds since that time, connection
+# id, event kind and payload length, followed by the payload. Payloads are
+# frames exactly as the client sent them, without their length prefix, so
+# HELLOs, v2 headers and compressed batches replay byte for byte.
+MAGIC = b"CHATCAP1"
+FILE_HEADER = struct.Struct("!8sd")
+RECORD_HEADER = struct.Struct("!QIBI")
+
+OPEN = 0   # a connection was accepted; the payload is its "host:port"
+FRAME = 1  # a frame arrived on the connection
+CLOSE = 2  # the connection ended
+
+Record = collections.namedtuple("Record", "time connection kind payload")
+
+class CaptureError(ValueError):
+    """Raised for files that are not captures"""
+
+class CaptureStream:
+    """Records the frames of one connection; set as FrameDecoder.capture"""
+
+    __slots__ = ("capture", "connection_id", "closed")
+
+    def __init__(self, capture, connection_id):
+        self.capture = capture
+        self.connection_id = connection_id
+        self.closed = False
+
+    def __call__(self, payload):
+        # The payload is a view into the decoder's buffer, so it is copied here
+        self.capture.record(self.connection_id, FRAME, bytes(payload))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.capture.record(self.connection_id, CLOSE)
+            self.capture.end_stream()
+
+class CaptureFile:
+    """Writes every connection's inbound frames to a capture file.
+
+    Readers only copy the payload and enqueue it; a background thread
+    encodes and writes the records, so capturing adds no file I/O to the
+    read path of any connection.
+
+    close() is called at shutdown while connections are still winding down.
+    It stops the thread, and what they record after that is written straight
+    to the file, which stays open until the last of them has closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.start = time.monotonic()
+        self.file.write(FILE_HEADER.pack(MAGIC, time.time()))
+        self.records = queue.SimpleQueue()
+        self.connection_ids = itertools.count(1)
+        self.frames = 0
+        self.lock = threading.Lock()
+        self.streams_ended = threading.Condition(self.lock)
+        self.open_streams = 0
+        self.closed = False  # records are then written by the caller
+        self.thread = threading.Thread(target=self._write, name="capture", daemon=True)
+        self.thread.start()
+
+    def stream(self, address=None):
+        """Start recording a new connection and return its CaptureStream"""
+        stream = CaptureStream(self, next(self.connection_ids))
+        with self.lock:
+            self.open_streams += 1
+        peer = f"{address[0]}:{address[1]}" if address else ""
+        self.record(stream.connection_id, OPEN, peer.encode())
+        return stream
+
+    def record(self, connection_id, kind, payload=b""):
+        record = (time.monotonic(), connection_id, kind, payload)
+        with self.lock:
+            if not self.closed:
+                self.records.put(record)
+            elif not self.file.closed:
+                self._write_record(record)
+                self.file.flush()
+
+    def end_stream(self):
+        with self.lock:
+            self.open_streams -= 1
+            if self.closed and not self.open_streams:
+                self.file.close()
+                self.streams_ended.notify_all()
+
+    def close(self, timeout=0.0):
+        """Write out everything recorded so far, then wait up to timeout for
+        open connections to end. The file closes with the last of them."""
+        with self.lock:
+            # Held until the thread is done, so no late record overtakes a queued one
+            self.closed = True
+            self.records.put(None)
+            self.thread.join()
+            self.file.flush()
+            if not self.open_streams:
+                self.file.close()
+            self.streams_ended.wait_for(lambda: not self.open_streams, timeout)
+
+    def _write(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+            self._write_record(record)
+            if self.records.empty():
+                # Keep the file current while traffic is idle
+                self.file.flush()
+
+    def _write_record(self, record):
+        timestamp, connection_id, kind, payload = record
+        offset = max(0, int((timestamp - self.start) * 1e6))
+        self.file.write(RECORD_HEADER.pack(offset, connection_id, kind, len(payload)))
+        self.file.write(payload)
+        if kind == FRAME:
+            self.frames += 1
+
+def read_capture(path):
+    """Yield the Records of a capture file in order, with wall-clock times.
+
+    A record cut short at the end, as left by a server that was killed
+    while capturing, ends the capture.
+    """
+    with open(path, "rb") as capture:
+        header = capture.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise CaptureError(f"{path} is not a chat capture file")
+        _, start = FILE_HEADER.unpack(header)
+        while True:
+            header = capture.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            offset, connection_id, kind, length = RECORD_HEADER.unpack(header)
+            payload = capture.read(length)
+            if len(payload) < length:
+                return
+            yield Record(start + offset / 1e6, connection_id, kind, payload)
@@ -1,3 +1,5 @@
+import argparse
+import random
 import socket
 import threading
 import sys
@@ -5,53 +7,162 @@ import struct
 import time
 import signal
 
+import protocol
+import tls
+
 SERVER_IP = "127.0.0.1"
 SERVER_PORT = 8000
 
 # Global flag for graceful shutdown
 client_running = True
 client_socket = None
+protocol_version = 1  # raised to 2 if the server agrees, see negotiate_protocol()
+send_lock = threading.Lock()  # pongs are sent from the receiver thread
+
+# Resuming after a dropped connection, see reconnect()
+session_token = None  # issued by the server in its HELLO reply
+last_seq = 0          # highest session sequence number received
+RECONNECT_ATTEMPTS = 8
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+# TLS, see tls.py; the session is offered again on reconnect to skip the full handshake
+tls_context = None
+tls_session = None
+
+COMMAND_HINTS = "\n".join([
+    "💬 Chat Commands:",
+    "   • Type messages normally to chat with everyone",
+    "   • /whisper <user> <message> - Send private message",
+    "   • /who - List all users",
+    "   • /join <room>, /part, /rooms - Switch between rooms",
+    "   • /history [count] - Show recent messages in your room",
+    "   • /help - Show all commands",
+    "   • 'exit' or Ctrl+C - Leave chat",
+    "-" * 50,
+])
 
 def send_message(sock, message):
     """Send a message with length prefix to handle partial reception"""
     try:
-        message_bytes = message.encode("utf-8")
-        message_length = len(message_bytes)
-        # Send 4-byte length prefix followed by message
-        length_prefix = struct.pack('!I', message_length)
-        sock.sendall(length_prefix + message_bytes)
+        if not isinstance(message, protocol.Message):
+            message = protocol.Message(protocol.CHAT, message)
+        if protocol_version > 1:
+            data = bytes(message.frame(protocol_version))
+        else:
+            message_bytes = message.body
+            message_length = len(message_bytes)
+            # Send 4-byte length prefix followed by message
+            length_prefix = struct.pack('!I', message_length)
+            data = length_prefix + message_bytes
+        with send_lock:
+            sock.sendall(data)
         return True
     except (socket.error, ConnectionResetError, BrokenPipeError):
         return False
 
-def receive_message(sock):
-    """Receive a message with length prefix to handle partial reception"""
+def negotiate_protocol(sock, reader):
+    """Ask the server for protocol v2 with batching, compression, heartbeats and a session.
+
+    Keeps v1 if the server declines. Returns True if the server resumed the
+    session from an earlier connection.
+    """
+    global protocol_version, session_token, last_seq
+    hello = protocol.hello_frame(
+        proto=protocol.PROTOCOL_VERSION, batch=protocol.MAX_BATCH_SIZE, compress=protocol.COMPRESSION,
+        heartbeat=1, resume=session_token or 1, last=last_seq)
+    sock.sendall(bytes(hello))
+    reply = reader.receive()
+    options = protocol.parse_hello(reply or "")
+    if options is None:
+        if reply:
+            # Not a HELLO: an older server, or a notice such as "server full"
+            print(reply)
+        return False
+    protocol_version = reader.decoder.version = int(options.get("proto", 1))
+    batch_limit = int(options.get("batch", 0))
+    reader.decoder.max_frame_size = max(reader.decoder.max_frame_size, batch_limit)
+    if options.get("compress") == protocol.COMPRESSION:
+        # Compressed frames are inflated inside the reader
+        reader.decoder.decompressor = protocol.new_decompressor()
+    token = options.get("session")
+    resumed = token is not None and token == session_token
+    if not resumed:
+        session_token, last_seq = token, 0
+    return resumed
+
+def connect():
+    """Open a connection to the server and negotiate. Returns (socket, reader)."""
+    global tls_session
+    sock = socket.create_connection((SERVER_IP, SERVER_PORT), timeout=10.0)
     try:
-        # First receive the 4-byte length prefix
-        length_data = b''
-        while len(length_data) < 4:
-            chunk = sock.recv(4 - len(length_data))
-            if not chunk:
-                return None
-            length_data += chunk
-        
-        message_length = struct.unpack('!I', length_data)[0]
-        
-        # Validate message length to prevent memory issues
-        if message_length > 10000:  # 10KB limit
+        if tls_context is not None:
+            sock = tls_context.wrap_socket(sock, server_hostname=SERVER_IP, session=tls_session)
+        reader = protocol.MessageReader(sock)
+        negotiate_protocol(sock, reader)
+        if tls_context is not None:
+            # TLS 1.3 tickets arrive after the handshake; the HELLO reply came after them
+            tls_session = sock.session
+        sock.settimeout(None)
+    except BaseException:
+        sock.close()
+        raise
+    return sock, reader
+
+def reconnect(username):
+    """Reconnect with exponential backoff, resuming the session if the server still has it.
+
+    Returns the new MessageReader, or None after RECONNECT_ATTEMPTS failures.
+    """
+    global client_socket
+    delay = RECONNECT_MIN_DELAY
+    for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+        # Jitter keeps clients dropped together from reconnecting in lockstep
+        time.sleep(delay * random.uniform(0.5, 1.0))
+        if not client_running:
             return None
-            
-        # Now receive the actual message
-        message_data = b''
-        while len(message_data) < message_length:
-            chunk = sock.recv(message_length - len(message_data))
-            if not chunk:
-                return None
-            message_data += chunk
-            
-        return message_data.decode("utf-8")
-    except (socket.error, ConnectionResetError, UnicodeDecodeError, struct.error):
-        return None
+        print(f"Reconnecting (attempt {attempt}/{RECONNECT_ATTEMPTS})...")
+        try:
+            sock, reader = connect()
+        except (OSError, protocol.ProtocolError):
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            continue
+        if send_message(sock, username):
+            client_socket = sock
+            return reader
+        sock.close()
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    return None
+
+def message_kind(message):
+    """Type of a received message; v1 servers only send text, so guess from it"""
+    if message.kind != protocol.UNTYPED:
+        return message.kind
+    text = message.text
+    if text.startswith("ERROR:"):
+        return protocol.ERROR
+    elif text.startswith("SERVER:"):
+        return protocol.SYSTEM
+    elif text.startswith("[PRIVATE"):
+        return protocol.PRIVATE
+    elif text.startswith("Connected users"):
+        return protocol.USER_LIST
+    elif text.startswith("Available commands:"):
+        return protocol.HELP
+    return protocol.CHAT
+
+def format_message(message):
+    """Text to display for a received message, decorated by its type"""
+    text = message.text
+    kind = message_kind(message)
+    if kind == protocol.PRIVATE:
+        # Highlight private messages
+        return f"🔒 {text}"
+    elif kind == protocol.USER_LIST:
+        return f"👥 {text}"
+    elif kind == protocol.HELP:
+        return f"📋 Help:\n{text}"
+    return text
 
 def signal_handler(signum, frame):
     """Handle Ctrl+C gracefully"""
@@ -66,47 +177,45 @@ def signal_handler(signum, frame):
             pass
     sys.exit(0)
 
-def receive_handler(sock):
-    """Handle incoming messages from server"""
-    global client_running
+def receive_handler(reader, username):
+    """Handle incoming messages from server, reconnecting if the connection drops"""
+    global client_running, last_seq
     
     while client_running:
         try:
-            response = receive_message(sock)
+            message = reader.receive_message()
             
-            if not response:
+            if not message:
                 if client_running:
-                    print("\nServer has closed the connection.")
+                    print("\nConnection to the server was lost.")
+                    reader = reconnect(username)
+                    if reader:
+                        continue
+                    print("Could not reconnect to the server.")
                 break
+            if message.seq > last_seq:
+                last_seq = message.seq
+            if message.kind == protocol.PING:
+                # The server checks that we are still here
+                send_message(reader.sock, protocol.Message(protocol.PONG, message.body))
+                continue
+            elif message.kind == protocol.PONG:
+                continue
+            response = message.text
+            kind = message_kind(message)
             
             # Check for server messages
-            if response.startswith("ERROR:"):
+            if kind == protocol.ERROR:
                 print(f"\n{response}")
                 continue
-            elif response.startswith("SERVER:"):
+            elif kind == protocol.SYSTEM:
                 print(f"\n{response}")
                 if "shutting down" in response.lower():
                     client_running = False
                     break
                 continue
-            elif response.startswith("[PRIVATE"):
-                # Highlight private messages
-                print(f"\n🔒 {response}")
-                if client_running:
-                    sys.stdout.write("You: ")
-                    sys.stdout.flush()
-                continue
-            elif response.startswith("Connected users"):
-                # Format user list nicely
-                print(f"\n👥 {response}")
-                if client_running:
-                    sys.stdout.write("You: ")
-                    sys.stdout.flush()
-                continue
-            elif response.startswith("Available commands:"):
-                # Format help text nicely
-                print(f"\n📋 Help:")
-                print(response)
+            elif kind in (protocol.PRIVATE, protocol.USER_LIST, protocol.HELP):
+                print(f"\n{format_message(message)}")
                 if client_running:
                     sys.stdout.write("You: ")
                     sys.stdout.flush()
@@ -126,7 +235,7 @@ def receive_handler(sock):
     
     client_running = False
 
-def input_handler(sock):
+def input_handler():
     """Handle user input in a separate thread"""
     global client_running
     
@@ -153,15 +262,17 @@ def input_handler(sock):
                 print("Message too long. Maximum 1000 characters allowed.")
                 continue
                 
-            if not send_message(sock, msg):
-                print("Failed to send message. Connection may be lost.")
-                client_running = False
-                break
-
             if msg.lower() == "exit":
-                print("Exit command sent. Closing client.")
+                # Stop first so the receiver does not try to reconnect
                 client_running = False
+                send_message(client_socket, msg)
+                print("Exit command sent. Closing client.")
                 break
+
+            if not send_message(client_socket, msg):
+                # The receiver notices the drop and reconnects
+                print("Failed to send message. Connection may be lost.")
+                continue
                 
         except EOFError:
             # Handle Ctrl+D
@@ -199,13 +310,9 @@ def run_client():
     # Set up signal handler for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
     
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    
     try:
         print(f"Connecting to server at {SERVER_IP}:{SERVER_PORT}...")
-        client_socket.settimeout(10.0)  # 10 second connection timeout
-        client_socket.connect((SERVER_IP, SERVER_PORT))
-        client_socket.settimeout(None)  # Remove timeout after connection
+        client_socket, reader = connect()
         print(f"Connected to server at {SERVER_IP}:{SERVER_PORT}")
 
         # Get and validate username
@@ -228,20 +335,14 @@ def run_client():
             return
 
         print(f"Joined chat as: {username}")
-        print("💬 Chat Commands:")
-        print("   • Type messages normally to chat with everyone")
-        print("   • /whisper <user> <message> - Send private message")
-        print("   • /who - List all users")
-        print("   • /help - Show all commands")
-        print("   • 'exit' or Ctrl+C - Leave chat")
-        print("-" * 50)
+        print(COMMAND_HINTS)
 
         # Start receiver thread
-        receiver_thread = threading.Thread(target=receive_handler, args=(client_socket,), daemon=True)
+        receiver_thread = threading.Thread(target=receive_handler, args=(reader, username), daemon=True)
         receiver_thread.start()
 
         # Start input handler in main thread
-        input_handler(client_socket)
+        input_handler()
 
         # Wait a moment for any final messages
         if receiver_thread.is_alive():
@@ -270,5 +371,27 @@ def run_client():
                 pass
         print("Connection closed.")
 
+def main():
+    global tls_context
+    parser = argparse.ArgumentParser(description="Multi-client chat client")
+    parser.add_argument(
+        "--mode", choices=("threads", "async"), default="threads",
+        help="threads: blocking input() and a receiver thread; async: one event loop "
+             "with a line editor and batched screen updates (default: %(default)s)",
+    )
+    parser.add_argument("--tls", action="store_true", help="connect with TLS")
+    parser.add_argument(
+        "--tls-ca", metavar="FILE",
+        help="trust this CA or self-signed certificate instead of the system store (implies --tls)",
+    )
+    args = parser.parse_args()
+    if args.tls or args.tls_ca:
+        tls_context = tls.client_context(args.tls_ca)
+    if args.mode == "async":
+        import async_client
+        async_client.run_async_client(tls_context=tls_context)
+    else:
+        run_client()
+
 if __name__ == "__main__":
-    run_client()
+    main()
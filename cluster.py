@@ -0,0 +1,284 @@
+import json
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import threading
+
+import outbound
+import protocol
+import server
+
+# Bus links carry every cross-worker message, so give them far more room
+# than a client queue before anything is dropped. Only relayed chat can be
+# dropped; directory events take the queue's priority lane, see _publish()
+BUS_QUEUE_BYTES = 64 * 1024 * 1024
+BUS_MAX_FRAME_SIZE = 1024 * 1024
+
+# Bus message kinds; relayed chat payloads are encoded protocol v2 messages
+BROADCAST = "broadcast"  # deliver payload to local members of a room
+WHISPER = "whisper"      # deliver payload to one local user
+JOIN = "join"            # a user connected to the sending worker
+LEAVE = "leave"          # a user disconnected from the sending worker
+MOVE = "move"            # a user on the sending worker changed rooms
+
+def encode_bus_message(header, payload=b""):
+    """Frame a bus message: a JSON header line followed by a raw payload"""
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return protocol.Frame(header_bytes + b"\n" + payload)
+
+def decode_bus_message(data):
+    """Split a bus message into its header dict and raw payload"""
+    newline = data.index(b"\n")
+    return json.loads(data[:newline]), data[newline + 1:]
+
+class ClusterBus:
+    """Connects one worker process to every other worker of the cluster.
+
+    Workers are wired as a full mesh of Unix socket pairs, so a message goes
+    straight to the worker that needs it without a relay hop. Each link has
+    its own outbound queue and writer thread, exactly like a client
+    connection, and a single reader thread multiplexes all incoming links.
+
+    Besides relaying room broadcasts and whispers, the bus keeps a
+    directory of users connected to other workers, so /who, /rooms,
+    /whisper and duplicate-name checks see the whole cluster. The directory
+    is updated asynchronously and two simultaneous joins with the same name
+    on different workers can both succeed.
+    """
+
+    def __init__(self, worker_id, peer_sockets, chat_server):
+        self.worker_id = worker_id
+        self.chat_server = chat_server
+        self.peer_sockets = peer_sockets
+        self.links = {}
+        for peer_id, peer_socket in peer_sockets.items():
+            queue = outbound.OutboundQueue(max_bytes=BUS_QUEUE_BYTES)
+            self.links[peer_id] = outbound.SocketConnection(peer_socket, queue)
+
+        self.lock = threading.Lock()
+        self.remote_users = {}  # casefolded username -> (worker id, username, room)
+        self.version = 0        # bumped whenever remote_users changes
+        self._usernames_cache = None  # (local usernames, version, merged usernames)
+        self.reader_thread = threading.Thread(target=self._run_reader, daemon=True)
+
+    def start(self):
+        for link in self.links.values():
+            link.start()
+        self.reader_thread.start()
+
+    # Outgoing events from this worker
+
+    def broadcast(self, message, room, record=False):
+        header = {"kind": BROADCAST, "room": room}
+        if record:
+            header["record"] = True
+        self._publish(encode_bus_message(header, message.encode()))
+
+    def whisper(self, target_username, message):
+        """Send a private message to a user on another worker.
+
+        Returns False if no other worker has that user.
+        """
+        entry = self.remote_users.get(target_username.casefold())
+        if entry is None:
+            return False
+        worker_id, username, _ = entry
+        link = self.links.get(worker_id)
+        if link is None:
+            return False
+        bus_message = encode_bus_message({"kind": WHISPER, "to": username}, message.encode())
+        try:
+            link.send_frame(bus_message)
+        except ConnectionResetError:
+            return False
+        return True
+
+    def user_joined(self, username, room):
+        self._publish(encode_bus_message({"kind": JOIN, "user": username, "room": room}), priority=True)
+
+    def user_left(self, username):
+        self._publish(encode_bus_message({"kind": LEAVE, "user": username}), priority=True)
+
+    def user_moved(self, username, room):
+        self._publish(encode_bus_message({"kind": MOVE, "user": username, "room": room}), priority=True)
+
+    # Cluster-wide views
+
+    def is_taken(self, key):
+        """Whether a casefolded username is held by a user on another worker"""
+        return key in self.remote_users
+
+    def merged_usernames(self, local_usernames):
+        """Sorted usernames across the cluster, cached until anything changes"""
+        cached = self._usernames_cache
+        if cached is not None and cached[0] is local_usernames and cached[1] == self.version:
+            return cached[2]
+        version = self.version
+        with self.lock:
+            remote = [username for _, username, _ in self.remote_users.values()]
+        merged = tuple(sorted(local_usernames + tuple(remote)))
+        self._usernames_cache = (local_usernames, version, merged)
+        return merged
+
+    def merged_room_counts(self, local_rooms):
+        """Combine local (room, count) pairs with rooms of remote users"""
+        counts = dict(local_rooms)
+        with self.lock:
+            for _, _, room in self.remote_users.values():
+                counts[room] = counts.get(room, 0) + 1
+        return sorted(counts.items())
+
+    # Incoming events from other workers
+
+    def _publish(self, message, priority=False):
+        """Send a bus message to every other worker.
+
+        Directory events go with priority: dropping one would leave the
+        other workers' directories wrong for as long as the user stays.
+        They may overtake relayed chat, which nothing on the far side minds.
+        """
+        for link in self.links.values():
+            try:
+                link.send_frame(message, priority)
+            except ConnectionResetError:
+                pass  # peer is gone; its reader will purge it
+
+    def _run_reader(self):
+        selector = selectors.DefaultSelector()
+        for peer_id, peer_socket in self.peer_sockets.items():
+            decoder = protocol.FrameDecoder(max_frame_size=BUS_MAX_FRAME_SIZE)
+            selector.register(peer_socket, selectors.EVENT_READ, (peer_id, decoder))
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                peer_id, decoder = key.data
+                try:
+                    received = decoder.recv_into(key.fileobj)
+                    while True:
+                        frame = decoder.next_frame()
+                        if frame is None:
+                            break
+                        with frame:
+                            header, payload = decode_bus_message(bytes(frame))
+                        self._dispatch(peer_id, header, payload)
+                except (OSError, protocol.ProtocolError, ValueError) as e:
+                    print(f"Bus link to worker {peer_id} failed: {e}")
+                    received = 0
+                if not received:
+                    selector.unregister(key.fileobj)
+                    self._purge_worker(peer_id)
+
+    def _dispatch(self, peer_id, header, payload):
+        kind = header["kind"]
+        if kind == BROADCAST:
+            message = protocol.decode_message(payload)
+            if header.get("record"):
+                # Every worker keeps the whole cluster's history and search index for its own clients
+                self.chat_server.record_message(header["room"], message)
+            self.chat_server.deliver_local(message, room=header["room"])
+        elif kind == WHISPER:
+            target_socket = self.chat_server.clients.find(header["to"])
+            if target_socket:
+                server.send_message(target_socket, protocol.decode_message(payload))
+        elif kind in (JOIN, MOVE):
+            username = header["user"]
+            with self.lock:
+                self.remote_users[username.casefold()] = (peer_id, username, header["room"])
+                self.version += 1
+        elif kind == LEAVE:
+            with self.lock:
+                self.remote_users.pop(header["user"].casefold(), None)
+                self.version += 1
+
+    def _purge_worker(self, peer_id):
+        """Forget every user of a worker whose link went away"""
+        with self.lock:
+            for key, (worker_id, _, _) in list(self.remote_users.items()):
+                if worker_id == peer_id:
+                    del self.remote_users[key]
+            self.version += 1
+
+def run_worker(worker_id, socket_pairs, chat_server):
+    """Entry point of one forked worker process"""
+    # The parent relays Ctrl+C as SIGTERM so every worker shuts down exactly once.
+    # Threads mode treats it as Ctrl+C; an async worker's event loop installs
+    # its own handler that cancels serving, so goodbyes still go out.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # Keep only this worker's end of each link so a dead peer reads as EOF
+    peer_sockets = {}
+    for (low, high), (low_end, high_end) in socket_pairs.items():
+        if low == worker_id:
+            peer_sockets[high] = low_end
+            high_end.close()
+        elif high == worker_id:
+            peer_sockets[low] = high_end
+            low_end.close()
+        else:
+            low_end.close()
+            high_end.close()
+
+    # Give each worker its own range of user ids so v2 sender ids stay unique
+    chat_server.clients.set_first_user_id((worker_id << 24) + 1)
+    chat_server.bus = ClusterBus(worker_id, peer_sockets, chat_server)
+    chat_server.bus.start()
+    chat_server.reuse_port = True
+    if chat_server.metrics_port:
+        # Each worker exposes its own metrics on consecutive ports
+        chat_server.metrics_port += worker_id
+    if chat_server.history_dir:
+        chat_server.history_dir = os.path.join(chat_server.history_dir, f"worker-{worker_id}")
+    if chat_server.capture_path:
+        chat_server.capture_path = f"{chat_server.capture_path}.worker-{worker_id}"
+    print(f"Worker {worker_id} starting ({chat_server.mode} mode)")
+    chat_server.run()
+
+def run_cluster(workers, chat_server):
+    """Fork workers that each run a copy of chat_server on its address through SO_REUSEPORT"""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT is not available on this platform; cannot run multiple workers.")
+        return
+    if not chat_server.port:
+        print("Workers must share a fixed port; give --port when using --workers.")
+        return
+
+    # One socket pair per pair of workers forms the bus mesh
+    socket_pairs = {}
+    for low in range(workers):
+        for high in range(low + 1, workers):
+            socket_pairs[(low, high)] = socket.socketpair()
+
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for worker_id in range(workers):
+        process = context.Process(
+            target=run_worker,
+            args=(worker_id, socket_pairs, chat_server),
+            name=f"chat-worker-{worker_id}",
+        )
+        process.start()
+        processes.append(process)
+
+    for low_end, high_end in socket_pairs.values():
+        low_end.close()
+        high_end.close()
+
+    print(f"Started {workers} workers on {chat_server.host}:{chat_server.port}. Press Ctrl+C to stop.")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("\nReceived shutdown signal. Stopping workers...")
+    finally:
+        # SIGTERM makes each worker shut down gracefully and say goodbye
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(server.CLOSE_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+        print("All workers stopped.")
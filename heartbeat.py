@@ -0,0 +1,167 @@
+import socket
+import threading
+import time
+
+TICK_SECONDS = 0.5
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 3  # 64 ticks of 0.5s per level: ~32s, ~34min and ~36h
+
+# TCP keepalive for peers that cannot answer pings (protocol v1 clients)
+KEEPALIVE_IDLE = 60      # seconds of silence before the first probe
+KEEPALIVE_INTERVAL = 15  # seconds between probes
+KEEPALIVE_COUNT = 4      # unanswered probes before the kernel drops the connection
+
+class TimerWheel:
+    """Hierarchical timing wheel holding one deadline per item.
+
+    Level 0 has one slot per tick; each slot of level n covers a whole turn
+    of level n-1. A deadline is filed in the lowest level that reaches it,
+    and whenever a level completes a turn the next slot of the level above
+    is cascaded down. Scheduling and cancelling are O(1), and advancing by
+    one tick only touches the items that are due or being cascaded, however
+    many deadlines are pending. Deadlines are rounded up to whole ticks.
+    """
+
+    def __init__(self, tick=TICK_SECONDS, slots=WHEEL_SLOTS, levels=WHEEL_LEVELS):
+        self.tick = tick
+        self.slots = slots
+        self.levels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.origin = time.monotonic()
+        self.ticks = 0      # ticks processed so far
+        self._deadlines = {}  # item -> (deadline tick, slot holding it)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, item, delay):
+        """Fire item after delay seconds, replacing any deadline it had"""
+        self.cancel(item)
+        due = time.monotonic() + delay - self.origin
+        self._file(item, max(-int(-due // self.tick), self.ticks + 1))
+
+    def cancel(self, item):
+        entry = self._deadlines.pop(item, None)
+        if entry is not None:
+            entry[1].discard(item)
+
+    def advance(self, now=None):
+        """Move the wheel up to now, returning the items that became due"""
+        if now is None:
+            now = time.monotonic()
+        target = int((now - self.origin) // self.tick)
+        due = []
+        while self.ticks < target:
+            self.ticks += 1
+            # Cascade from the top so items can fall through several levels
+            span = self.slots ** (len(self.levels) - 1)
+            for level in range(len(self.levels) - 1, 0, -1):
+                if self.ticks % span == 0:
+                    slot = self.levels[level][(self.ticks // span) % self.slots]
+                    items = list(slot)
+                    slot.clear()
+                    for item in items:
+                        self._file(item, self._deadlines.pop(item)[0])
+                span //= self.slots
+            slot = self.levels[0][self.ticks % self.slots]
+            for item in slot:
+                del self._deadlines[item]
+            due.extend(slot)
+            slot.clear()
+        return due
+
+    def _file(self, item, deadline):
+        span = 1
+        level = 0
+        # The top level also takes deadlines beyond its reach; they are
+        # cascaded early and filed again
+        while level < len(self.levels) - 1 and deadline - self.ticks >= span * self.slots:
+            span *= self.slots
+            level += 1
+        slot = self.levels[level][(deadline // span) % self.slots]
+        slot.add(item)
+        self._deadlines[item] = (deadline, slot)
+
+class Heartbeat:
+    """Pings quiet connections and evicts the ones that stay silent.
+
+    Each tracked connection has one check in a TimerWheel, not a timer of
+    its own. The read loops only stamp connection.last_seen, so traffic
+    costs nothing here; a check that finds the connection was heard from
+    recently just files a new one. After interval seconds of silence the
+    connection is sent a ping, and after timeout seconds it is evicted.
+
+    ping(connection) and evict(connection) are the server's callbacks. The
+    threads server runs poll() on a background thread with start(); the
+    asyncio server calls it from a task on its loop instead.
+    """
+
+    def __init__(self, interval, timeout, ping, evict, tick=TICK_SECONDS):
+        self.interval = interval
+        self.timeout = max(timeout, interval)
+        self.ping = ping
+        self.evict = evict
+        self.wheel = TimerWheel(tick)
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.running = False
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, connection):
+        connection.last_seen = time.monotonic()
+        with self.lock:
+            self.connections.add(connection)
+            self.wheel.schedule(connection, self.interval)
+
+    def remove(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+            self.wheel.cancel(connection)
+
+    def poll(self):
+        """Ping or evict every connection whose check is due"""
+        now = time.monotonic()
+        with self.lock:
+            due = self.wheel.advance(now)
+        for connection in due:
+            quiet = now - connection.last_seen
+            if quiet >= self.timeout:
+                with self.lock:
+                    self.connections.discard(connection)
+                self.evict(connection)
+                continue
+            if quiet >= self.interval:
+                self.ping(connection)
+                delay = self.timeout - quiet
+            else:
+                delay = self.interval - quiet
+            with self.lock:
+                # Skip connections that closed while their check ran
+                if connection in self.connections:
+                    self.wheel.schedule(connection, delay)
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._run, name="heartbeat", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.wheel.tick)
+            self.poll()
+
+def enable_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """Turn on TCP keepalive, tuning its timers where the platform allows"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except OSError:
+        pass
@@ -0,0 +1,217 @@
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+import protocol
+import registry
+
+# Each record is a header, the room name and the framed chat payload
+RECORD_HEADER = struct.Struct("!IdB")  # payload length, unix time, room name length
+
+SEGMENT_BYTES = 4 * 1024 * 1024
+MAX_SEGMENTS = 16      # oldest segments are deleted beyond this
+RING_SIZE = 50         # recent messages kept in memory per room
+HISTORY_LIMIT = 500    # most messages /history can return per room
+MAX_ROOMS = 1024       # rooms with a history; the least recently active are forgotten
+
+class MessageHistory:
+    """Recent chat messages per room, optionally persisted to disk.
+
+    The newest messages of every room live in an in-memory ring of shared
+    protocol.Message objects, so a join backfill just queues messages that
+    are already encoded and never touches the disk. Replayed messages carry
+    FLAG_HISTORY so v2 clients can tell them from live traffic.
+
+    With a directory, every message is also appended to a segment log:
+    numbered files that are only ever appended to and are deleted whole,
+    oldest first, once there are more than max_segments. Each room keeps
+    the positions of its last HISTORY_LIMIT records, so requests that reach
+    past the ring are served by copying straight out of memory-mapped
+    segments, without seeking or scanning. The log is read back on startup,
+    so history survives restarts.
+    """
+
+    def __init__(self, directory=None, segment_bytes=SEGMENT_BYTES,
+                 max_segments=MAX_SEGMENTS, ring_size=RING_SIZE):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.ring_size = ring_size
+        self.lock = threading.Lock()
+        self._rings = collections.OrderedDict()  # room -> deque of Messages, least recently active first
+        self._index = {}      # room -> deque of (segment id, payload offset, payload length)
+        self._segments = []   # segment ids on disk, oldest first
+        self._maps = {}       # segment id -> mmap of a sealed segment
+        self._active = None   # file object of the segment being appended to
+        self._active_size = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    def append(self, room, message):
+        """Record a chat message that was broadcast to room"""
+        with self.lock:
+            ring = self._rings.get(room)
+            if ring is None:
+                ring = self._rings[room] = collections.deque(maxlen=self.ring_size)
+                if len(self._rings) > MAX_ROOMS:
+                    forgotten, _ = self._rings.popitem(last=False)
+                    self._index.pop(forgotten, None)
+            else:
+                self._rings.move_to_end(room)
+            ring.append(message.with_flags(protocol.FLAG_HISTORY))
+            if self.directory:
+                self._write(room, message.body)
+
+    def recent(self, room, count):
+        """Up to count of the newest messages in room, oldest first"""
+        with self.lock:
+            ring = self._rings.get(room)
+            if not ring or count <= 0:
+                return []
+            if count <= len(ring) or room not in self._index:
+                return list(ring)[-count:]
+            return self._read(room, min(count, HISTORY_LIMIT))
+
+    def close(self):
+        with self.lock:
+            if self._active:
+                self._active.close()
+                self._active = None
+            for segment_map in self._maps.values():
+                segment_map.close()
+            self._maps.clear()
+
+    # Segment log
+
+    def _path(self, segment_id):
+        return os.path.join(self.directory, f"{segment_id:08d}.log")
+
+    def _write(self, room, payload):
+        if self._active is None or self._active_size >= self.segment_bytes:
+            self._roll()
+        segment_id = self._segments[-1]
+        room_bytes = room.encode("utf-8")
+        offset = self._active_size + RECORD_HEADER.size + len(room_bytes)
+        record = RECORD_HEADER.pack(len(payload), time.time(), len(room_bytes)) + room_bytes + payload
+        # Unbuffered, so a record is one write() and is visible to readers at once
+        self._active.write(record)
+        self._active_size += len(record)
+        self._remember(room, segment_id, offset, len(payload))
+
+    def _remember(self, room, segment_id, offset, length):
+        positions = self._index.get(room)
+        if positions is None:
+            positions = self._index[room] = collections.deque(maxlen=HISTORY_LIMIT)
+        positions.append((segment_id, offset, length))
+
+    def _roll(self):
+        """Seal the active segment and start a new one"""
+        if self._active:
+            self._active.close()
+            self._map(self._segments[-1])
+        segment_id = self._segments[-1] + 1 if self._segments else 0
+        self._active = open(self._path(segment_id), "ab", buffering=0)
+        self._active_size = 0
+        self._segments.append(segment_id)
+        while len(self._segments) > self.max_segments:
+            self._drop(self._segments.pop(0))
+
+    def _drop(self, segment_id):
+        segment_map = self._maps.pop(segment_id, None)
+        if segment_map is not None:
+            segment_map.close()
+        try:
+            os.remove(self._path(segment_id))
+        except OSError:
+            pass
+        # Positions in the deleted segment are always the oldest ones
+        for positions in self._index.values():
+            while positions and positions[0][0] == segment_id:
+                positions.popleft()
+
+    def _map(self, segment_id):
+        """Memory-map a segment, or return None if it is empty or gone"""
+        segment_map = self._maps.get(segment_id)
+        if segment_map is not None:
+            return segment_map
+        try:
+            with open(self._path(segment_id), "rb") as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if segment_id != self._segments[-1] or self._active is None:
+            # Sealed segments never change, so their mapping can be kept
+            self._maps[segment_id] = segment_map
+        return segment_map
+
+    def _read(self, room, count):
+        messages = []
+        room_id = registry.room_id(room)
+        active_map = None
+        active_id = self._segments[-1] if self._active else None
+        for segment_id, offset, length in list(self._index[room])[-count:]:
+            if segment_id == active_id:
+                # The active segment keeps growing; map it once per request
+                if active_map is None:
+                    active_map = self._map(segment_id)
+                segment_map = active_map
+            else:
+                segment_map = self._map(segment_id)
+            if segment_map is not None:
+                body = segment_map[offset:offset + length]
+                messages.append(protocol.Message(
+                    protocol.CHAT, body, room_id=room_id, flags=protocol.FLAG_HISTORY))
+        if active_map is not None:
+            active_map.close()
+        return messages
+
+    def _load(self):
+        """Rebuild the rings and indexes from the segments on disk"""
+        for name in sorted(os.listdir(self.directory)):
+            stem, extension = os.path.splitext(name)
+            if extension == ".log" and stem.isdigit():
+                self._segments.append(int(stem))
+        while len(self._segments) > self.max_segments:
+            self._drop(self._segments.pop(0))
+
+        for segment_id in self._segments:
+            segment_map = self._map(segment_id)
+            if segment_map is None:
+                continue
+            end = self._scan(segment_id, segment_map)
+            if end < len(segment_map):
+                # A crash mid-append left a torn record; cut it off
+                self._maps.pop(segment_id).close()
+                os.truncate(self._path(segment_id), end)
+                print(f"History: truncated damaged segment {self._path(segment_id)} at byte {end}")
+
+        if self._segments:
+            # Keep appending to the newest segment
+            segment_id = self._segments[-1]
+            segment_map = self._maps.pop(segment_id, None)
+            if segment_map is not None:
+                segment_map.close()
+            self._active = open(self._path(segment_id), "ab", buffering=0)
+            self._active_size = os.path.getsize(self._path(segment_id))
+
+        for room in self._index:
+            ring = collections.deque(self._read(room, self.ring_size), maxlen=self.ring_size)
+            self._rings[room] = ring
+
+    def _scan(self, segment_id, segment_map):
+        """Index every whole record in a segment, returning where they end"""
+        position = 0
+        while position + RECORD_HEADER.size <= len(segment_map):
+            length, _, room_length = RECORD_HEADER.unpack_from(segment_map, position)
+            start = position + RECORD_HEADER.size
+            offset = start + room_length
+            if offset + length > len(segment_map):
+                break
+            room = segment_map[start:offset].decode("utf-8", "replace")
+            self._remember(room, segment_id, offset, length)
+            position = offset + length
+        return position
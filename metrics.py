@@ -0,0 +1,203 @@
+import http.server
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+class Counter:
+    """Monotonically increasing value"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, "", self.value)]
+
+class Gauge:
+    """Value computed on demand when metrics are collected"""
+
+    def __init__(self, name, help_text, function, kind="gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.kind = kind
+
+    @property
+    def value(self):
+        return self.function()
+
+    def samples(self):
+        return [(self.name, "", self.value)]
+
+class Histogram:
+    """Distribution of observed values over fixed cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager that observes the elapsed time of its block"""
+        return _Timer(self)
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            label = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append((f"{self.name}_bucket", f'{{le="{label}"}}', cumulative))
+        samples.append((f"{self.name}_sum", "", self.sum))
+        samples.append((f"{self.name}_count", "", self.count))
+        return samples
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class TimedLock:
+    """threading.Lock that records how long callers waited to acquire it"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self.histogram.time():
+            self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+all_metrics = {}  # name -> metric, in registration order
+
+def register(metric):
+    """Add a metric to the exported set, replacing any earlier one of the same name"""
+    all_metrics[metric.name] = metric
+    return metric
+
+def render_prometheus():
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in all_metrics.values():
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+def summary():
+    """Short human-readable summary used by the /stats command"""
+    lines = []
+    for metric in all_metrics.values():
+        if metric.kind == "histogram":
+            mean = metric.sum / metric.count if metric.count else 0.0
+            lines.append(f"{metric.name}: count={metric.count} mean={mean * 1000:.3f}ms")
+        else:
+            lines.append(f"{metric.name}: {metric.value}")
+    return "\n".join(lines)
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep scrapes out of the server output
+
+def start_http_server(host, port):
+    """Serve /metrics from a background thread. Returns the HTTP server."""
+    httpd = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return httpd
+
+class RateLimitFilter(logging.Filter):
+    """Drop records beyond a fixed number per second, counting what was dropped"""
+
+    def __init__(self, per_second, suppressed=None):
+        super().__init__()
+        self.per_second = per_second
+        self.suppressed = suppressed  # optional Counter of dropped records
+        self.window = int(time.monotonic())
+        self.emitted = 0
+
+    def filter(self, record):
+        window = int(time.monotonic())
+        if window != self.window:
+            self.window = window
+            self.emitted = 0
+        if self.emitted >= self.per_second:
+            if self.suppressed:
+                self.suppressed.inc()
+            return False
+        self.emitted += 1
+        return True
+
+message_log = logging.getLogger("chat.messages")
+message_log.propagate = False
+message_log.disabled = True
+
+def enable_message_log(per_second=100, suppressed=None):
+    """Log chat traffic through a queue so the caller never waits on stdout.
+
+    Records are rate-limited before they are queued, and a listener thread
+    does the actual writing.
+    """
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(RateLimitFilter(per_second, suppressed))
+    message_log.addHandler(handler)
+    message_log.setLevel(logging.INFO)
+    message_log.disabled = False
+
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    return listener
@@ -0,0 +1,311 @@
+import collections
+import select
+import socket
+import ssl
+import threading
+import time
+
+import protocol
+
+# What to do when a client stops reading and its queue reaches the limit
+DROP_OLDEST = "drop-oldest"  # discard the oldest queued frames to make room
+DISCONNECT = "disconnect"    # drop the client altogether
+COALESCE = "coalesce"        # replace the backlog with a single "skipped" notice
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DISCONNECT, COALESCE)
+
+DEFAULT_MAX_QUEUE_BYTES = 256 * 1024
+
+# Linux holds partial segments back while a socket is corked; elsewhere corking is a no-op
+CORK_OPTION = getattr(socket, "TCP_CORK", None)
+
+def set_nodelay(sock, enabled=True):
+    """Turn Nagle's algorithm off (enabled) or back on for a TCP socket"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+    except OSError:
+        pass
+
+def set_cork(sock, corked):
+    """Cork or uncork a TCP socket; uncorking sends whatever was held back"""
+    if CORK_OPTION is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, CORK_OPTION, int(corked))
+    except OSError:
+        pass
+
+class OutboundQueue:
+    """Bounded FIFO of protocol.Frame objects waiting to be written to one client.
+
+    put() never blocks and never touches the socket, so a broadcast costs
+    one enqueue per recipient. A writer (thread or event-loop task) drains
+    the queue with take(). When a client falls behind, the slow-consumer
+    policy decides what happens to the frames that no longer fit.
+
+    Frames put with priority=True go out ahead of the regular backlog and
+    are never dropped or coalesced; they do not count towards max_bytes,
+    so use them only for small messages that must arrive.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_QUEUE_BYTES, policy=DROP_OLDEST,
+                 skipped_notice=None, on_ready=None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.skipped_notice = skipped_notice  # count -> encoded frame, for COALESCE
+        self.on_ready = on_ready  # called when the queue goes from empty to non-empty
+        self.frames = collections.deque()
+        self.priority_frames = collections.deque()
+        self.closed = False
+
+        # Counters
+        self.queued_bytes = 0
+        self.enqueued_frames = 0
+        self.enqueued_bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+
+        self._cond = threading.Condition(threading.Lock())
+
+    def put(self, data, priority=False):
+        """Queue a frame. Returns False if the client must be dropped."""
+        with self._cond:
+            if self.closed:
+                return False
+
+            size = len(data)
+            if not priority and self.queued_bytes + size > self.max_bytes and self.frames:
+                if self.policy == DISCONNECT:
+                    self._discard_all()
+                    self.priority_frames.clear()
+                    self.closed = True
+                    self._cond.notify()
+                    return False
+                elif self.policy == COALESCE:
+                    skipped = self._discard_all()
+                    if self.skipped_notice:
+                        self._append(self.skipped_notice(skipped))
+                else:
+                    while self.frames and self.queued_bytes + size > self.max_bytes:
+                        self._drop_oldest()
+
+            was_empty = not self.frames and not self.priority_frames
+            if priority:
+                self.priority_frames.append(data)
+            else:
+                self._append(data)
+            self.enqueued_frames += 1
+            self.enqueued_bytes += size
+            if was_empty:
+                self._cond.notify()
+
+        if was_empty and self.on_ready:
+            self.on_ready()
+        return True
+
+    def take(self, timeout=None):
+        """Remove and return all queued frames, waiting up to timeout for one.
+
+        Returns an empty list on timeout and None once the queue is closed
+        and fully drained.
+        """
+        with self._cond:
+            if not self.frames and not self.priority_frames and not self.closed:
+                self._cond.wait(timeout)
+            if not self.frames and not self.priority_frames:
+                return None if self.closed else []
+            frames = list(self.priority_frames)
+            frames.extend(self.frames)
+            self.priority_frames.clear()
+            self.frames.clear()
+            self.queued_bytes = 0
+            return frames
+
+    def close(self, discard=False):
+        """Stop accepting frames; the writer exits after draining (or at once if discard)."""
+        with self._cond:
+            if discard:
+                self._discard_all()
+                self.priority_frames.clear()
+            self.closed = True
+            self._cond.notify()
+        if self.on_ready:
+            self.on_ready()
+
+    def _append(self, data):
+        self.frames.append(data)
+        self.queued_bytes += len(data)
+
+    def _drop_oldest(self):
+        data = self.frames.popleft()
+        self.queued_bytes -= len(data)
+        self.dropped_frames += 1
+        self.dropped_bytes += len(data)
+
+    def _discard_all(self):
+        count = len(self.frames)
+        self.dropped_frames += count
+        self.dropped_bytes += self.queued_bytes
+        self.frames.clear()
+        self.queued_bytes = 0
+        return count
+
+def wait_for_socket(sock, write=False, timeout=None):
+    """Block until sock can be read (or written). Returns False on timeout."""
+    if hasattr(select, "poll"):
+        # poll() has no FD_SETSIZE limit, which a busy threads-mode server exceeds
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if write else select.POLLIN)
+        return bool(poller.poll(None if timeout is None else timeout * 1000))
+    readable, writable, _ = select.select([] if write else [sock], [sock] if write else [], [], timeout)
+    return bool(readable or writable)
+
+class SharedTLSSocket:
+    """An SSLSocket read by one thread while another writes to it.
+
+    OpenSSL does not allow an SSL_read and an SSL_write on the same
+    connection at once, so every call into the SSLSocket holds one lock.
+    The socket is non-blocking underneath: recv_into() and sendall() wait
+    for the socket outside the lock and only take it to move bytes, so a
+    reader waiting for its client never holds up the writer, nor the other
+    way round. settimeout() applies to those waits.
+    """
+
+    def __init__(self, tls_socket):
+        self.tls_socket = tls_socket
+        self.timeout = tls_socket.gettimeout()
+        self.lock = threading.Lock()
+        tls_socket.setblocking(False)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def recv_into(self, buffer):
+        return self._call(self.tls_socket.recv_into, buffer)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[self._call(self.tls_socket.send, view):]
+
+    def setsockopt(self, *args):
+        self.tls_socket.setsockopt(*args)
+
+    def fileno(self):
+        return self.tls_socket.fileno()
+
+    def shutdown(self, how):
+        with self.lock:
+            self.tls_socket.shutdown(how)
+
+    def close(self):
+        self.tls_socket.close()
+
+    def _call(self, method, buffer):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            with self.lock:
+                try:
+                    return method(buffer)
+                except (ssl.SSLWantReadError, BlockingIOError):
+                    write = False
+                except ssl.SSLWantWriteError:
+                    write = True
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not wait_for_socket(self.tls_socket, write, remaining):
+                raise socket.timeout("timed out")
+
+class SocketConnection:
+    """A client socket whose writes go through an OutboundQueue.
+
+    send_frame() only enqueues; the actual socket writes happen on a
+    dedicated writer thread, which flushes everything queued with one
+    vectored write. For a protocol v2 peer that backlog is also packed into
+    BATCH frames, so the peer parses it in one go.
+    Reads are still done directly on .socket by the client's handler thread.
+    A TLS socket is replaced by a SharedTLSSocket on start(), since OpenSSL
+    cannot read and write one connection from two threads at once; the
+    handler must read through .socket from then on.
+
+    With a coalesce_window, the writer waits that many seconds after the
+    first frame of a burst so everything queued meanwhile goes out in the
+    same write. With cork, each write is bracketed by TCP_CORK so the
+    kernel sends only full segments. on_write(frame_count) is called after
+    every write.
+    """
+
+    def __init__(self, client_socket, queue, address=None, coalesce_window=0.0, cork=False, on_write=None):
+        self.socket = client_socket
+        self.queue = queue
+        self.address = address
+        self.coalesce_window = coalesce_window
+        self.cork = cork
+        self.on_write = on_write
+        self.version = 1      # protocol version negotiated with the peer
+        self.batch_limit = 0  # largest BATCH frame the peer accepts; 0 disables batching
+        self.compressor = None  # protocol.FrameCompressor when compression was negotiated
+        self.heartbeat = False  # peer answers pings, see heartbeat.py
+        self.last_seen = time.monotonic()  # when the peer last sent anything
+        self.session = None     # sessions.Session when the peer can resume after a drop
+        self.resume_seq = 0     # last session seq the peer saw before reconnecting
+        self.writer_thread = threading.Thread(target=self._run_writer, daemon=True)
+
+    def start(self):
+        if isinstance(self.socket, ssl.SSLSocket):
+            self.socket = SharedTLSSocket(self.socket)
+        self.writer_thread.start()
+
+    def send_frame(self, frame, priority=False):
+        if not self.queue.put(frame, priority):
+            raise ConnectionResetError("client dropped by slow-consumer policy")
+
+    def close(self):
+        """Flush whatever is queued, then close the socket"""
+        self.queue.close()
+
+    def abort(self):
+        """Discard queued frames and close the socket immediately"""
+        self.queue.close(discard=True)
+        self._shutdown()
+
+    def join(self, timeout=None):
+        if self.writer_thread.is_alive():
+            self.writer_thread.join(timeout)
+
+    def _run_writer(self):
+        try:
+            while True:
+                frames = self.queue.take()
+                if frames is None:
+                    break
+                if frames:
+                    if self.coalesce_window:
+                        time.sleep(self.coalesce_window)
+                        frames.extend(self.queue.take(timeout=0) or ())
+                    count = len(frames)
+                    if self.batch_limit:
+                        frames = protocol.pack_batches(frames, self.batch_limit)
+                    if self.compressor:
+                        frames = self.compressor.compress(frames)
+                    if self.cork:
+                        set_cork(self.socket, True)
+                    protocol.send_frames(self.socket, frames)
+                    if self.cork:
+                        set_cork(self.socket, False)
+                    if self.on_write:
+                        self.on_write(count)
+        except (socket.error, ConnectionResetError, BrokenPipeError):
+            self.queue.close(discard=True)
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        # shutdown() wakes the handler thread blocked in recv(); close() alone does not
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
@@ -0,0 +1,510 @@
+import collections
+import socket
+import ssl
+import struct
+import zlib
+
+# Every message on the wire is a 4-byte big-endian length followed by the payload
+LENGTH_PREFIX = struct.Struct('!I')
+MAX_FRAME_SIZE = 10000  # 10KB limit on a single framed message
+
+# Most systems cap a single sendmsg() at 1024 buffers
+IOV_MAX = 1024
+
+# Smallest read into a FrameDecoder, and the most a drained one holds on to
+MIN_READ_SIZE = 4096
+
+# Protocol v2 is negotiated by a HELLO frame sent before the username, e.g.
+# "\x00HELLO proto=2 batch=65536". The server answers with a HELLO of its
+# own and both sides switch to v2 framing after it. v1 clients never send
+# one and keep exchanging plain UTF-8 text.
+HELLO_PREFIX = "\x00HELLO "
+PROTOCOL_VERSION = 2
+MAX_BATCH_SIZE = 64 * 1024  # largest BATCH frame a v2 peer may ask for
+
+# In v2 every payload starts with a typed header, followed by the UTF-8 body
+MESSAGE_HEADER = struct.Struct("!BBIII")  # type, flags, sender id, room id, sequence
+
+# v2 message types
+UNTYPED = 0    # a v1 message, which carries no type
+CHAT = 1       # a room message from a user; from a client, any line it typed
+PRIVATE = 2    # a whisper to or from this user
+NOTICE = 3     # joins, leaves, welcome text and command replies
+ERROR = 4      # a request failed
+USER_LIST = 5  # reply to /who
+HELP = 6       # reply to /help
+SYSTEM = 7     # server-wide announcements such as shutdown
+BATCH = 8      # body is a sequence of complete v2 frames
+PING = 9       # liveness probe; the receiver answers with a PONG
+PONG = 10      # answer to a PING, echoing its body
+
+# v2 message flags
+FLAG_HISTORY = 0x01     # replayed from history rather than live
+FLAG_COMPRESSED = 0x02  # BATCH body is deflated with the connection's stream
+
+# Compression is offered in the HELLO as "compress=deflate". Each compressed
+# connection keeps one raw deflate stream per direction for its lifetime, so
+# repeated text like "[username]: " is sent as a back-reference. A small
+# window and memory level keep a stream to about 64KB.
+COMPRESSION = "deflate"
+COMPRESSION_WBITS = -13  # 8KB window, raw deflate without zlib headers
+COMPRESSION_MEMLEVEL = 6
+COMPRESSION_SLACK = 64   # room kept in a batch for deflate's worst-case growth
+
+class Frame:
+    """A message framed once and shared by every recipient.
+
+    The length prefix and UTF-8 payload are kept as two separate buffers so
+    they can be handed to sendmsg() together without concatenating them.
+    Frames are immutable, so the same object can sit in many outbound
+    queues at once.
+    """
+
+    __slots__ = ("header", "payload")
+
+    def __init__(self, payload, prefix=b""):
+        # A v2 frame carries its typed header in prefix, ahead of the payload
+        self.header = LENGTH_PREFIX.pack(len(prefix) + len(payload)) + prefix
+        self.payload = payload
+
+    @classmethod
+    def from_text(cls, message):
+        return cls(message.encode("utf-8"))
+
+    @property
+    def typed(self):
+        """Whether this is a v2 frame with a typed header"""
+        return len(self.header) > LENGTH_PREFIX.size
+
+    def buffers(self):
+        return (self.header, self.payload)
+
+    def __len__(self):
+        return len(self.header) + len(self.payload)
+
+    def __bytes__(self):
+        return self.header + self.payload
+
+class Batch:
+    """Several v2 frames sent as the body of a single BATCH frame.
+
+    The inner frames are not copied; their buffers follow the batch header
+    in the same vectored write, and the receiver parses them in one go.
+    """
+
+    __slots__ = ("header", "frames")
+
+    typed = True
+
+    def __init__(self, frames):
+        size = MESSAGE_HEADER.size + sum(len(frame) for frame in frames)
+        self.header = LENGTH_PREFIX.pack(size) + MESSAGE_HEADER.pack(BATCH, 0, 0, 0, 0)
+        self.frames = frames
+
+    def buffers(self):
+        buffers = [self.header]
+        for frame in self.frames:
+            buffers.append(frame.header)
+            buffers.append(frame.payload)
+        return buffers
+
+    def __len__(self):
+        return len(self.header) + sum(len(frame) for frame in self.frames)
+
+def pack_batches(frames, limit):
+    """Combine runs of v2 frames into BATCH frames whose payload fits in limit.
+
+    v1 frames (such as the HELLO reply) and frames too big to share a batch
+    are passed through unchanged, in order.
+    """
+    packed = []
+    run = []
+    run_size = MESSAGE_HEADER.size
+
+    def flush():
+        if len(run) == 1:
+            packed.append(run[0])
+        elif run:
+            packed.append(Batch(list(run)))
+        run.clear()
+
+    for frame in frames:
+        if not frame.typed or MESSAGE_HEADER.size + len(frame) > limit:
+            flush()
+            run_size = MESSAGE_HEADER.size
+            packed.append(frame)
+            continue
+        if run_size + len(frame) > limit:
+            flush()
+            run_size = MESSAGE_HEADER.size
+        run.append(frame)
+        run_size += len(frame)
+    flush()
+    return packed
+
+class Message:
+    """A message that can be framed for either protocol version.
+
+    The body is encoded once. The v1 frame (just the text) and the v2 frame
+    (typed header plus the same body) are each built the first time a
+    recipient speaking that version needs them and then shared, so a
+    broadcast to a mix of old and new clients still frames at most twice.
+    """
+
+    __slots__ = ("kind", "body", "sender_id", "room_id", "seq", "flags", "_frames")
+
+    def __init__(self, kind, body, sender_id=0, room_id=0, seq=0, flags=0):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.kind = kind
+        self.body = body
+        self.sender_id = sender_id
+        self.room_id = room_id
+        self.seq = seq
+        self.flags = flags
+        self._frames = [None, None]  # v1 frame, v2 frame
+
+    @property
+    def text(self):
+        try:
+            return str(self.body, "utf-8")
+        except UnicodeDecodeError as e:
+            raise ProtocolError("message is not valid UTF-8") from e
+
+    def typed_header(self):
+        return MESSAGE_HEADER.pack(self.kind, self.flags, self.sender_id, self.room_id, self.seq)
+
+    def frame(self, version=1):
+        """The shared Frame for a peer speaking the given protocol version"""
+        frame = self._frames[version - 1]
+        if frame is None:
+            if version == 1:
+                frame = Frame(self.body)
+            else:
+                frame = Frame(self.body, self.typed_header())
+            self._frames[version - 1] = frame
+        return frame
+
+    def encode(self):
+        """The v2 payload (typed header and body) as bytes"""
+        return self.typed_header() + self.body
+
+    def with_flags(self, flags):
+        """Copy of this message with extra flags set"""
+        return Message(self.kind, self.body, self.sender_id, self.room_id, self.seq, self.flags | flags)
+
+def as_message(message, kind=NOTICE):
+    """Return message as a Message, wrapping it with kind if it is still a str"""
+    if isinstance(message, Message):
+        return message
+    return Message(kind, message)
+
+def decode_message(payload):
+    """Parse one v2 payload (typed header and body) into a Message"""
+    if len(payload) < MESSAGE_HEADER.size:
+        raise ProtocolError("v2 payload is shorter than its header")
+    kind, flags, sender_id, room_id, seq = MESSAGE_HEADER.unpack_from(payload)
+    return Message(kind, bytes(payload[MESSAGE_HEADER.size:]), sender_id, room_id, seq, flags)
+
+def unpack_messages(payload, decompressor=None, max_size=MAX_BATCH_SIZE):
+    """List of Messages in one v2 payload, expanding a BATCH.
+
+    A compressed BATCH is inflated with decompressor, the connection's
+    zlib decompression stream, to at most max_size bytes.
+    """
+    payload = bytes(payload)
+    if len(payload) < MESSAGE_HEADER.size:
+        raise ProtocolError("v2 payload is shorter than its header")
+    kind, flags = payload[0], payload[1]
+    if kind != BATCH:
+        return [decode_message(payload)]
+
+    position = MESSAGE_HEADER.size
+    if flags & FLAG_COMPRESSED:
+        if decompressor is None:
+            raise ProtocolError("compressed frame on an uncompressed connection")
+        try:
+            payload = decompressor.decompress(payload[position:], max_size)
+        except zlib.error as e:
+            raise ProtocolError(f"bad compressed frame: {e}") from e
+        if decompressor.unconsumed_tail:
+            raise ProtocolError(f"compressed frame inflates beyond {max_size} bytes")
+        position = 0
+
+    messages = []
+    while position < len(payload):
+        if len(payload) - position < LENGTH_PREFIX.size:
+            raise ProtocolError("truncated frame in batch")
+        (length,) = LENGTH_PREFIX.unpack_from(payload, position)
+        start = position + LENGTH_PREFIX.size
+        position = start + length
+        if position > len(payload):
+            raise ProtocolError("truncated frame in batch")
+        message = decode_message(payload[start:position])
+        if message.kind == BATCH:
+            raise ProtocolError("batches cannot be nested")
+        messages.append(message)
+    return messages
+
+class FrameCompressor:
+    """Deflates a connection's outgoing v2 frames with one persistent stream.
+
+    Used by the connection's writer after pack_batches(). A batch, or a
+    single typed frame, of at least threshold bytes is replaced by a
+    compressed BATCH. The stream is flushed with Z_SYNC_FLUSH after every
+    frame, so each frame can be decoded as soon as it arrives. The stream
+    is created on first use, so idle connections never pay for it.
+    """
+
+    def __init__(self, threshold, level=6, on_compressed=None):
+        self.threshold = threshold
+        self.level = level
+        self.on_compressed = on_compressed  # called with (bytes in, bytes out) per write
+        self.stream = None
+
+    def compress(self, frames):
+        compressed = []
+        bytes_in = bytes_out = 0
+        for frame in frames:
+            if len(frame) < self.threshold or not frame.typed:
+                compressed.append(frame)
+                continue
+            if self.stream is None:
+                self.stream = zlib.compressobj(
+                    self.level, zlib.DEFLATED, COMPRESSION_WBITS, COMPRESSION_MEMLEVEL)
+            inner = frame.frames if isinstance(frame, Batch) else (frame,)
+            data = self.stream.compress(frames_to_bytes(inner)) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+            packed = Frame(data, MESSAGE_HEADER.pack(BATCH, FLAG_COMPRESSED, 0, 0, 0))
+            compressed.append(packed)
+            bytes_in += len(frame)
+            bytes_out += len(packed)
+        if bytes_in and self.on_compressed:
+            self.on_compressed(bytes_in, bytes_out)
+        return compressed
+
+def new_decompressor():
+    """Decompression stream matching FrameCompressor"""
+    return zlib.decompressobj(COMPRESSION_WBITS)
+
+def hello_frame(**options):
+    """v1 Frame announcing protocol options, e.g. hello_frame(proto=2)"""
+    fields = " ".join(f"{key}={value}" for key, value in options.items())
+    return Frame.from_text(HELLO_PREFIX + fields)
+
+def parse_hello(message):
+    """Options of a HELLO message as a dict of strings, or None if it is not one"""
+    if not message.startswith(HELLO_PREFIX):
+        return None
+    options = {}
+    for field in message[len(HELLO_PREFIX):].split():
+        key, _, value = field.partition("=")
+        options[key] = value
+    return options
+
+def send_frames(sock, frames):
+    """Write frames to a blocking socket using vectored I/O.
+
+    Headers and payloads go out in as few sendmsg() calls as possible,
+    handling partial writes, so a batch of queued frames costs one syscall
+    and no copying in the common case.
+    """
+    buffers = []
+    for frame in frames:
+        buffers.extend(frame.buffers())
+
+    if not hasattr(sock, "sendmsg") or isinstance(sock, ssl.SSLSocket):
+        # TLS encrypts a record at a time, so it gets one buffer instead
+        sock.sendall(b"".join(buffers))
+        return
+
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index + IOV_MAX])
+        # Skip the buffers that went out completely, then trim a partial one
+        while index < len(buffers) and sent >= len(buffers[index]):
+            sent -= len(buffers[index])
+            index += 1
+        if sent:
+            buffers[index] = memoryview(buffers[index])[sent:]
+
+def frames_to_bytes(frames):
+    """Concatenate frames for transports without a vectored write"""
+    buffers = []
+    for frame in frames:
+        buffers.extend(frame.buffers())
+    return b"".join(buffers)
+
+class ProtocolError(Exception):
+    """Raised when the peer sends data that violates the framing protocol"""
+
+class FrameDecoder:
+    """Incremental decoder for length-prefixed frames.
+
+    Bytes are received straight into one reusable bytearray with
+    recv_into() (or appended with feed() by event loops that already hold
+    the data), and every complete frame in the buffer can then be taken
+    without another syscall. A burst of pipelined messages is therefore
+    read with a single recv rather than two per message, and fragmented
+    payloads are never re-copied while they accumulate.
+
+    The buffer starts empty and only grows as far as the data needs: reads
+    double in size, up to buffer_size, while they keep filling it, and a
+    partial frame reserves just the bytes it still lacks. Once everything
+    has been consumed, a buffer grown beyond what the next read needs is
+    given back, so an idle connection holds a few KB at most.
+    """
+
+    def __init__(self, buffer_size=64 * 1024, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()  # allocated by the first read, see _reserve()
+        self.max_read_size = max(buffer_size, MIN_READ_SIZE)
+        self.read_size = MIN_READ_SIZE  # size of the next recv_into()
+        self.max_frame_size = max_frame_size
+        self.start = 0  # first unconsumed byte
+        self.end = 0    # one past the last received byte
+        self.last_frame_size = 0  # payload length of the most recent frame
+        self.version = 1  # protocol version the peer speaks, see PROTOCOL_VERSION
+        self._unpacked = collections.deque()  # messages left over from a v2 batch
+        self.decompressor = None  # set when the connection negotiated compression
+        self.capture = None  # called with every payload taken, see capture.py
+
+    def writable_buffer(self, min_size=MIN_READ_SIZE):
+        """Free space at the end of the buffer, for recv_into()-style APIs"""
+        self._reserve(min_size)
+        return memoryview(self.buffer)[self.end:]
+
+    def commit(self, nbytes):
+        """Record nbytes written into the buffer returned by writable_buffer()"""
+        self.end += nbytes
+
+    def recv_into(self, sock):
+        """Receive whatever the kernel has ready. Returns 0 on EOF."""
+        with self.writable_buffer(max(self.read_size, self._missing())) as view:
+            size = len(view)
+            nbytes = sock.recv_into(view)
+        self.commit(nbytes)
+        # Read in bigger chunks while the peer keeps them full, smaller once it slows down
+        if nbytes == size:
+            self.read_size = min(self.read_size * 2, self.max_read_size)
+        elif nbytes < self.read_size // 2:
+            self.read_size = max(self.read_size // 2, MIN_READ_SIZE)
+        return nbytes
+
+    def feed(self, data):
+        """Append bytes that were received elsewhere"""
+        self._reserve(max(len(data), self._missing()))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_frame(self):
+        """Return the next complete payload as a memoryview, or None.
+
+        The view points into the decoder's buffer and is only valid until
+        the next call that receives or feeds more data.
+        """
+        available = self.end - self.start
+        if available < LENGTH_PREFIX.size:
+            return None
+        (length,) = LENGTH_PREFIX.unpack_from(self.buffer, self.start)
+        if length > self.max_frame_size:
+            raise ProtocolError(f"frame of {length} bytes exceeds limit of {self.max_frame_size}")
+        if available < LENGTH_PREFIX.size + length:
+            return None
+        payload_start = self.start + LENGTH_PREFIX.size
+        self.start = payload_start + length
+        self.last_frame_size = length
+        frame = memoryview(self.buffer)[payload_start:self.start]
+        if self.capture is not None:
+            self.capture(frame)
+        return frame
+
+    def next_message(self):
+        """Return the text of the next complete message, or None"""
+        if self.version > 1:
+            message = self.next_decoded()
+            return None if message is None else message.text
+        frame = self.next_frame()
+        if frame is None:
+            return None
+        with frame:
+            try:
+                return str(frame, "utf-8")
+            except UnicodeDecodeError as e:
+                raise ProtocolError("frame is not valid UTF-8") from e
+
+    def next_decoded(self):
+        """Return the next complete message as a Message, or None.
+
+        v1 messages come back UNTYPED. v2 batches are unpacked in one pass
+        and their messages returned one per call.
+        """
+        if self.version == 1:
+            text = self.next_message()
+            return None if text is None else Message(UNTYPED, text)
+        if not self._unpacked:
+            frame = self.next_frame()
+            if frame is None:
+                return None
+            with frame:
+                self._unpacked.extend(unpack_messages(
+                    frame, self.decompressor, max(self.max_frame_size, MAX_BATCH_SIZE)))
+        message = self._unpacked.popleft()
+        self.last_frame_size = MESSAGE_HEADER.size + len(message.body)
+        return message
+
+    def _missing(self):
+        """Bytes the partial frame at the front of the buffer still lacks"""
+        available = self.end - self.start
+        if available < LENGTH_PREFIX.size:
+            return 0
+        (length,) = LENGTH_PREFIX.unpack_from(self.buffer, self.start)
+        return max(0, min(length, self.max_frame_size) + LENGTH_PREFIX.size - available)
+
+    def _reserve(self, size):
+        """Make room for at least size bytes after self.end"""
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > max(size, MIN_READ_SIZE):
+                # Drained: give back what a burst or a large frame needed
+                self.buffer = bytearray(size)
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if pending + size <= len(self.buffer):
+            # Slide the partial frame to the front of the buffer
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            grown = bytearray(pending + size)
+            grown[:pending] = self.buffer[self.start:self.end]
+            self.buffer = grown
+        self.start, self.end = 0, pending
+
+class MessageReader:
+    """Blocking reader that yields one decoded message per call"""
+
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.decoder = FrameDecoder(max_frame_size=max_frame_size)
+
+    def receive(self):
+        """Return the next message's text, or None on EOF, error or protocol violation.
+
+        Socket timeouts are re-raised so callers can tell them apart.
+        """
+        return self._receive(self.decoder.next_message)
+
+    def receive_message(self):
+        """Like receive(), but returns a Message carrying its type and ids"""
+        return self._receive(self.decoder.next_decoded)
+
+    def _receive(self, next_message):
+        try:
+            while True:
+                message = next_message()
+                if message is not None:
+                    return message
+                if not self.decoder.recv_into(self.sock):
+                    return None
+        except socket.timeout:
+            raise
+        except (OSError, ProtocolError):
+            return None
@@ -0,0 +1,181 @@
+import threading
+import time
+
+# What to do with a client that exceeds its message or byte rate
+THROTTLE = "throttle"      # stop reading from it until it is back within its rate
+MUTE = "mute"              # drop its messages for a while
+DISCONNECT = "disconnect"  # drop the client altogether
+FLOOD_ACTIONS = (THROTTLE, MUTE, DISCONNECT)
+
+BURST_SECONDS = 2.0  # a bucket holds this many seconds' worth of its rate
+MUTE_SECONDS = 30.0
+MAX_IDLE_ADDRESSES = 4096  # idle per-IP entries kept before sweeping
+
+class TokenBucket:
+    """Classic token bucket, refilled lazily from the monotonic clock.
+
+    Every call is O(1) and needs no timer. Buckets shared between threads
+    (per-IP ones) are updated without a lock, so a concurrent burst may be
+    let through a token or two early, which is fine for flood protection.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate * BURST_SECONDS
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount tokens are available, without taking them"""
+        self._refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+    def reserve(self, amount, now):
+        """Take amount tokens, going into debt if needed.
+
+        Returns how long the caller should wait for its turn, so callers
+        that keep reserving are spaced out at exactly the bucket's rate.
+        """
+        self._refill(now)
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    @property
+    def full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+class ClientLimits:
+    """Rate limits applied to one connection's incoming messages.
+
+    Holds the connection's own message and byte buckets plus the ones it
+    shares with other connections from the same IP address.
+    """
+
+    def __init__(self, message_buckets, byte_buckets, action):
+        self.message_buckets = message_buckets
+        self.byte_buckets = byte_buckets
+        self.action = action
+        self.muted_until = 0.0
+
+    def admit(self, size):
+        """Charge one message of size bytes against every bucket.
+
+        Returns 0.0 if it is within the limits, otherwise how many seconds
+        the client is over. With THROTTLE the message is charged anyway and
+        the caller should wait that long; otherwise nothing is charged.
+        """
+        now = time.monotonic()
+        if self.action == THROTTLE:
+            delay = 0.0
+            for bucket in self.message_buckets:
+                delay = max(delay, bucket.reserve(1, now))
+            for bucket in self.byte_buckets:
+                delay = max(delay, bucket.reserve(size, now))
+            return delay
+
+        delay = 0.0
+        for bucket in self.message_buckets:
+            delay = max(delay, bucket.wait_time(1, now))
+        for bucket in self.byte_buckets:
+            delay = max(delay, bucket.wait_time(size, now))
+        if delay:
+            return delay
+        for bucket in self.message_buckets:
+            bucket.take(1)
+        for bucket in self.byte_buckets:
+            bucket.take(size)
+        return 0.0
+
+    def muted(self):
+        return self.muted_until > time.monotonic()
+
+    def mute(self, seconds=MUTE_SECONDS):
+        self.muted_until = time.monotonic() + seconds
+
+class RateLimiter:
+    """Flood protection settings and the per-IP buckets shared by connections.
+
+    A rate of 0 disables that limit. The lock only guards the per-IP table
+    and is taken when a connection opens or closes, never per message.
+    """
+
+    def __init__(self, message_rate=0, byte_rate=0, ip_message_rate=0, ip_byte_rate=0,
+                 action=THROTTLE, accept_rate=0):
+        if action not in FLOOD_ACTIONS:
+            raise ValueError(f"Unknown flood action: {action}")
+        self.message_rate = message_rate
+        self.byte_rate = byte_rate
+        self.ip_message_rate = ip_message_rate
+        self.ip_byte_rate = ip_byte_rate
+        self.action = action
+        self.accept_bucket = TokenBucket(accept_rate) if accept_rate else None
+        self.lock = threading.Lock()
+        self._addresses = {}  # IP -> [message bucket, byte bucket, open connections]
+
+    @property
+    def enabled(self):
+        return bool(self.message_rate or self.byte_rate or self.ip_message_rate or self.ip_byte_rate)
+
+    def accept_delay(self):
+        """Seconds to wait before accepting the next connection"""
+        if self.accept_bucket is None:
+            return 0.0
+        return self.accept_bucket.reserve(1, time.monotonic())
+
+    def for_client(self, address):
+        """ClientLimits for a new connection, or None if no limit is set"""
+        if not self.enabled:
+            return None
+        message_buckets = []
+        byte_buckets = []
+        if self.message_rate:
+            message_buckets.append(TokenBucket(self.message_rate))
+        if self.byte_rate:
+            byte_buckets.append(TokenBucket(self.byte_rate))
+
+        if address and (self.ip_message_rate or self.ip_byte_rate):
+            with self.lock:
+                entry = self._addresses.get(address[0])
+                if entry is None:
+                    if len(self._addresses) >= MAX_IDLE_ADDRESSES:
+                        self._sweep()
+                    entry = self._addresses[address[0]] = [
+                        TokenBucket(self.ip_message_rate) if self.ip_message_rate else None,
+                        TokenBucket(self.ip_byte_rate) if self.ip_byte_rate else None,
+                        0,
+                    ]
+                entry[2] += 1
+            if entry[0]:
+                message_buckets.append(entry[0])
+            if entry[1]:
+                byte_buckets.append(entry[1])
+        return ClientLimits(message_buckets, byte_buckets, self.action)
+
+    def release(self, address):
+        """Forget a closed connection's share of its IP's buckets"""
+        if not address:
+            return
+        with self.lock:
+            entry = self._addresses.get(address[0])
+            if entry is not None:
+                entry[2] -= 1
+
+    def _sweep(self):
+        # Only addresses with no connections and full buckets can go; dropping
+        # one that is still in debt would let a flooder reset it by reconnecting
+        for ip, (message_bucket, byte_bucket, connections) in list(self._addresses.items()):
+            if (not connections and (message_bucket is None or message_bucket.full)
+                    and (byte_bucket is None or byte_bucket.full)):
+                del self._addresses[ip]
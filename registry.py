@@ -0,0 +1,207 @@
+import itertools
+import re
+import threading
+import zlib
+
+DEFAULT_ROOM = "lobby"
+ROOM_NAME_PATTERN = re.compile(r"^[a-z0-9_-]{1,30}$")
+
+def normalize_room(name):
+    """Canonical room name ("#General" -> "general"), or None if invalid"""
+    name = name.strip().lstrip("#").lower()
+    if not ROOM_NAME_PATTERN.match(name):
+        return None
+    return name
+
+def room_id(room):
+    """32-bit id for a room in protocol v2 headers.
+
+    Derived from the name rather than assigned, so every cluster worker and
+    every restart agrees on it without coordination. Being a hash, two rooms
+    can share an id, though with a thousand rooms the odds are about one in
+    ten thousand; clients that must never confuse rooms should go by name.
+    """
+    return zlib.crc32(room.encode("utf-8"))
+
+class ClientRegistry:
+    """The set of connected clients, published as copy-on-write snapshots.
+
+    Joins and leaves take the lock, update the mutable indexes and publish
+    a new immutable snapshot tuple of (connection, username) pairs. Readers
+    such as broadcast() just grab the current snapshot attribute, which is
+    a single atomic reference read, so sending a chat message neither locks
+    nor copies the client list. Membership changes are far rarer than
+    messages, so paying O(N) there is the right trade-off.
+
+    Every client is in exactly one room. Each room's members are published
+    the same way, so a room broadcast costs O(room size) rather than
+    O(connected users). New clients start in DEFAULT_ROOM.
+    """
+
+    def __init__(self, lock=None):
+        self.lock = lock or threading.Lock()
+        self.snapshot = ()
+        self._clients = {}      # connection -> username
+        self._usernames = {}    # casefolded username -> connection
+        self._next_suffix = {}  # casefolded taken name -> next "_N" suffix to try
+        self._sorted_cache = None  # (snapshot, sorted usernames)
+        self._room_of = {}      # connection -> room name
+        self._rooms = {}        # room name -> {connection: username}
+        self.room_snapshots = {}  # room name -> tuple of (connection, username)
+        self._user_ids = {}     # connection -> numeric id for protocol v2 headers
+        self._next_user_id = itertools.count(1)
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def add(self, connection, username, is_taken=None):
+        """Register a connection under a unique username.
+
+        Returns the username actually assigned, which carries a numeric
+        suffix when the requested name is already taken. is_taken, if
+        given, reports names held elsewhere (e.g. by other cluster workers).
+        """
+        def taken(name):
+            key = name.casefold()
+            return key in self._usernames or (is_taken is not None and is_taken(key))
+
+        with self.lock:
+            key = username.casefold()
+            if taken(username):
+                # Resume from the last suffix handed out for this name
+                original_username = username
+                counter = self._next_suffix.get(key, 1)
+                while taken(f"{original_username}_{counter}"):
+                    counter += 1
+                self._next_suffix[key] = counter + 1
+                username = f"{original_username}_{counter}"
+
+            self._clients[connection] = username
+            self._usernames[username.casefold()] = connection
+            self._user_ids[connection] = next(self._next_user_id)
+            self._enter_room(connection, username, DEFAULT_ROOM)
+            self._publish()
+        return username
+
+    def remove(self, connection):
+        """Unregister a connection. Returns its username, or None if unknown."""
+        with self.lock:
+            username = self._clients.pop(connection, None)
+            if username is None:
+                return None
+            key = username.casefold()
+            if self._usernames.get(key) is connection:
+                del self._usernames[key]
+            # Once the name itself is free, suffixing for it can start over
+            self._next_suffix.pop(key, None)
+            self._user_ids.pop(connection, None)
+            self._leave_room(connection)
+            self._publish()
+        return username
+
+    def replace(self, old, new):
+        """Hand old's username, room and user id over to connection new.
+
+        Nobody else sees a leave or a join. Returns the username, or None
+        if old is not registered.
+        """
+        with self.lock:
+            username = self._clients.pop(old, None)
+            if username is None:
+                return None
+            self._clients[new] = username
+            self._usernames[username.casefold()] = new
+            self._user_ids[new] = self._user_ids.pop(old)
+            room = self._room_of[old]
+            self._leave_room(old)
+            self._enter_room(new, username, room)
+            self._publish()
+        return username
+
+    def clear(self):
+        """Unregister everyone, returning the last snapshot"""
+        with self.lock:
+            snapshot = self.snapshot
+            self._clients.clear()
+            self._usernames.clear()
+            self._next_suffix.clear()
+            self._user_ids.clear()
+            self._room_of.clear()
+            self._rooms.clear()
+            self.room_snapshots = {}
+            self._publish()
+        return snapshot
+
+    def find(self, username):
+        """Connection for a username (case-insensitive), or None"""
+        # A single dict lookup is atomic, so this does not need the lock
+        return self._usernames.get(username.casefold())
+
+    def sorted_usernames(self):
+        """All usernames in sorted order, cached until membership changes"""
+        snapshot = self.snapshot
+        cached = self._sorted_cache
+        if cached is not None and cached[0] is snapshot:
+            return cached[1]
+        usernames = tuple(sorted(username for _, username in snapshot))
+        self._sorted_cache = (snapshot, usernames)
+        return usernames
+
+    def user_id(self, connection):
+        """Numeric id of a registered connection, or 0"""
+        return self._user_ids.get(connection, 0)
+
+    def set_first_user_id(self, first_id):
+        """Start handing out user ids from first_id, e.g. one range per cluster worker"""
+        self._next_user_id = itertools.count(first_id)
+
+    def room_of(self, connection):
+        """Name of the room a connection is in, or None if not registered"""
+        return self._room_of.get(connection)
+
+    def members(self, room):
+        """Snapshot of (connection, username) pairs in a room, without locking"""
+        return self.room_snapshots.get(room, ())
+
+    def move(self, connection, room):
+        """Move a registered connection into room (already normalized).
+
+        Returns the name of the room it left, or None if it was not
+        registered or is already in that room.
+        """
+        with self.lock:
+            username = self._clients.get(connection)
+            old_room = self._room_of.get(connection)
+            if username is None or old_room == room:
+                return None
+            self._leave_room(connection)
+            self._enter_room(connection, username, room)
+        return old_room
+
+    def room_list(self):
+        """Sorted list of (room name, member count) for every room"""
+        with self.lock:
+            rooms = [(room, len(members)) for room, members in self._rooms.items()]
+        return sorted(rooms)
+
+    def _enter_room(self, connection, username, room):
+        members = self._rooms.setdefault(room, {})
+        members[connection] = username
+        self._room_of[connection] = room
+        self.room_snapshots[room] = tuple(members.items())
+
+    def _leave_room(self, connection):
+        room = self._room_of.pop(connection, None)
+        if room is None:
+            return
+        members = self._rooms[room]
+        del members[connection]
+        if members or room == DEFAULT_ROOM:
+            self.room_snapshots[room] = tuple(members.items())
+        else:
+            # Empty rooms other than the default one disappear
+            del self._rooms[room]
+            del self.room_snapshots[room]
+
+    def _publish(self):
+        self.snapshot = tuple(self._clients.items())
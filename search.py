@@ -0,0 +1,132 @@
+import collections
+import queue
+import re
+import threading
+
+import protocol
+
+WINDOW = 10000     # most recent broadcasts kept searchable, across all rooms
+MAX_RESULTS = 10   # messages one /search returns: the newest matches, listed oldest first
+MAX_PENDING = 10000  # messages waiting to be indexed; more are left out of the index
+
+WORD = re.compile(r"\w+")
+
+def tokenize(text):
+    """The distinct lowercase words of text; a URL is split into its parts"""
+    return set(WORD.findall(text.casefold()))
+
+class SearchIndex:
+    """Inverted index over the most recent broadcast messages.
+
+    Every word maps, per room, to a posting list: the ids of the messages
+    in that room containing it, oldest first. Ids only grow, so the message
+    that drops out of the window is at the head of each of its lists and
+    evicting it is one popleft() per word; memory stays bounded by the
+    window. A query walks the posting lists of its words from the newest
+    end, so its cost follows the length of those lists, not the window.
+
+    add() only enqueues. A background thread tokenizes and updates the
+    index, so recording a message costs a broadcast nothing measurable.
+    If that thread falls behind by max_pending messages, add() drops new
+    ones instead of queueing without bound; they are just not searchable.
+    """
+
+    def __init__(self, window=WINDOW, max_pending=MAX_PENDING):
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = queue.Queue(maxsize=max_pending)  # (room, Message), None to stop
+        self._messages = {}   # id -> (room, words, Message) for the window
+        self._postings = {}   # (room, word) -> deque of ids, oldest first
+        self._next_id = 0
+        self._oldest_id = 0
+        self.thread = threading.Thread(target=self._run, name="search-index", daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, room, message):
+        """Queue a message broadcast to room for indexing.
+
+        Returns False if the message was dropped because the queue is full.
+        """
+        try:
+            self.pending.put_nowait((room, message))
+        except queue.Full:
+            return False
+        return True
+
+    def close(self):
+        self.pending.put(None)  # waits for room if the thread is behind
+
+    def search(self, room, terms, limit=MAX_RESULTS):
+        """The newest limit messages of room containing every word of terms, oldest first"""
+        words = tokenize(terms)
+        if not words:
+            return []
+        with self.lock:
+            postings = [self._postings.get((room, word)) for word in words]
+            if None in postings:
+                return []
+            ids = newest_common(postings, limit)
+            matches = [self._messages[message_id][2] for message_id in ids]
+        matches.reverse()
+        return matches
+
+    def _run(self):
+        while True:
+            # Index everything that queued up meanwhile under one lock acquisition
+            batch = [self.pending.get()]
+            while not self.pending.empty() and batch[-1] is not None:
+                batch.append(self.pending.get())
+            entries = [
+                # Results are replayed like history, so v2 clients can tell them from live traffic
+                (room, tokenize(message.text), message.with_flags(protocol.FLAG_HISTORY))
+                for room, message in (item for item in batch if item is not None)
+            ]
+            with self.lock:
+                for entry in entries:
+                    self._insert(*entry)
+            if batch[-1] is None:
+                return
+
+    def _insert(self, room, words, message):
+        message_id = self._next_id
+        self._next_id += 1
+        self._messages[message_id] = (room, words, message)
+        for word in words:
+            posting = self._postings.get((room, word))
+            if posting is None:
+                posting = self._postings[(room, word)] = collections.deque()
+            posting.append(message_id)
+        while len(self._messages) > self.window:
+            self._evict()
+
+    def _evict(self):
+        room, words, _ = self._messages.pop(self._oldest_id)
+        for word in words:
+            posting = self._postings[(room, word)]
+            posting.popleft()
+            if not posting:
+                del self._postings[(room, word)]
+        self._oldest_id += 1
+
+def newest_common(postings, limit):
+    """Ids present in every posting list, newest first, at most limit of them.
+
+    The lists are walked backwards in step, always advancing the ones whose
+    current id is newer than the oldest current id, so each list is read
+    at most once and the walk stops as soon as limit ids have matched.
+    """
+    iterators = [reversed(posting) for posting in postings]
+    heads = [next(iterator, None) for iterator in iterators]
+    matches = []
+    while len(matches) < limit and None not in heads:
+        target = min(heads)
+        if all(head == target for head in heads):
+            matches.append(target)
+            heads = [next(iterator, None) for iterator in iterators]
+        else:
+            heads = [next(iterator, None) if head > target else head
+                     for iterator, head in zip(iterators, heads)]
+    return matches
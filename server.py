@@ -1,310 +1,1429 @@
+import argparse
+import functools
+import itertools
 import socket
 import threading
-import struct
 import time
 
-server_ip = "127.0.0.1" # localhost
-port = 8000
+import admission
+import capture
+import heartbeat
+import history
+import metrics
+import outbound
+import protocol
+import ratelimit
+import registry
+import search
+import sessions
+import tls
+from registry import ClientRegistry
 
-clients = {}
-clients_lock = threading.Lock()
-server_running = True
+HANDSHAKE_TIMEOUT = 30.0
+CLOSE_TIMEOUT = 5.0  # how long a closing connection may spend flushing its queue
 
-def send_message(client_socket, message):
-    """Send a message with length prefix to handle partial reception"""
+PING_MESSAGE = protocol.Message(protocol.PING, b"")
+
+# Instrumentation, exposed through /stats and the --metrics-port HTTP endpoint.
+# Metrics are process-wide: several ChatServers in one process add up.
+connections_accepted = metrics.register(metrics.Counter(
+    "chat_connections_accepted_total", "Connections accepted"))
+messages_in = metrics.register(metrics.Counter(
+    "chat_messages_received_total", "Messages received from clients"))
+bytes_in = metrics.register(metrics.Counter(
+    "chat_received_bytes_total", "Payload bytes received from clients"))
+messages_out = metrics.register(metrics.Counter(
+    "chat_messages_sent_total", "Messages queued for delivery to clients"))
+bytes_out = metrics.register(metrics.Counter(
+    "chat_sent_bytes_total", "Framed bytes queued for delivery to clients"))
+send_failures = metrics.register(metrics.Counter(
+    "chat_send_failures_total", "Deliveries refused because the client was gone or dropped"))
+broadcast_fanout = metrics.register(metrics.Histogram(
+    "chat_broadcast_fanout_seconds", "Time to queue one broadcast for every recipient",
+    metrics.LATENCY_BUCKETS))
+lock_wait = metrics.register(metrics.Histogram(
+    "chat_registry_lock_wait_seconds", "Time spent waiting for the client registry lock",
+    metrics.LATENCY_BUCKETS))
+log_suppressed = metrics.register(metrics.Counter(
+    "chat_message_log_suppressed_total", "Message log lines dropped by the rate limit"))
+rate_limited = metrics.register(metrics.Counter(
+    "chat_rate_limited_messages_total", "Messages throttled or dropped by flood protection"))
+flood_disconnects = metrics.register(metrics.Counter(
+    "chat_flood_disconnects_total", "Clients disconnected by flood protection"))
+connections_rejected = metrics.register(metrics.Counter(
+    "chat_connections_rejected_total", "Connections turned away because the server was full"))
+pings_sent = metrics.register(metrics.Counter(
+    "chat_heartbeat_pings_total", "Pings sent to quiet connections"))
+idle_evictions = metrics.register(metrics.Counter(
+    "chat_idle_evictions_total", "Connections dropped for not answering heartbeats"))
+sessions_resumed = metrics.register(metrics.Counter(
+    "chat_sessions_resumed_total", "Dropped clients that reconnected into their session"))
+sessions_expired = metrics.register(metrics.Counter(
+    "chat_sessions_expired_total", "Dropped sessions whose client did not come back in time"))
+messages_replayed = metrics.register(metrics.Counter(
+    "chat_messages_replayed_total", "Missed messages replayed to resumed sessions"))
+accepts_throttled = metrics.register(metrics.Counter(
+    "chat_accepts_throttled_total", "Connections whose handling was delayed by the accept rate limit"))
+tls_handshakes = metrics.register(metrics.Counter(
+    "chat_tls_handshakes_total", "Completed TLS handshakes"))
+tls_resumed = metrics.register(metrics.Counter(
+    "chat_tls_resumed_total", "TLS handshakes that resumed an earlier session"))
+socket_writes = metrics.register(metrics.Counter(
+    "chat_socket_writes_total", "Writes that flushed queued frames to a client socket"))
+frames_written = metrics.register(metrics.Counter(
+    "chat_socket_write_frames_total", "Frames flushed by those writes"))
+search_dropped = metrics.register(metrics.Counter(
+    "chat_search_dropped_messages_total", "Chat messages not indexed for /search because indexing fell behind"))
+compression_in = metrics.register(metrics.Counter(
+    "chat_compression_input_bytes_total", "Framed bytes handed to per-connection compressors"))
+compression_out = metrics.register(metrics.Counter(
+    "chat_compression_output_bytes_total", "Compressed bytes produced from them"))
+metrics.register(metrics.Gauge(
+    "chat_compression_saved_bytes", "Bytes saved on the wire by compression",
+    lambda: compression_in.value - compression_out.value))
+
+# ChatServers running in this process, see ChatServer.run()
+chat_servers = []
+
+# Chat commands by name and alias, see command(); every ChatServer copies it
+commands = {}
+
+def send_message(client_socket, message, kind=protocol.NOTICE):
+    """Send a message (str or pre-encoded protocol.Message) to one client.
+
+    A str is sent as a message of the given protocol v2 type.
+    """
+    frame = frame_for(client_socket, protocol.as_message(message, kind))
+    if not queue_frame(client_socket, frame):
+        send_failures.inc()
+        return False
+    messages_out.inc()
+    bytes_out.inc(len(frame))
+    return True
+
+def send_error(client_socket, text):
+    """Tell one client that its request failed"""
+    return send_message(client_socket, f"ERROR: {text}", protocol.ERROR)
+
+def frame_for(client_socket, message):
+    """The Frame to queue for one client; resumable sessions number their own copy"""
+    session = client_socket.session
+    if session is None:
+        return message.frame(client_socket.version)
+    return session.record(message)
+
+def queue_frame(client_socket, frame):
+    """Hand a frame to a client's outbound queue without touching the counters"""
     try:
-        message_bytes = message.encode("utf-8")
-        message_length = len(message_bytes)
-        # Send 4-byte length prefix followed by message
-        length_prefix = struct.pack('!I', message_length)
-        client_socket.sendall(length_prefix + message_bytes)
+        client_socket.send_frame(frame)
         return True
     except (socket.error, ConnectionResetError, BrokenPipeError):
         return False
 
-def receive_message(client_socket):
-    """Receive a message with length prefix to handle partial reception"""
-    try:
-        # First receive the 4-byte length prefix
-        length_data = b''
-        while len(length_data) < 4:
-            chunk = client_socket.recv(4 - len(length_data))
-            if not chunk:
-                return None
-            length_data += chunk
-        
-        message_length = struct.unpack('!I', length_data)[0]
-        
-        # Validate message length to prevent memory issues
-        if message_length > 10000:  # 10KB limit
-            return None
-            
-        # Now receive the actual message
-        message_data = b''
-        while len(message_data) < message_length:
-            chunk = client_socket.recv(message_length - len(message_data))
-            if not chunk:
-                return None
-            message_data += chunk
-            
-        return message_data.decode("utf-8")
-    except (socket.error, ConnectionResetError, UnicodeDecodeError, struct.error):
+def skipped_notice(count, version=1):
+    """Frame that replaces a coalesced backlog for a slow client"""
+    notice = protocol.Message(protocol.SYSTEM, f"SERVER: {count} messages skipped because your connection is too slow")
+    return notice.frame(version)
+
+def outbound_stats():
+    """Aggregate outbound queue counters over all connected clients"""
+    queues = [client_socket.queue for chat_server in chat_servers
+              for client_socket, _ in chat_server.clients.snapshot
+              if client_socket.queue is not None]
+
+    stats = {"clients": len(queues), "queued_bytes": 0, "max_queued_bytes": 0,
+             "enqueued_bytes": 0, "dropped_frames": 0, "dropped_bytes": 0}
+    for queue in queues:
+        stats["queued_bytes"] += queue.queued_bytes
+        stats["max_queued_bytes"] = max(stats["max_queued_bytes"], queue.queued_bytes)
+        stats["enqueued_bytes"] += queue.enqueued_bytes
+        stats["dropped_frames"] += queue.dropped_frames
+        stats["dropped_bytes"] += queue.dropped_bytes
+    return stats
+
+def count_write(frame_count):
+    socket_writes.inc()
+    frames_written.inc(frame_count)
+
+metrics.register(metrics.Gauge(
+    "chat_frames_per_write", "Frames sent per socket write on average; higher with --coalesce-ms",
+    lambda: round(frames_written.value / socket_writes.value, 2) if socket_writes.value else 0))
+
+def total(value):
+    """Sum value(chat_server) over the running servers, for the gauges below"""
+    return lambda: sum(value(chat_server) for chat_server in chat_servers)
+
+metrics.register(metrics.Gauge(
+    "chat_connected_clients", "Registered clients on this process",
+    total(lambda chat_server: len(chat_server.clients))))
+metrics.register(metrics.Gauge(
+    "chat_open_connections", "Open connections, including ones still in their handshake",
+    total(lambda chat_server: chat_server.connection_slots.current)))
+metrics.register(metrics.Gauge(
+    "chat_peak_open_connections", "Most connections open at once since startup",
+    total(lambda chat_server: chat_server.connection_slots.peak)))
+metrics.register(metrics.Gauge(
+    "chat_pending_handshakes", "Connections waiting in the handshake threads for a username",
+    total(lambda chat_server: sum(len(reactor) for reactor in chat_server.handshake_reactors))))
+metrics.register(metrics.Gauge(
+    "chat_sessions", "Resumable sessions, including dropped ones waiting for their client",
+    total(lambda chat_server: len(chat_server.session_table))))
+metrics.register(metrics.Gauge(
+    "chat_heartbeat_connections", "Connections watched by the heartbeat reaper",
+    total(lambda chat_server: len(chat_server.heartbeats) if chat_server.heartbeats is not None else 0)))
+metrics.register(metrics.Gauge(
+    "chat_search_indexed_messages", "Recent chat messages in the /search index",
+    total(lambda chat_server: len(chat_server.search_index) if chat_server.search_index is not None else 0)))
+metrics.register(metrics.Gauge(
+    "chat_outbound_queued_bytes", "Bytes waiting in all outbound queues",
+    lambda: outbound_stats()["queued_bytes"]))
+metrics.register(metrics.Gauge(
+    "chat_outbound_max_queued_bytes", "Deepest single outbound queue in bytes",
+    lambda: outbound_stats()["max_queued_bytes"]))
+metrics.register(metrics.Gauge(
+    "chat_outbound_dropped_frames", "Frames dropped by the slow-consumer policy for connected clients",
+    lambda: outbound_stats()["dropped_frames"]))
+
+def get_stats():
+    """Text for the /stats admin command"""
+    return "Server stats:\n" + metrics.summary()
+
+def room_notice(text, user_id, room):
+    """Notice about a user in a room, tagged with both ids for v2 clients"""
+    return protocol.Message(protocol.NOTICE, text, user_id, registry.room_id(room))
+
+def clean_username(username):
+    """Strip a requested username, returning None if it is not acceptable"""
+    username = username.strip()
+    if not username or len(username) > 50:
         return None
+    return username
 
-def broadcast(message, sender_socket=None):
-    """Broadcast message to all clients except sender"""
-    disconnected_clients = []
-    
-    with clients_lock:
-        # Create a copy of clients to avoid modification during iteration
-        clients_copy = dict(clients)
-    
-    for client_socket, username in clients_copy.items():
-        if client_socket != sender_socket:
-            if not send_message(client_socket, message):
-                print(f"Failed to send message to {username}. Marking for removal.")
-                disconnected_clients.append(client_socket)
-    
-    # Remove disconnected clients
-    if disconnected_clients:
-        with clients_lock:
-            for client_socket in disconnected_clients:
-                if client_socket in clients:
-                    username = clients[client_socket]
-                    del clients[client_socket]
-                    print(f"Removed disconnected client: {username}")
-                try:
-                    client_socket.close()
-                except:
-                    pass
+def count_compression(bytes_in, bytes_out):
+    compression_in.inc(bytes_in)
+    compression_out.inc(bytes_out)
+
+def count_tls(tls_socket):
+    """Count a finished TLS handshake; tls_socket is an SSLSocket or SSLObject"""
+    tls_handshakes.inc()
+    if tls_socket.session_reused:
+        tls_resumed.inc()
+
+def server_full_notice():
+    return protocol.Frame.from_text("SERVER: The server is full. Please try again later.")
+
+def reject_connection(raw_socket, client_address, notice=True):
+    """Turn away a connection because --max-connections was reached.
+
+    Without notice it is just closed; a TLS peer could not read a plaintext one.
+    """
+    connections_rejected.inc()
+    print(f"Rejected connection from {client_address[0]}:{client_address[1]}: server full")
+    try:
+        if notice:
+            raw_socket.settimeout(1.0)
+            raw_socket.sendall(bytes(server_full_notice()))
+    except OSError:
+        pass
+    finally:
+        raw_socket.close()
+
+class Command:
+    """A chat command and the line describing it in /help"""
+
+    def __init__(self, handler, name, aliases=(), usage="", description=""):
+        self.handler = handler
+        self.name = name
+        self.aliases = aliases
+        self.usage = usage
+        self.description = description
+
+    @property
+    def help_line(self):
+        line = self.name
+        if self.usage:
+            line += f" {self.usage}"
+        if self.aliases:
+            line += f" (or {', '.join(self.aliases)})"
+        return f"{line} - {self.description}"
+
+def command(name, *aliases, usage="", description="", table=None):
+    """Decorator registering handler(chat_server, client_socket, username, args) as a command.
+
+    args are the words following the command. Commands go into the
+    module-wide table, which every ChatServer created afterwards starts
+    from; pass a server's own .commands as table to extend only that one.
+    Registering an existing name replaces its command.
+    """
+    def register(handler):
+        entry = Command(handler, name, aliases, usage, description)
+        target = commands if table is None else table
+        for key in (name,) + aliases:
+            target[key.lower()] = entry
+        return handler
+    return register
+
+class ChatServer:
+    """One chat server: its clients, rooms, sessions, commands and lifecycle.
+
+    Everything a server mutates lives on the instance, so several can run
+    in one process, e.g. for tests and in-process benchmarks. Options are
+    the class attributes below and can be given to the constructor:
+
+        chat_server = ChatServer(port=0, mode="async").start()
+        ...  # connect to chat_server.port
+        chat_server.stop()
+
+    start() binds, runs the server on a background thread and returns once
+    it accepts connections; port 0 binds a free port, which is then in
+    .port. run() serves on the calling thread instead, until stop() or
+    Ctrl+C. Inside a running event loop, await async_server.serve() on an
+    instance that has been bind()-ed, and cancel it to stop.
+    """
+
+    host = "127.0.0.1"  # localhost
+    port = 8000
+    mode = "threads"    # threads: one thread per connection; async: asyncio event loop
+
+    # Admission control: listen backlog, connection cap and handshake threads
+    listen_backlog = 1024
+    max_connections = 0    # 0 is unlimited
+    handshake_threads = 0  # 0 reads each handshake on the client's own thread
+    rate_limiter = None    # ratelimit.RateLimiter; every limit is off by default
+
+    # Per-client outbound queue limits, see outbound.py
+    slow_consumer_policy = outbound.DROP_OLDEST
+    max_queue_bytes = outbound.DEFAULT_MAX_QUEUE_BYTES
+
+    # Compression of protocol v2 connections, offered to clients that ask for it
+    compression_enabled = True
+    compress_min_bytes = 256  # smaller writes go out uncompressed
+
+    # Socket writes: how long a writer gathers frames before flushing them in
+    # one write, TCP_NODELAY (asyncio always sets it) and TCP_CORK around writes
+    coalesce_window = 0.0  # seconds; 0 writes as soon as the writer wakes
+    tcp_nodelay = True
+    tcp_cork = False
+
+    # Heartbeats for v2 clients that offer them; v1 clients get TCP keepalive
+    heartbeat_interval = 30.0  # ping after this many seconds of silence; 0 disables
+    idle_timeout = 90.0        # evict after this many seconds of silence
+
+    # Resumable sessions for v2 clients that ask for them; grace 0 disables them
+    session_grace = sessions.GRACE_SECONDS
+    replay_size = sessions.REPLAY_SIZE
+
+    # Recent chat messages per room; persisted when history_dir is given
+    history_dir = None
+    backfill_count = 20  # messages replayed to a client when it enters a room
+    search_window = search.WINDOW  # recent broadcasts /search looks through; 0 disables it
+
+    # File to record every inbound frame to, for benchmarks/replay.py; see capture.py
+    capture_path = None
+
+    # Who may use admin commands like /stats; when empty, any loopback client may
+    admin_users = ()
+    metrics_port = 0  # 0 disables the HTTP metrics endpoint
+
+    # Set when this process is one worker of a multi-process cluster, see cluster.py
+    reuse_port = False
+
+    # ssl.SSLContext to serve TLS with, see tls.server_context(); None is plaintext
+    tls_context = None
+
+    def __init__(self, **options):
+        for name, value in options.items():
+            if name.startswith("_") or not hasattr(ChatServer, name) or callable(getattr(ChatServer, name)):
+                raise TypeError(f"ChatServer got an unknown option '{name}'")
+            setattr(self, name, value)
+        self.admin_users = {username.casefold() for username in self.admin_users}
+        if self.rate_limiter is None:
+            self.rate_limiter = ratelimit.RateLimiter()
+
+        self.commands = dict(commands)
+        self.clients = ClientRegistry(lock=metrics.TimedLock(lock_wait))
+        self.connection_slots = admission.ConnectionSlots(self.max_connections)
+        self.session_table = sessions.SessionTable(self.session_grace, self.replay_size)
+        self.message_history = history.MessageHistory()
+        self.capture = None  # capture.CaptureFile, see start_capture()
+        self.search_index = None  # search.SearchIndex, see start_search()
+        self.handshake_reactors = []
+        self.heartbeats = None  # heartbeat.Heartbeat, see start_heartbeat()
+        self.bus = None  # cluster.ClusterBus when this process is a cluster worker
+
+        # Pre-encoded /who reply, rebuilt only after membership changes
+        self.user_list_cache = (None, None)  # (sorted usernames it was built from, message)
 
-def send_private_message(sender_username, target_username, message):
-    """Send a private message to a specific user"""
-    target_socket = None
-    
-    with clients_lock:
-        # Find the target user's socket
-        for socket, username in clients.items():
-            if username.lower() == target_username.lower():
-                target_socket = socket
-                break
-    
-    if target_socket:
-        private_msg = f"[PRIVATE from {sender_username}]: {message}"
-        if send_message(target_socket, private_msg):
+        # Sequence numbers of chat messages, carried in protocol v2 headers
+        self.message_seq = itertools.count(1)
+
+        self.running = False
+        self.listener = None  # listening socket, see bind()
+        self.ready = threading.Event()  # set once connections are being accepted
+        self.thread = None  # background thread of start()
+        self.loop = None    # event loop and serving task of an async server
+        self.task = None
+
+    # Lifecycle
+
+    def bind(self):
+        """Open the listening socket. Returns the port, which the kernel picks for port 0."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Cluster workers each bind the same address; the kernel spreads accepts
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        print(f"Binding server to {self.host}:{self.port}...")
+        try:
+            listener.bind((self.host, self.port))
+            listener.listen(self.listen_backlog)
+        except OSError:
+            listener.close()
+            raise
+        print("Server bound successfully.")
+        self.listener = listener
+        self.port = listener.getsockname()[1]
+        return self.port
+
+    def run(self):
+        """Serve in the calling thread until stop() or Ctrl+C"""
+        chat_servers.append(self)
+        try:
+            if self.mode == "async":
+                import async_server
+                async_server.run_async_server(self)
+            else:
+                self.run_server()
+        finally:
+            chat_servers.remove(self)
+            if self.listener is not None:
+                # Already closed by the server; a later start() binds afresh
+                self.listener.close()
+                self.listener = None
+            self.ready.set()  # release start() if serving failed early
+
+    def start(self):
+        """Bind and serve on a background thread. Returns self once it accepts connections."""
+        if self.listener is None:
+            self.bind()
+        self.ready.clear()  # still set if this server ran before
+        self.thread = threading.Thread(target=self.run, name=f"chat-server-{self.port}", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if not self.running:
+            raise OSError(f"Chat server on {self.host}:{self.port} failed to start")
+        return self
+
+    def stop(self, timeout=CLOSE_TIMEOUT):
+        """Stop accepting, say goodbye to every client and wait for run() to return"""
+        self.running = False
+        # run() clears these as it finishes, possibly while we look at them
+        loop, task, listener = self.loop, self.task, self.listener
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                pass  # the loop has already finished
+        elif listener is not None:
+            try:
+                # Wakes a thread blocked in accept()
+                listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.join(timeout)
+
+    def join(self, timeout=None):
+        """Wait for a server started with start() to finish"""
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def start_metrics_endpoint(self):
+        """Start the HTTP metrics endpoint if --metrics-port was given"""
+        if not self.metrics_port:
+            return
+        try:
+            metrics.start_http_server(self.host, self.metrics_port)
+            print(f"Serving metrics on http://{self.host}:{self.metrics_port}/metrics")
+        except OSError as e:
+            print(f"Could not start metrics endpoint on port {self.metrics_port}: {e}")
+
+    def start_history(self):
+        """Switch to a disk-backed history if --history-dir was given"""
+        if not self.history_dir:
+            return
+        try:
+            self.message_history = history.MessageHistory(self.history_dir)
+            print(f"Keeping message history in {self.history_dir}")
+        except OSError as e:
+            print(f"Could not open message history in {self.history_dir}: {e}")
+
+    def start_search(self):
+        """Start indexing broadcasts for /search unless --search-window is 0"""
+        if self.search_window:
+            self.search_index = search.SearchIndex(self.search_window)
+
+    def record_message(self, room, message):
+        """Keep a broadcast chat message in room's history and the search index"""
+        self.message_history.append(room, message)
+        if self.search_index is not None:
+            if not self.search_index.add(room, message):
+                search_dropped.inc()
+
+    def start_capture(self):
+        """Start recording inbound traffic if --capture was given"""
+        if not self.capture_path:
+            return
+        try:
+            self.capture = capture.CaptureFile(self.capture_path)
+            print(f"Capturing inbound traffic to {self.capture_path}")
+        except OSError as e:
+            print(f"Could not open capture file {self.capture_path}: {e}")
+
+    def new_decoder(self, client_address):
+        """FrameDecoder for a new connection, recording it when capturing"""
+        decoder = protocol.FrameDecoder()
+        capture_file = self.capture  # cleared by shutdown_server() on another thread
+        if capture_file is not None:
+            decoder.capture = capture_file.stream(client_address)
+        return decoder
+
+    def end_capture(self, decoder):
+        if decoder.capture is not None:
+            decoder.capture.close()
+
+    def new_connection(self, raw_socket, client_address):
+        """Wrap an accepted socket in a SocketConnection with the configured write options"""
+        return outbound.SocketConnection(
+            raw_socket, self.new_outbound_queue(), client_address,
+            coalesce_window=self.coalesce_window, cork=self.tcp_cork, on_write=count_write)
+
+    def new_outbound_queue(self, on_ready=None):
+        """Create an outbound queue using the configured slow-consumer settings"""
+        return outbound.OutboundQueue(
+            max_bytes=self.max_queue_bytes,
+            policy=self.slow_consumer_policy,
+            skipped_notice=skipped_notice,
+            on_ready=on_ready,
+        )
+
+    # Delivery
+
+    def broadcast(self, message, sender_socket=None, room=None, record=False):
+        """Broadcast message to all clients except sender.
+
+        With a room, only that room's members receive it; otherwise everyone does.
+        With record, the message is also kept in the room's history.
+        In a cluster the message is also relayed to the other workers.
+        """
+        # Encode once; every recipient's queue shares the same frame
+        message = protocol.as_message(message)
+        if record:
+            self.record_message(room, message)
+        self.deliver_local(message, sender_socket, room)
+        if self.bus:
+            self.bus.broadcast(message, room, record)
+
+    def deliver_local(self, message, sender_socket=None, room=None):
+        """Queue a message for this process's clients in room (or all of them)"""
+        disconnected_clients = []
+        delivered = 0
+        delivered_bytes = 0
+
+        with broadcast_fanout.time():
+            # Snapshots are immutable, so they can be iterated without the lock
+            recipients = self.clients.snapshot if room is None else self.clients.members(room)
+            for client_socket, username in recipients:
+                if client_socket != sender_socket:
+                    # Framed at most once per protocol version, then shared
+                    frame = frame_for(client_socket, message)
+                    if queue_frame(client_socket, frame):
+                        delivered += 1
+                        delivered_bytes += len(frame)
+                    else:
+                        print(f"Failed to send message to {username}. Marking for removal.")
+                        disconnected_clients.append(client_socket)
+
+        # Count once per broadcast rather than once per recipient
+        messages_out.inc(delivered)
+        bytes_out.inc(delivered_bytes)
+        if disconnected_clients:
+            send_failures.inc(len(disconnected_clients))
+
+        # Remove disconnected clients
+        for client_socket in disconnected_clients:
+            username = self.forget_client(client_socket)
+            if username:
+                print(f"Removed disconnected client: {username}")
+            client_socket.abort()
+
+    def send_private_message(self, sender_username, target_username, message, sender_id=0):
+        """Send a private message to a specific user"""
+        target_socket = self.clients.find(target_username)
+        private_msg = protocol.Message(
+            protocol.PRIVATE, f"[PRIVATE from {sender_username}]: {message}", sender_id)
+
+        if target_socket:
+            if send_message(target_socket, private_msg):
+                return True, f"Private message sent to {target_username}"
+            else:
+                return False, f"Failed to send message to {target_username} (connection issue)"
+        elif self.bus and self.bus.whisper(target_username, private_msg):
             return True, f"Private message sent to {target_username}"
         else:
-            return False, f"Failed to send message to {target_username} (connection issue)"
-    else:
-        return False, f"User '{target_username}' not found"
-
-def get_user_list():
-    """Get a list of all connected users"""
-    with clients_lock:
-        usernames = list(clients.values())
-    
-    if usernames:
-        user_list = "Connected users (" + str(len(usernames)) + "): " + ", ".join(sorted(usernames))
-    else:
-        user_list = "No users currently connected"
-    
-    return user_list
-
-def handle_command(client_socket, username, message):
-    """Handle chat commands starting with /"""
-    parts = message.strip().split()
-    command = parts[0].lower()
-    
-    if command == "/whisper" or command == "/w":
-        if len(parts) < 3:
-            send_message(client_socket, "ERROR: Usage: /whisper <username> <message>")
-            return
-        
-        target_username = parts[1]
-        whisper_message = " ".join(parts[2:])
-        
-        success, response = send_private_message(username, target_username, whisper_message)
-        
-        if success:
-            # Send confirmation to sender
-            confirmation = f"[PRIVATE to {target_username}]: {whisper_message}"
-            send_message(client_socket, confirmation)
+            return False, f"User '{target_username}' not found"
+
+    def send_history(self, client_socket, room, count, title):
+        """Replay up to count recent messages of room to one client"""
+        messages = self.message_history.recent(room, count)
+        if not messages:
+            return 0
+        send_message(client_socket, f"--- {title} ---")
+        for message in messages:
+            send_message(client_socket, message)
+        send_message(client_socket, "--- End of history ---")
+        return len(messages)
+
+    def user_count(self):
+        """Number of connected users, across all workers when clustered"""
+        if self.bus:
+            return len(self.clients) + len(self.bus.remote_users)
+        return len(self.clients)
+
+    def get_user_list(self):
+        """Get the encoded list of all connected users, cached between joins and leaves"""
+        usernames = self.clients.sorted_usernames()
+        if self.bus:
+            usernames = self.bus.merged_usernames(usernames)
+        cached_usernames, user_list = self.user_list_cache
+        if cached_usernames is usernames:
+            return user_list
+
+        if usernames:
+            user_list = "Connected users (" + str(len(usernames)) + "): " + ", ".join(usernames)
         else:
-            send_message(client_socket, f"ERROR: {response}")
-    
-    elif command == "/who" or command == "/users":
-        user_list = get_user_list()
-        send_message(client_socket, user_list)
-    
-    elif command == "/help" or command == "/h":
-        help_text = """Available commands:
-/whisper <username> <message> (or /w) - Send a private message
-/who (or /users) - List all connected users  
-/help (or /h) - Show this help message
-/exit - Leave the chat"""
-        send_message(client_socket, help_text)
-    
-    else:
-        send_message(client_socket, f"ERROR: Unknown command '{command}'. Type /help for available commands.")
+            user_list = "No users currently connected"
 
-def client_handler(client_socket, client_address):
-    """Handle individual client connections"""
-    username = None
-    try:
-        # Set socket timeout for operations
-        client_socket.settimeout(30.0)
-        
-        # Receive username with proper message framing
-        username = receive_message(client_socket)
-        if not username:
-            print(f"Failed to receive username from {client_address}")
+        user_list = protocol.Message(protocol.USER_LIST, user_list)
+        self.user_list_cache = (usernames, user_list)
+        return user_list
+
+    # Commands
+
+    def is_admin(self, client_socket, username):
+        """Whether a client may use admin commands"""
+        if self.admin_users:
+            return username.casefold() in self.admin_users
+        address = getattr(client_socket, "address", None)
+        return bool(address) and address[0] in ("127.0.0.1", "::1")
+
+    def handle_command(self, client_socket, username, message):
+        """Handle chat commands starting with /"""
+        parts = message.strip().split()
+        name = parts[0].lower()
+        entry = self.commands.get(name)
+        if entry is None:
+            send_error(client_socket, f"Unknown command '{name}'. Type /help for available commands.")
             return
-            
-        username = username.strip()
-        
-        # Validate username
-        if not username or len(username) > 50:
-            send_message(client_socket, "ERROR: Invalid username")
+        entry.handler(self, client_socket, username, parts[1:])
+
+    def help_text(self):
+        """Text for /help, one line per registered command"""
+        entries = dict.fromkeys(self.commands.values())  # aliases share an entry
+        lines = ["Available commands:"]
+        lines.extend(entry.help_line for entry in entries if entry.description)
+        lines.append("/exit - Leave the chat")
+        return "\n".join(lines)
+
+    def change_room(self, client_socket, username, room):
+        """Move a client to another room and tell both rooms about it"""
+        old_room = self.clients.move(client_socket, room)
+        if old_room is None:
+            send_error(client_socket, f"You are already in #{room}")
             return
-            
-        # Check for duplicate usernames
-        with clients_lock:
-            existing_usernames = set(clients.values())
-            if username in existing_usernames:
-                counter = 1
-                original_username = username
-                while username in existing_usernames:
-                    username = f"{original_username}_{counter}"
-                    counter += 1
-            
-            clients[client_socket] = username
-            
+        if self.bus:
+            self.bus.user_moved(username, room)
+
+        user_id = self.clients.user_id(client_socket)
+        self.broadcast(room_notice(f"--- {username} has left #{old_room} ---", user_id, old_room), room=old_room)
+        self.broadcast(room_notice(f"--- {username} has joined #{room} ---", user_id, room), client_socket, room=room)
+        send_message(client_socket, room_notice(
+            f"You are now in #{room} ({len(self.clients.members(room))} users)", user_id, room))
+        self.send_history(client_socket, room, self.backfill_count, f"Recent messages in #{room}")
+
+    # Joining and leaving
+
+    def register_client(self, client_socket, username):
+        """Add a client under a unique username and announce the join.
+
+        Returns the username actually assigned, which may carry a numeric suffix
+        when the requested name is already taken.
+        """
+        bus = self.bus
+        username = self.clients.add(client_socket, username, is_taken=bus.is_taken if bus else None)
+        room = self.clients.room_of(client_socket)
+        if bus:
+            bus.user_joined(username, room)
+
+        user_id = self.clients.user_id(client_socket)
         join_msg = f"--- {username} has joined the chat ---"
-        print(f"User {username} joined from {client_address}")
-        broadcast(join_msg)
-        
+        self.broadcast(room_notice(join_msg, user_id, room), room=room)
+
         # Send welcome message to the user
         welcome_msg = f"""Welcome to the chat, {username}!
 Type /help to see available commands.
-Current users: {len(clients)}"""
-        send_message(client_socket, welcome_msg)
-        
-        # Remove timeout for message receiving
-        client_socket.settimeout(None)
-        
-        while server_running:
-            request = receive_message(client_socket)
-            if not request:
-                break
-                
-            if request.lower() in ["close", "exit"]:
-                send_message(client_socket, "Goodbye!")
-                break
-                
-            # Validate message length
-            if len(request) > 1000:  # 1KB message limit
-                send_message(client_socket, "ERROR: Message too long")
-                continue
-            
-            # Check if it's a command
-            if request.startswith('/'):
-                handle_command(client_socket, username, request)
+Current users: {self.user_count()}
+You are in #{room}; use /join <room> to switch rooms."""
+        send_message(client_socket, room_notice(welcome_msg, user_id, room))
+        self.send_history(client_socket, room, self.backfill_count, f"Recent messages in #{room}")
+        if self.heartbeats is not None and client_socket.heartbeat:
+            self.heartbeats.add(client_socket)
+        return username
+
+    def join_client(self, client_socket, username):
+        """Register a client, or put it back into its session if it is resuming one.
+
+        Returns the username the client ends up with.
+        """
+        session = client_socket.session
+        if session is not None and session.username is not None:
+            resumed = self.resume_session(client_socket, session)
+            if resumed:
+                return resumed
+        username = self.register_client(client_socket, username)
+        if session is not None:
+            session.username = username
+            self.session_table.attach(session, client_socket)
+        return username
+
+    def resume_session(self, client_socket, session):
+        """Swap a reconnected client in for its old connection and replay what it missed.
+
+        Returns the username, or None if the session cannot be resumed after all.
+        """
+        old = session.connection
+        if not self.session_table.attach(session, client_socket):
+            return None
+        username = self.clients.replace(old, client_socket)
+        if username is None:
+            return None
+        if not isinstance(old, sessions.DetachedConnection):
+            # The old connection is half-open and the server has not noticed yet
+            old.abort()
+        if self.heartbeats is not None and client_socket.heartbeat:
+            self.heartbeats.add(client_socket)
+
+        frames, complete = session.missed(client_socket.resume_seq)
+        for frame in frames:
+            queue_frame(client_socket, frame)
+        sessions_resumed.inc()
+        messages_replayed.inc(len(frames))
+        notice = f"--- Reconnected as {username}; {len(frames)} missed messages replayed ---"
+        if not complete:
+            notice += " (older messages were lost)"
+        send_message(client_socket, notice)
+        print(f"Session of {username} resumed from {client_socket.address}")
+        return username
+
+    def end_connection(self, client_socket, username, dropped):
+        """Unregister a client whose connection ended.
+
+        If the connection dropped and the client has a session, it is detached
+        instead: the username stays taken and messages are kept for a resume.
+        """
+        session = client_socket.session
+        if session is not None and session.connection is client_socket:
+            if dropped and username and self.running:
+                placeholder = sessions.DetachedConnection(session, client_socket.version, client_socket.address)
+                if self.clients.replace(client_socket, placeholder) is not None:
+                    if self.heartbeats is not None:
+                        self.heartbeats.remove(client_socket)
+                    self.session_table.detach(session, placeholder)
+                    print(f"User {username} dropped; keeping the session for {self.session_table.grace:g} seconds")
+                    return
+            self.session_table.discard(session)
+        self.unregister_client(client_socket, username)
+
+    def expire_sessions(self):
+        """Let go of detached sessions whose client did not come back in time"""
+        for session in self.session_table.expired():
+            sessions_expired.inc()
+            print(f"Session of {session.username} expired")
+            self.unregister_client(session.connection, session.username)
+
+    def forget_client(self, client_socket):
+        """Unregister a client, telling other workers when clustered.
+
+        Returns the client's username, or None if it was not registered.
+        """
+        username = self.clients.remove(client_socket)
+        if username and self.bus:
+            self.bus.user_left(username)
+        return username
+
+    def unregister_client(self, client_socket, username):
+        """Remove a client and announce the departure to the rest of its room"""
+        if self.heartbeats is not None:
+            self.heartbeats.remove(client_socket)
+        room = self.clients.room_of(client_socket)
+        user_id = self.clients.user_id(client_socket)
+        was_registered = self.forget_client(client_socket) is not None
+
+        if was_registered and username:
+            leave_msg = f"--- {username} has left the chat ---"
+            print(f"User {username} left")
+            self.broadcast(room_notice(leave_msg, user_id, room), room=room)
+
+    # Incoming traffic
+
+    def handle_request(self, client_socket, username, request):
+        """Process one message from a registered client.
+
+        Returns False when the client asked to leave the chat.
+        """
+        messages_in.inc()
+        if request.lower() in ["close", "exit"]:
+            send_message(client_socket, "Goodbye!")
+            return False
+
+        # Validate message length
+        if len(request) > 1000:  # 1KB message limit
+            send_error(client_socket, "Message too long")
+            return True
+
+        # Check if it's a command
+        if request.startswith('/'):
+            self.handle_command(client_socket, username, request)
+        else:
+            # Regular broadcast message
+            room = self.clients.room_of(client_socket)
+            broadcast_msg = protocol.Message(
+                protocol.CHAT, f"[{username}]: {request}",
+                self.clients.user_id(client_socket), registry.room_id(room), next(self.message_seq))
+            metrics.message_log.info("%s in #%s: %s", username, room, request)
+            self.broadcast(broadcast_msg, client_socket, room=room, record=True)
+        return True
+
+    def handle_control(self, client_socket, message):
+        """Answer heartbeat traffic. Returns False if message is not a PING or PONG."""
+        if message.kind == protocol.PING:
+            send_message(client_socket, protocol.Message(protocol.PONG, message.body))
+            return True
+        return message.kind == protocol.PONG
+
+    def start_heartbeat(self, thread=True):
+        """Create the heartbeat reaper unless --heartbeat-interval is 0.
+
+        With thread=False the caller must call heartbeats.poll() every tick.
+        Returns the reaper or None.
+        """
+        if self.heartbeat_interval:
+            self.heartbeats = heartbeat.Heartbeat(
+                self.heartbeat_interval, self.idle_timeout, self.send_ping, self.evict_idle)
+            if thread:
+                self.heartbeats.start()
+        return self.heartbeats
+
+    def send_ping(self, client_socket):
+        pings_sent.inc()
+        try:
+            send_message(client_socket, PING_MESSAGE)
+        except ConnectionResetError:
+            pass
+
+    def evict_idle(self, client_socket):
+        """Drop a connection that stopped answering; its handler cleans up on EOF"""
+        idle_evictions.inc()
+        print(f"Evicting {client_socket.address}: silent for {self.idle_timeout:g} seconds")
+        client_socket.abort()
+
+    def admit_request(self, client_socket, username, limits, size):
+        """Check one incoming message against the client's rate limits.
+
+        Returns how many seconds to wait before handling it (0 when within the
+        limits, more when throttled), None if the message must be dropped, or
+        False if the client was told it is being disconnected and the read
+        loop should end.
+        """
+        if limits.muted():
+            rate_limited.inc()
+            return None
+        delay = limits.admit(size)
+        if not delay:
+            return 0.0
+        rate_limited.inc()
+        if limits.action == ratelimit.THROTTLE:
+            return delay
+        if limits.action == ratelimit.MUTE:
+            limits.mute()
+            send_error(client_socket, f"You are sending messages too fast and are muted for "
+                                      f"{ratelimit.MUTE_SECONDS:.0f} seconds")
+            print(f"Muted {username} for flooding")
+        else:
+            flood_disconnects.inc()
+            send_error(client_socket, "You are sending messages too fast. Disconnecting.")
+            print(f"Disconnecting {username} for flooding")
+            return False
+        return None
+
+    def negotiate_protocol(self, client_socket, decoder, options):
+        """Answer a client's HELLO and switch the connection to the agreed protocol.
+
+        Returns the HELLO reply, still in v1 framing, which the caller must get
+        to the client before anything else.
+        """
+        try:
+            version = int(options.get("proto", 1))
+            batch_limit = int(options.get("batch", 0))
+        except ValueError:
+            version, batch_limit = 1, 0
+        version = max(1, min(version, protocol.PROTOCOL_VERSION))
+        batch_limit = max(0, min(batch_limit, protocol.MAX_BATCH_SIZE)) if version > 1 else 0
+        compress = (self.compression_enabled and version > 1
+                    and options.get("compress") == protocol.COMPRESSION)
+
+        # The reply is still v1, so the client can read it whatever was agreed
+        reply = {"proto": version, "batch": batch_limit}
+        if compress:
+            reply["compress"] = protocol.COMPRESSION
+        resume = options.get("resume") if version > 1 and self.session_table.grace else None
+        if resume:
+            # "resume=1" asks for a new session; a token asks to continue one
+            session = self.session_table.get(resume)
+            if session is not None:
+                try:
+                    client_socket.resume_seq = int(options.get("last", 0))
+                except ValueError:
+                    pass
             else:
-                # Regular broadcast message
-                broadcast_msg = f"[{username}]: {request}"
-                print(f"Broadcasting from {username}: {request}")
-                broadcast(broadcast_msg, client_socket)
-            
-    except socket.timeout:
-        print(f"Client {client_address} timed out during initial handshake.")
-    except (ConnectionResetError, ConnectionAbortedError):
-        print(f"Connection reset by {client_address}.")
-    except Exception as e:
-        print(f"Error handling client {client_address}: {e}")
-    finally:
-        # Clean up client
-        with clients_lock:
-            if client_socket in clients:
-                if username:
-                    leave_msg = f"--- {username} has left the chat ---"
-                    print(f"User {username} left")
-                    broadcast(leave_msg)
-                del clients[client_socket]
-        
+                session = self.session_table.create()
+            client_socket.session = session
+            reply["session"] = session.token
+        if self.heartbeat_interval and version > 1 and options.get("heartbeat") == "1":
+            # The client promised to answer pings, so it can be told apart from a dead peer
+            reply["heartbeat"] = f"{self.heartbeat_interval:g}"
+            client_socket.heartbeat = True
+        client_socket.version = decoder.version = version
+        client_socket.batch_limit = batch_limit
+        client_socket.queue.skipped_notice = functools.partial(skipped_notice, version=version)
+        if compress:
+            # Both streams start right after the HELLO exchange
+            client_socket.compressor = protocol.FrameCompressor(
+                self.compress_min_bytes, on_compressed=count_compression)
+            decoder.decompressor = protocol.new_decompressor()
+            if batch_limit:
+                client_socket.batch_limit = max(0, batch_limit - protocol.COMPRESSION_SLACK)
+        return protocol.hello_frame(**reply)
+
+    # Threads mode
+
+    def client_handler(self, raw_socket, client_address, client_socket=None, decoder=None, username=None):
+        """Handle individual client connections.
+
+        When a handshake thread already read the username, it passes the
+        connection, its decoder and the username, and the handshake is skipped.
+        """
+        if client_socket is None:
+            if self.tls_context is not None:
+                raw_socket = self.wrap_tls(raw_socket, client_address)
+                if raw_socket is None:
+                    self.connection_slots.release()
+                    return
+            # Writes go through a queue drained by a writer thread; reads stay here
+            client_socket = self.new_connection(raw_socket, client_address)
+        client_socket.start()
+        raw_socket = client_socket.socket  # a SharedTLSSocket now if TLS
+        reader = protocol.MessageReader(raw_socket)
+        reader.decoder = decoder if decoder is not None else self.new_decoder(client_address)
+        limits = self.rate_limiter.for_client(client_address)
+        dropped = False  # the connection went away rather than the client leaving
         try:
+            if username is None:
+                # Set socket timeout for operations
+                raw_socket.settimeout(HANDSHAKE_TIMEOUT)
+
+                # Receive username with proper message framing
+                username = reader.receive()
+                hello = protocol.parse_hello(username or "")
+                if hello is not None:
+                    # Newer clients negotiate the protocol before sending their username
+                    queue_frame(client_socket, self.negotiate_protocol(client_socket, reader.decoder, hello))
+                    username = reader.receive()
+            if not username:
+                print(f"Failed to receive username from {client_address}")
+                return
+
+            # Validate username
+            username = clean_username(username)
+            if not username:
+                send_error(client_socket, "Invalid username")
+                return
+
+            username = self.join_client(client_socket, username)
+            print(f"User {username} joined from {client_address}")
+
+            # Remove timeout for message receiving
+            raw_socket.settimeout(None)
+
+            while self.running:
+                message = reader.receive_message()
+                if message is None:
+                    dropped = True
+                    break
+                client_socket.last_seen = time.monotonic()
+                bytes_in.inc(reader.decoder.last_frame_size)
+                if limits:
+                    delay = self.admit_request(client_socket, username, limits, reader.decoder.last_frame_size)
+                    if delay is False:
+                        break
+                    if delay is None:
+                        continue
+                    if delay:
+                        # Not reading lets TCP push back on the flooder
+                        time.sleep(delay)
+                if self.handle_control(client_socket, message):
+                    continue
+                request = message.text
+                if not request:
+                    break
+                if not self.handle_request(client_socket, username, request):
+                    break
+
+        except socket.timeout:
+            print(f"Client {client_address} timed out during initial handshake.")
+        except (ConnectionResetError, ConnectionAbortedError):
+            print(f"Connection reset by {client_address}.")
+            dropped = True
+        except Exception as e:
+            print(f"Error handling client {client_address}: {e}")
+        finally:
+            # Clean up client
+            self.end_connection(client_socket, username, dropped)
+            self.end_capture(reader.decoder)
+            self.rate_limiter.release(client_address)
+            self.connection_slots.release()
+
+            # Let the writer flush (e.g. "Goodbye!") before the socket goes away
             client_socket.close()
-        except:
-            pass
-        print(f"Connection to {client_address} closed.")
-
-def shutdown_server():
-    """Gracefully shutdown the server"""
-    global server_running
-    server_running = False
-    
-    print("Shutting down server gracefully...")
-    
-    # Notify all clients and close connections
-    with clients_lock:
-        clients_copy = dict(clients)
-    
-    for client_socket, username in clients_copy.items():
+            client_socket.join(CLOSE_TIMEOUT)
+            client_socket.abort()
+            try:
+                raw_socket.close()
+            except:
+                pass
+            print(f"Connection to {client_address} closed.")
+
+    def wrap_tls(self, raw_socket, client_address):
+        """Do the TLS handshake of a new connection. Returns the SSLSocket, or None.
+
+        This runs on the client's own thread, never in the accept loop, so
+        a peer that is slow to complete its handshake only holds up itself.
+        """
         try:
-            send_message(client_socket, "SERVER: Server is shutting down. Goodbye!")
+            raw_socket.settimeout(HANDSHAKE_TIMEOUT)
+            tls_socket = self.tls_context.wrap_socket(raw_socket, server_side=True)
+        except OSError as e:
+            print(f"TLS handshake with {client_address} failed: {e}")
+            raw_socket.close()
+            return None
+        count_tls(tls_socket)
+        return tls_socket
+
+    def start_client_thread(self, client_socket, client_address, decoder, username):
+        """Run a client whose handshake finished on a handshake thread"""
+        if self.tls_context is not None:
+            count_tls(client_socket.socket)
+        thread = threading.Thread(
+            target=self.client_handler,
+            args=(client_socket.socket, client_address, client_socket, decoder, username),
+            daemon=True,
+        )
+        thread.start()
+
+    def handshake_failed(self, client_socket, client_address, reason):
+        print(f"Client {client_address} {reason}.")
+        client_socket.abort()
+        client_socket.socket.close()
+        self.connection_slots.release()
+
+    def start_handshake_reactors(self):
+        """Start the --handshake-threads pool; returns an endless cycle over it"""
+        for index in range(self.handshake_threads):
+            reactor = admission.HandshakeReactor(
+                HANDSHAKE_TIMEOUT, self.negotiate_protocol, self.start_client_thread,
+                self.handshake_failed, name=f"handshakes-{index}", tls_context=self.tls_context,
+                new_decoder=self.new_decoder)
+            reactor.start()
+            self.handshake_reactors.append(reactor)
+        return itertools.cycle(self.handshake_reactors)
+
+    def shutdown_server(self):
+        """Gracefully shutdown the server"""
+        self.running = False
+
+        print("Shutting down server gracefully...")
+
+        # Notify all clients and close connections
+        clients_copy = self.clients.clear()
+
+        goodbye = protocol.Message(protocol.SYSTEM, "SERVER: Server is shutting down. Goodbye!")
+        for client_socket, username in clients_copy:
+            send_message(client_socket, goodbye)
             client_socket.close()
-        except:
-            pass
-    
-    with clients_lock:
-        clients.clear()
-
-def run_server():
-    """Run the chat server"""
-    global server_running
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
-    try:
-        print(f"Binding server to {server_ip}:{port}...")
-        server.bind((server_ip, port))
-        print("Server bound successfully.")
 
-        server.listen(5)
-        print(f"Listening on {server_ip}:{port}")
-        print("Server is ready to accept connections. Press Ctrl+C to stop.")
+        # Give writers a moment to flush the goodbye before the process exits
+        deadline = time.monotonic() + 1.0
+        for client_socket, username in clients_copy:
+            client_socket.join(max(0.0, deadline - time.monotonic()))
+        self.message_history.close()
+        if self.search_index is not None:
+            self.search_index.close()
+        if self.capture is not None:
+            # Handler threads record their last frames as their sockets close;
+            # on the event loop they can only do so once this returns
+            self.capture.close(timeout=0.0 if self.mode == "async" else 1.0)
+            print(f"Captured {self.capture.frames} frames to {self.capture_path}")
+            self.capture = None
 
-        while server_running:
-            try:
-                server.settimeout(1.0)  # Allow periodic checks for shutdown
-                client_socket, client_address = server.accept()
-                
-                if not server_running:
-                    client_socket.close()
+    def run_server(self):
+        """Run the chat server with one thread per connection"""
+        try:
+            self.start_metrics_endpoint()
+            self.start_history()
+            self.start_capture()
+            self.start_search()
+            self.start_heartbeat()
+            if self.listener is None:
+                self.bind()
+            listener = self.listener
+
+            reactors = self.start_handshake_reactors()
+            self.running = True
+            print(f"Listening on {self.host}:{self.port}{' (TLS)' if self.tls_context else ''}")
+            print("Server is ready to accept connections. Press Ctrl+C to stop.")
+            self.ready.set()
+
+            while self.running:
+                try:
+                    listener.settimeout(1.0)  # Allow periodic checks for shutdown
+                    client_socket, client_address = listener.accept()
+
+                    if not self.running:
+                        client_socket.close()
+                        break
+
+                    connections_accepted.inc()
+                    self.expire_sessions()
+                    heartbeat.enable_keepalive(client_socket)
+                    # Also keeps Nagle from holding back the flights of a TLS handshake
+                    outbound.set_nodelay(client_socket, self.tcp_nodelay)
+                    if not self.connection_slots.acquire():
+                        reject_connection(client_socket, client_address, notice=self.tls_context is None)
+                        continue
+                    print(f"Accepted connection from {client_address[0]}:{client_address[1]}")
+                    if self.handshake_reactors:
+                        # Idle handshakers then cost a selector entry, not a thread
+                        connection = self.new_connection(client_socket, client_address)
+                        next(reactors).add(connection, client_address)
+                    else:
+                        thread = threading.Thread(
+                            target=self.client_handler,
+                            args=(client_socket, client_address),
+                            daemon=True
+                        )
+                        thread.start()
+
+                    # Hold off the next accept to stay within --accept-rate;
+                    # meanwhile new connections wait in the listen backlog
+                    delay = self.rate_limiter.accept_delay()
+                    if delay:
+                        accepts_throttled.inc()
+                        time.sleep(delay)
+
+                except socket.timeout:
+                    self.expire_sessions()
+                    continue  # Check if server should keep running
+                except OSError:
+                    if self.running:
+                        print("Error accepting connections")
                     break
-                    
-                print(f"Accepted connection from {client_address[0]}:{client_address[1]}")
-                thread = threading.Thread(
-                    target=client_handler, 
-                    args=(client_socket, client_address),
-                    daemon=True
-                )
-                thread.start()
-                
-            except socket.timeout:
-                continue  # Check if server should keep running
-            except OSError:
-                if server_running:
-                    print("Error accepting connections")
-                break
-                
-    except KeyboardInterrupt:
-        print("\nReceived shutdown signal.")
-    except Exception as e:
-        print(f"Server error: {e}")
-    finally:
-        shutdown_server()
-        server.close()
-        print("Server closed.")
+
+        except KeyboardInterrupt:
+            print("\nReceived shutdown signal.")
+        except Exception as e:
+            print(f"Server error: {e}")
+        finally:
+            for reactor in self.handshake_reactors:
+                reactor.stop()
+            self.handshake_reactors = []
+            if self.heartbeats is not None:
+                self.heartbeats.stop()
+            self.shutdown_server()
+            if self.listener is not None:
+                self.listener.close()
+            print("Server closed.")
+
+@command("/whisper", "/w", usage="<username> <message>", description="Send a private message")
+def whisper_command(chat_server, client_socket, username, args):
+    if len(args) < 2:
+        send_error(client_socket, "Usage: /whisper <username> <message>")
+        return
+
+    target_username = args[0]
+    whisper_message = " ".join(args[1:])
+
+    success, response = chat_server.send_private_message(
+        username, target_username, whisper_message, chat_server.clients.user_id(client_socket))
+
+    if success:
+        # Send confirmation to sender
+        confirmation = f"[PRIVATE to {target_username}]: {whisper_message}"
+        send_message(client_socket, confirmation, protocol.PRIVATE)
+    else:
+        send_error(client_socket, response)
+
+@command("/who", "/users", description="List all connected users")
+def who_command(chat_server, client_socket, username, args):
+    send_message(client_socket, chat_server.get_user_list())
+
+@command("/join", "/j", usage="<room>", description="Switch to another room, creating it if needed")
+def join_command(chat_server, client_socket, username, args):
+    if len(args) != 1:
+        send_error(client_socket, "Usage: /join <room>")
+        return
+    room = registry.normalize_room(args[0])
+    if not room:
+        send_error(client_socket, "Room names are 1-30 letters, digits, '-' or '_'")
+        return
+    chat_server.change_room(client_socket, username, room)
+
+@command("/part", "/leave", description="Go back to the lobby")
+def part_command(chat_server, client_socket, username, args):
+    if chat_server.clients.room_of(client_socket) == registry.DEFAULT_ROOM:
+        send_error(client_socket, f"You are already in #{registry.DEFAULT_ROOM}")
+        return
+    chat_server.change_room(client_socket, username, registry.DEFAULT_ROOM)
+
+@command("/rooms", description="List rooms and how many users are in each")
+def rooms_command(chat_server, client_socket, username, args):
+    rooms = chat_server.clients.room_list()
+    if chat_server.bus:
+        rooms = chat_server.bus.merged_room_counts(rooms)
+    room_list = ", ".join(f"#{room} ({count})" for room, count in rooms)
+    send_message(client_socket, f"Rooms ({len(rooms)}): {room_list}")
+
+@command("/history", usage="[count]", description="Show recent messages in your room")
+def history_command(chat_server, client_socket, username, args):
+    count = chat_server.backfill_count
+    if len(args) > 1 or (args and not args[0].isdigit()):
+        send_error(client_socket, "Usage: /history [count]")
+        return
+    if args:
+        count = min(int(args[0]), history.HISTORY_LIMIT)
+    room = chat_server.clients.room_of(client_socket)
+    if not chat_server.send_history(client_socket, room, count, f"Last messages in #{room}"):
+        send_message(client_socket, f"No messages in #{room} yet")
+
+@command("/search", usage="<words>", description="Find recent messages in your room containing all the words")
+def search_command(chat_server, client_socket, username, args):
+    if not args:
+        send_error(client_socket, "Usage: /search <words>")
+        return
+    if chat_server.search_index is None:
+        send_error(client_socket, "Search is disabled on this server")
+        return
+    terms = " ".join(args)
+    room = chat_server.clients.room_of(client_socket)
+    matches = chat_server.search_index.search(room, terms)
+    if not matches:
+        send_message(client_socket, f"No recent messages in #{room} match '{terms}'")
+        return
+    send_message(client_socket, f"--- Messages in #{room} matching '{terms}' ---")
+    for message in matches:
+        send_message(client_socket, message)
+    send_message(client_socket, "--- End of search results ---")
+
+@command("/stats", description="Show server statistics (admins only)")
+def stats_command(chat_server, client_socket, username, args):
+    if not chat_server.is_admin(client_socket, username):
+        send_error(client_socket, "/stats is restricted to admins")
+        return
+    send_message(client_socket, get_stats())
+
+@command("/help", "/h", description="Show this help message")
+def help_command(chat_server, client_socket, username, args):
+    send_message(client_socket, chat_server.help_text(), protocol.HELP)
+
+def main():
+    """Parse command-line options and start the selected server mode"""
+    parser = argparse.ArgumentParser(description="Multi-client chat server")
+    parser.add_argument("--host", default=ChatServer.host, help="address to bind (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=ChatServer.port,
+                        help="port to bind; 0 picks a free one (default: %(default)s)")
+    parser.add_argument(
+        "--mode", choices=["threads", "async"], default=ChatServer.mode,
+        help="threads: one thread per connection; async: single-threaded asyncio event loop",
+    )
+    parser.add_argument(
+        "--slow-consumer", choices=outbound.SLOW_CONSUMER_POLICIES, default=ChatServer.slow_consumer_policy,
+        help="what to do when a client's outbound queue is full (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-queue-bytes", type=int, default=ChatServer.max_queue_bytes,
+        help="per-client outbound queue limit in bytes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of worker processes sharing the port via SO_REUSEPORT (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=0,
+        help="serve Prometheus metrics over HTTP on this port (default: off)",
+    )
+    parser.add_argument(
+        "--admin", action="append", default=[], metavar="USERNAME",
+        help="allow this user to run /stats (repeatable; default: any loopback client)",
+    )
+    parser.add_argument(
+        "--log-messages", type=int, nargs="?", const=100, default=0, metavar="PER_SECOND",
+        help="log chat messages, at most PER_SECOND lines per second (default when given: 100)",
+    )
+    parser.add_argument(
+        "--history-dir", metavar="DIR",
+        help="persist chat history in this directory (default: keep it in memory only)",
+    )
+    parser.add_argument(
+        "--backfill", type=int, default=ChatServer.backfill_count, metavar="COUNT",
+        help="recent messages shown when a user enters a room (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-compression", action="store_true",
+        help="refuse compression even when a client asks for it",
+    )
+    parser.add_argument(
+        "--compress-min-bytes", type=int, default=ChatServer.compress_min_bytes, metavar="BYTES",
+        help="send writes smaller than this uncompressed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rate-limit", type=float, default=0, metavar="PER_SECOND",
+        help="messages per second allowed from one connection (default: unlimited)",
+    )
+    parser.add_argument(
+        "--byte-limit", type=float, default=0, metavar="PER_SECOND",
+        help="message bytes per second allowed from one connection (default: unlimited)",
+    )
+    parser.add_argument(
+        "--ip-rate-limit", type=float, default=0, metavar="PER_SECOND",
+        help="messages per second allowed from all connections of one IP (default: unlimited)",
+    )
+    parser.add_argument(
+        "--ip-byte-limit", type=float, default=0, metavar="PER_SECOND",
+        help="message bytes per second allowed from all connections of one IP (default: unlimited)",
+    )
+    parser.add_argument(
+        "--flood-action", choices=ratelimit.FLOOD_ACTIONS, default=ratelimit.THROTTLE,
+        help="what to do with a client over its limits (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--accept-rate", type=float, default=0, metavar="PER_SECOND",
+        help="new connections handled per second (default: unlimited)",
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=ChatServer.listen_backlog,
+        help="listen backlog for connections not yet accepted (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-connections", type=int, default=0, metavar="COUNT",
+        help="turn away connections beyond this many with a 'server full' notice (default: unlimited)",
+    )
+    parser.add_argument(
+        "--handshake-threads", type=int, default=0, metavar="COUNT",
+        help="read handshakes on this many shared threads instead of one per connection "
+             "(threads mode only; default: off)",
+    )
+    parser.add_argument(
+        "--heartbeat-interval", type=float, default=ChatServer.heartbeat_interval, metavar="SECONDS",
+        help="ping clients that support heartbeats after this much silence; 0 disables "
+             "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--idle-timeout", type=float, default=ChatServer.idle_timeout, metavar="SECONDS",
+        help="drop such clients after this much silence (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--session-grace", type=float, default=ChatServer.session_grace, metavar="SECONDS",
+        help="keep a dropped client's session this long so it can reconnect and resume; "
+             "0 disables sessions (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--replay-size", type=int, default=ChatServer.replay_size, metavar="COUNT",
+        help="recent messages kept per session for a resume (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--search-window", type=int, default=ChatServer.search_window, metavar="COUNT",
+        help="most recent chat messages /search looks through; 0 disables /search "
+             "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--capture", metavar="FILE",
+        help="record every inbound frame to FILE for benchmarks/replay.py; holds chat text, "
+             "so treat it like a message log",
+    )
+    parser.add_argument(
+        "--coalesce-ms", type=float, default=0, metavar="MS",
+        help="gather frames for a client this long before writing them in one go; trades "
+             "latency for fewer syscalls and packets (default: write at once)",
+    )
+    parser.add_argument(
+        "--no-nodelay", action="store_true",
+        help="leave Nagle's algorithm on for client sockets",
+    )
+    parser.add_argument(
+        "--cork", action="store_true",
+        help="cork client sockets around each write so only full TCP segments go out (Linux)",
+    )
+    parser.add_argument(
+        "--tls-cert", metavar="FILE",
+        help="serve TLS with this PEM certificate chain (default: plaintext)",
+    )
+    parser.add_argument(
+        "--tls-key", metavar="FILE",
+        help="private key for --tls-cert, if not in the same file",
+    )
+    args = parser.parse_args()
+    tls_context = None
+    if args.tls_cert:
+        try:
+            tls_context = tls.server_context(args.tls_cert, args.tls_key)
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot load TLS certificate: {e}")
+    if args.cork and outbound.CORK_OPTION is None:
+        print("TCP_CORK is not available on this platform; --cork has no effect")
+    if args.log_messages:
+        metrics.enable_message_log(args.log_messages, log_suppressed)
+    chat_server = ChatServer(
+        host=args.host, port=args.port, mode=args.mode,
+        slow_consumer_policy=args.slow_consumer, max_queue_bytes=args.max_queue_bytes,
+        metrics_port=args.metrics_port, admin_users=args.admin,
+        history_dir=args.history_dir, backfill_count=args.backfill, capture_path=args.capture,
+        search_window=args.search_window,
+        compression_enabled=not args.no_compression, compress_min_bytes=args.compress_min_bytes,
+        listen_backlog=args.backlog, max_connections=args.max_connections,
+        handshake_threads=args.handshake_threads,
+        heartbeat_interval=args.heartbeat_interval, idle_timeout=args.idle_timeout,
+        session_grace=args.session_grace, replay_size=args.replay_size, tls_context=tls_context,
+        coalesce_window=args.coalesce_ms / 1000, tcp_nodelay=not args.no_nodelay, tcp_cork=args.cork,
+        rate_limiter=ratelimit.RateLimiter(
+            args.rate_limit, args.byte_limit, args.ip_rate_limit, args.ip_byte_limit,
+            args.flood_action, args.accept_rate),
+    )
+
+    if args.workers > 1:
+        import cluster
+        cluster.run_cluster(args.workers, chat_server)
+    else:
+        chat_server.run()
 
 if __name__ == "__main__":
-    run_server()
+    # Run through the importable module so plugins and async_server share its command table
+    import server
+    server.main()
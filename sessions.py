@@ -0,0 +1,140 @@
+import collections
+import secrets
+import threading
+import time
+
+import protocol
+
+GRACE_SECONDS = 60.0  # how long a dropped session waits for its client
+REPLAY_SIZE = 128     # most recent messages kept per session for a resume
+
+class Session:
+    """Identity of a resumable client and the messages recently sent to it.
+
+    Every message queued for the session is stamped with the next number of
+    the session's own sequence, carried in the seq field of the v2 header,
+    and kept in a bounded replay buffer. A client that reconnects reports
+    the last number it saw and gets only what came after it. The body of a
+    message is still shared by all recipients; only the 14-byte header is
+    built per session.
+    """
+
+    def __init__(self, token, replay_size=REPLAY_SIZE):
+        self.token = token
+        self.username = None  # set once the first connection has registered
+        self.connection = None  # live connection, or DetachedConnection while away
+        self.seq = 0
+        self.replay = collections.deque(maxlen=replay_size)  # (seq, Frame)
+        self.expires = None   # monotonic deadline while detached
+        self.lock = threading.Lock()
+
+    def record(self, message):
+        """Number message for this session, keep it, and return its Frame"""
+        with self.lock:
+            self.seq += 1
+            frame = protocol.Frame(message.body, protocol.MESSAGE_HEADER.pack(
+                message.kind, message.flags, message.sender_id, message.room_id, self.seq))
+            self.replay.append((self.seq, frame))
+        return frame
+
+    def missed(self, last_seq):
+        """Frames sent after last_seq, and whether that is all of them.
+
+        The second value is False when older messages the client never saw
+        have already left the replay buffer.
+        """
+        with self.lock:
+            frames = [frame for seq, frame in self.replay if seq > last_seq]
+            oldest = self.replay[0][0] if self.replay else self.seq + 1
+        return frames, last_seq >= oldest - 1
+
+class DetachedConnection:
+    """Stands in for a dropped client in the registry until it resumes.
+
+    It keeps the username taken and the client in its room, so nobody is
+    told about a leave or a join for a short network blip. Messages sent to
+    it are only recorded by the session, to be replayed on resume.
+    """
+
+    queue = None
+    writer_task = None
+    heartbeat = False
+
+    def __init__(self, session, version, address=None):
+        self.session = session
+        self.version = version
+        self.address = address
+        self.last_seen = time.monotonic()
+
+    def send_frame(self, frame):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+    def join(self, timeout=None):
+        pass
+
+class SessionTable:
+    """Sessions by token, and the detached ones in order of expiry"""
+
+    def __init__(self, grace=GRACE_SECONDS, replay_size=REPLAY_SIZE):
+        self.grace = grace
+        self.replay_size = replay_size
+        self.lock = threading.Lock()
+        self._sessions = {}  # token -> Session
+        self._detached = collections.deque()  # (deadline, Session) in detach order
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self):
+        session = Session(secrets.token_urlsafe(16), self.replay_size)
+        with self.lock:
+            self._sessions[session.token] = session
+        return session
+
+    def get(self, token):
+        return self._sessions.get(token)
+
+    def discard(self, session):
+        with self.lock:
+            self._sessions.pop(session.token, None)
+        session.expires = None
+
+    def detach(self, session, placeholder):
+        """Park a session whose connection dropped until grace runs out"""
+        session.connection = placeholder
+        session.expires = time.monotonic() + self.grace
+        with self.lock:
+            self._detached.append((session.expires, session))
+
+    def attach(self, session, connection):
+        """Give a session to a new connection. Returns False if it just expired."""
+        with self.lock:
+            if self._sessions.get(session.token) is not session:
+                return False
+            session.connection = connection
+            session.expires = None
+        return True
+
+    def expired(self):
+        """Remove and return the detached sessions whose grace ran out"""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            # Every session gets the same grace, so deadlines arrive in order;
+            # entries of sessions that resumed since are skipped as they surface
+            while self._detached:
+                deadline, session = self._detached[0]
+                if deadline > now:
+                    break
+                self._detached.popleft()
+                if session.expires == deadline:
+                    session.expires = None
+                    self._sessions.pop(session.token, None)
+                    expired.append(session)
+        return expired
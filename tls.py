@@ -0,0 +1,27 @@
+import ssl
+
+# Session tickets the server hands out per full handshake. A TLS 1.3
+# ticket is good for one resumption, so a client that reconnects twice
+# in a row still skips the full handshake both times.
+SESSION_TICKETS = 2
+
+def server_context(certfile, keyfile=None):
+    """TLS context for the chat server.
+
+    Clients resume earlier sessions with TLS 1.3 tickets, or session ids
+    on TLS 1.2. A resumed handshake skips the certificate exchange and the
+    public-key operations, which are most of what a full one costs. The
+    ticket keys belong to the context, so every connection of the server,
+    and every worker forked after it was created, honours them.
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = SESSION_TICKETS
+    return context
+
+def client_context(cafile=None):
+    """TLS context for clients, trusting cafile (e.g. a self-signed cert) if given"""
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context